@@ -1,2 +1,26 @@
 from . import mamele
 Mamele = mamele.Mamele
+spawn = mamele.spawn
+
+# the rest pull in numpy, asyncio and threads, so only import them when somebody asks for them
+_lazy = {
+    'MameleVec': ('vector', 'MameleVec'),
+    'AsyncMamele': ('asynchronous', 'AsyncMamele'),
+    'MamelePool': ('pool', 'MamelePool'),
+    'EpisodeRecorder': ('recorder', 'EpisodeRecorder'),
+    'Recording': ('recorder', 'Recording'),
+    'MameleEnv': ('wrapper', 'MameleEnv'),
+    'SupervisedMamele': ('supervisor', 'SupervisedMamele'),
+    'RemoteMamele': ('remote', 'RemoteMamele'),
+    'RemoteMameleVec': ('remote', 'RemoteMameleVec'),
+    'MameleServer': ('server', 'MameleServer'),
+}
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    module_name, attribute = _lazy[name]
+    value = getattr(importlib.import_module('.' + module_name, __name__), attribute)
+    globals()[name] = value
+    return value
@@ -0,0 +1,368 @@
+"""
+asyncio version of Mamele, so that many environments can share one event loop
+"""
+
+import os
+import time
+import socket
+import asyncio
+import logging
+import tempfile
+
+import numpy
+
+from .connection import Socket
+from .mamele import Mamele
+from .protocol import (TextProtocol, BinaryProtocol, UpdateHeader, UpdateMessage, QuitMessage,
+    FrameInSharedMemory, FrameOmitted, FrameTiles, TimingsAttached, FrameHashAttached, TileCount, Timings, FrameHash)
+
+
+def _synchronous_only(name):
+    """
+    A method that says `name` is one of Mamele's that AsyncMamele can't have, for those it would otherwise inherit
+    """
+    def method(self, *arguments, **keywords):
+        raise NotImplementedError("%s only works with Mamele, AsyncMamele talks to MAME through asyncio streams" % name)
+    method.__name__ = name
+    return method
+
+
+class AsyncMamele(Mamele):
+    """
+    Talks to the passthrough like Mamele does, but over asyncio streams.
+
+    Create it with `await AsyncMamele.launch(game_name)`. Everything that talks to MAME is a coroutine
+    (act, restart_game, skip, quit...), while everything that only looks at what we already received
+    (get_screen, is_game_over, get_minimal_action_set...) is the same as in Mamele
+    """
+
+    def __init__(self, game_name, **arguments):
+        # same arguments as Mamele
+        self._initialise_state(game_name, **arguments)
+        self.listener = Socket()
+        self.reader = None
+        self.writer = None
+        self.mame = None
+
+    @classmethod
+    async def launch(cls, game_name, **arguments):
+        """
+        Start MAME and go through the handshake without blocking the event loop
+        """
+        environment = cls(game_name, **arguments)
+        try:
+            await environment._connect()
+        except BaseException:
+            environment._close_connection()
+            raise
+        return environment
+
+    async def _connect(self):
+        if self.inherit_socket:
+            # same as Mamele, MAME gets its end of a socket pair
+            connection, other_end = socket.socketpair()
+            address = '%s%d' % (Socket.InheritedPrefix, other_end.fileno())
+            if self.shared_memory:
+                self.frame_buffer_directory = tempfile.mkdtemp(prefix="mameleframes")
+                self.frame_buffer_path = os.path.join(self.frame_buffer_directory, 'framebuffer')
+            try:
+                self.mame = await asyncio.create_subprocess_exec(*self._mame_command(self.game_name, address), stderr=asyncio.subprocess.STDOUT,
+                                                                 pass_fds=(other_end.fileno(),))
+                self._place_mame(self.mame.pid)
+            except BaseException:
+                connection.close()
+                raise
+            finally:
+                other_end.close()
+        else:
+            socket_path = self.listener.start_server()
+            if self.shared_memory:
+                self.frame_buffer_path = os.path.join(os.path.dirname(socket_path), 'framebuffer')
+
+            self.mame = await asyncio.create_subprocess_exec(*self._mame_command(self.game_name, socket_path), stderr=asyncio.subprocess.STDOUT)
+            self._place_mame(self.mame.pid)
+
+            # wait for mame to connect
+            self.listener.socket.setblocking(False)
+            connection, _ = await asyncio.get_running_loop().sock_accept(self.listener.socket)
+        self.reader, self.writer = await asyncio.open_unix_connection(sock=connection)
+
+        # we expect the mame module to send the size and the minimal button set
+        await self.receive_message()
+        await self.receive_message()
+        if self.requested_protocol > TextProtocol:
+            # and to tell us which protocol we'll be talking from now on
+            await self.receive_message()
+
+
+    async def send_message(self, message):
+        if not self.last_received:
+            # the passthrough only receives once after sending an update
+            await self.receive_message()
+
+        self.writer.write(message)
+        await self.writer.drain()
+        self.last_received = False
+
+
+    async def receive_message(self):
+        try:
+            if self.protocol == BinaryProtocol:
+                await self._receive_binary_message()
+                return
+
+            command = (await self.reader.readexactly(4)).lower()
+            if command == b'size':
+                size_description = await self.reader.readuntil(b'\n')
+                self._initialise_screen(size_description.strip())
+            elif command == b'used':
+                switches_used_description = await self.reader.readuntil(b'\n')
+                self._initialise_action_space(switches_used_description.strip())
+            elif command == b'prot':
+                protocol_description = await self.reader.readuntil(b'\n')
+                self._set_protocol(protocol_description.strip())
+            elif command == b'quit':
+                logging.info("Got a quit from the environment")
+                self.expected_quit()
+            elif command == b'updt':
+                score_description = await self.reader.readuntil(b'\n')
+                game_over_description = await self.reader.readuntil(b'\n')
+                await self._receive_frame()
+                if not self.resetting:
+                    self._set_score(score_description.strip())
+                    self._set_game_over(game_over_description.strip())
+                self.last_received = True
+            elif command == b'frme':
+                frame_number_description = await self.reader.readuntil(b'\n')
+                score_description = await self.reader.readuntil(b'\n')
+                game_over_description = await self.reader.readuntil(b'\n')
+                self.frame_number = int(frame_number_description)
+                self._take_shared_frame()
+                if not self.resetting:
+                    self._set_score(score_description.strip())
+                    self._set_game_over(game_over_description.strip())
+                self.last_received = True
+
+        except asyncio.IncompleteReadError as error:
+            logging.error("The passthrough hung up on us: %s" % error)
+            self.unexpected_quit()
+        except self.CommunicationError as error:
+            logging.error("Something went wrong talking to mamele: %s" % error)
+            self.unexpected_quit()
+
+
+    async def _receive_binary_message(self):
+        header = await self.reader.readexactly(UpdateHeader.size)
+        message, game_over, flags, frame_number, score, length = UpdateHeader.unpack(header)
+        if message == UpdateMessage:
+            if flags & TimingsAttached:
+                self._record_passthrough_timings(Timings.unpack(await self.reader.readexactly(Timings.size)))
+                length -= Timings.size
+            if flags & FrameHashAttached:
+                self._take_frame_hash(*FrameHash.unpack(await self.reader.readexactly(FrameHash.size)))
+                length -= FrameHash.size
+
+            if flags & FrameOmitted:
+                pass
+            elif flags & FrameInSharedMemory:
+                self._take_shared_frame()
+            elif flags & FrameTiles:
+                count, = TileCount.unpack(await self.reader.readexactly(TileCount.size))
+                indices, contents = self._tiles_buffers(count, length)
+                indices[:] = numpy.frombuffer(await self.reader.readexactly(indices.nbytes), dtype=numpy.uint32)
+                contents[:] = numpy.frombuffer(await self.reader.readexactly(contents.nbytes), dtype=numpy.uint8)
+                self._apply_tiles(indices, contents)
+            elif length == self.images_size_in_bytes:
+                await self._receive_frame()
+            else:
+                raise self.CommunicationError("Expected a frame of %d bytes but got told about %d" % (self.images_size_in_bytes, length))
+
+            self.frame_number = frame_number
+            self._update_status(score, game_over)
+            self.last_received = True
+        elif message == QuitMessage:
+            logging.info("Got a quit from the environment")
+            self.expected_quit()
+        else:
+            raise self.CommunicationError("Unknown message type: %d" % message)
+
+    async def _timed_send_message(self, message):
+        if not self.last_received:
+            await self.receive_message()
+        started = time.perf_counter_ns()
+        await self._untimed_send_message(message)
+        self._sent_at = time.perf_counter_ns()
+        self.statistics.record('send', self._sent_at - started)
+
+    async def _timed_receive_message(self):
+        started = time.perf_counter_ns()
+        frame_number = self.frame_number
+        await self._untimed_receive_message()
+        self._count_update(started, frame_number)
+
+    def _connection_counters(self):
+        # the streams don't keep count
+        return {}
+
+    async def _receive_frame(self):
+        # the stream hands us a new bytes object whatever we do, so only copy if somebody wants it elsewhere
+        frame = await self.reader.readexactly(self.images_size_in_bytes)
+        if self._own_image_buffer and self.tile_grid is None:
+            self.latest_image_as_bytes = frame
+            self._observations.clear()
+        else:
+            memoryview(self.image_buffer).cast('B')[:] = frame
+            self._take_full_frame()
+
+
+    async def restart_game(self):
+        # same dance as Mamele.restart_game
+        if self._start_snapshot is not None:
+            await self._restore_snapshot(self._start_snapshot)
+            return
+
+        self.resetting = True
+        if not self.last_received:
+            await self.receive_message()
+        if not self.game_over:
+            await self.reset()
+            await self.skip(self.ResetFrames)
+        await self.insert_coin()
+        await self.skip(self.PressFrames)
+        await self.press_nothing()
+        await self.skip(self.CoinToStartFrames)
+        await self.start_player1()
+        await self.skip(self.PressFrames)
+        await self.press_nothing()
+        await self.skip(self.StartToLiveFrames)
+        self.game_over = False
+        self.score = self.previous_score = 0
+        self.resetting = False
+
+        if self._wants_start_snapshot():
+            try:
+                self._start_snapshot = await self._take_snapshot()
+            except NotImplementedError:
+                logging.info("MAME can't save states, restarting the long way")
+
+    async def snapshot(self):
+        return self.states.add(await self._take_snapshot())
+
+    async def restore(self, handle):
+        await self._restore_snapshot(self.states.get(handle))
+
+    async def _take_snapshot(self):
+        self._check_states_supported()
+        if not self.last_received:
+            await self.receive_message()
+        self.writer.write(self._save_state_message())
+        await self.writer.drain()
+        return self._snapshot_of(await self._receive_state())
+
+    async def _restore_snapshot(self, snapshot):
+        self._check_states_supported()
+        if not self.last_received:
+            await self.receive_message()
+        self.writer.writelines(self._load_state_message(snapshot.state))
+        await self.writer.drain()
+        await self._receive_state()
+        self._apply_snapshot(snapshot)
+
+    async def _receive_state(self):
+        message, _, flags, _, _, length = UpdateHeader.unpack(await self.reader.readexactly(UpdateHeader.size))
+        self._check_state_message(message, flags)
+        return await self.reader.readexactly(length)
+
+    async def act(self, action, repeat=1, max_pool=False, with_frame=None):
+        if repeat > 1 and self.protocol == TextProtocol:
+            if max_pool:
+                raise ValueError("Pooling frames needs the binary protocol")
+            starting_score = self.score
+            for _ in range(repeat):
+                await self.send_action(action, with_frame=with_frame)
+                await self.receive_update()
+                if self.game_over:
+                    break
+            return self.score - starting_score
+
+        await self.send_action(action, repeat, max_pool, with_frame)
+        return await self.receive_update()
+
+    def act_async(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        Not needed here: act is a coroutine already, so make a task of it to get on with something else while MAME emulates
+        """
+        raise NotImplementedError("AsyncMamele.act is a coroutine already, run it as a task (asyncio.ensure_future) instead of using act_async")
+
+    async def send_action(self, action, repeat=1, max_pool=False, with_frame=None):
+        await self._send_input(action, repeat, max_pool, with_frame)
+
+    async def receive_update(self):
+        await self.receive_message()
+        return self.score - self.previous_score
+
+    async def quit(self):
+        """
+        Tell MAME to quit and wait for it to be gone
+        """
+        await self.send_message(self._quit_message())
+        self._close_connection()
+        await self.mame.wait()
+
+    async def reset(self):
+        await self.send_message(self._reset_message())
+
+    async def insert_coin(self):
+        await self._send_input('coin')
+
+    async def start_player1(self):
+        await self._send_input('player1')
+
+    async def press_nothing(self):
+        await self._send_input('nothing')
+
+    async def skip(self, frames):
+        await self.send_message(self._skip_message(frames))
+
+    async def _send_input(self, key, repeat=1, max_pool=False, with_frame=None):
+        await self.send_message(self._input_message(key, repeat, max_pool, with_frame))
+
+
+    # these block on the connection Mamele makes, which we don't have
+    finish_connecting = _synchronous_only('finish_connecting')
+    connecting_socket = _synchronous_only('connecting_socket')
+    has_pending_data = _synchronous_only('has_pending_data')
+    replay = _synchronous_only('replay')
+    # and hooks are called as Mamele receives updates, which we do differently
+    add_step_hook = _synchronous_only('add_step_hook')
+    remove_step_hook = _synchronous_only('remove_step_hook')
+
+    def abandon(self):
+        """
+        Kill MAME and clean up without talking to it, for when things didn't work out. This can't wait
+        for MAME to be gone, `await environment.mame.wait()` for that
+        """
+        if self.mame is not None and self.mame.returncode is None:
+            self.mame.kill()
+        self._close_connection()
+
+    def fileno(self):
+        """
+        File descriptor of the connection to the passthrough
+        """
+        return self.writer.get_extra_info('socket').fileno()
+
+    def expected_quit(self):
+        self._close_connection()
+
+    def unexpected_quit(self):
+        self._close_connection()
+        raise IOError("Could not connect to our module in mamele land")
+
+    def _close_connection(self):
+        self._close_frame_buffer()
+        self._remove_frame_buffer_directory()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.listener.stop_server()
@@ -0,0 +1,6 @@
+"""
+Measuring how fast we can talk to MAME without needing MAME.
+
+standin.py plays the part of MAME and its python binding, driving the passthrough with synthetic
+frames, and harness.py times Mamele against it. Run it with `python -m mamele.benchmark --help`
+"""
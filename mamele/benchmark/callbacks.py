@@ -0,0 +1,99 @@
+"""
+Times the passthrough's callbacks on their own, calling them the way the binding does as fast as we can.
+
+There's no game and no frames being made: the frame is the same every time, and the other side is a
+child process that answers every update straight away with the same input held for `repeat` frames,
+without asking for a frame. What's left is the cost of update, get_actions and should_we_reset, which
+MAME pays on every frame it emulates. Run it with `python -m mamele.benchmark.callbacks`
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+
+import numpy
+
+from .. import protocol
+from . import standin
+
+
+def answer(connection, buttons, repeat, flags):
+    """
+    Play the other side on `connection` until the passthrough quits: hold `buttons` for `repeat` frames after every update
+    """
+    stream = connection.makefile('rb')
+    # size, used and prot
+    for _ in range(3):
+        stream.readline()
+
+    command = protocol.CommandHeader.pack(protocol.InputCommand, flags, buttons, repeat, 0)
+    while True:
+        header = stream.read(protocol.UpdateHeader.size)
+        if len(header) < protocol.UpdateHeader.size:
+            return
+        message, _, _, _, _, length = protocol.UpdateHeader.unpack(header)
+        stream.read(length)
+        if message != protocol.UpdateMessage:
+            return
+        connection.sendall(command)
+
+
+def run(module, frames, repeat, width=400, height=300, with_frames=False, options=''):
+    """
+    Drive `module` (the passthrough) for `frames` frames with inputs held for `repeat` frames. Returns the seconds it took
+    """
+    passthrough_end, other_end = socket.socketpair()
+    flags = 0 if with_frames else protocol.NoFrame
+    child = os.fork()
+    if child == 0:
+        passthrough_end.close()
+        try:
+            answer(other_end, 1 << standin.StandInGame.Button1, repeat, flags)
+        finally:
+            os._exit(0)
+    other_end.close()
+
+    # the passthrough takes its end over, like it does in MAME
+    address = 'fd:%d' % passthrough_end.detach()
+    start, update, get_actions, should_we_reset, shutdown, _ = module.le_get_functions('%s protocol=%d %s' % (address, protocol.BinaryProtocol, options))
+    start('callbacks', width, height, [used == '1' for used in standin.StandInGame.ButtonsUsed])
+    frame = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    # the same loop as the stand-in's, without the game
+    frames_to_skip = 0
+    started = time.perf_counter()
+    for _ in range(frames):
+        if frames_to_skip > 0:
+            frames_to_skip -= 1
+        else:
+            frames_to_skip = update(0, False, frame)
+        get_actions()
+        should_we_reset()
+    elapsed = time.perf_counter() - started
+
+    shutdown()
+    os.waitpid(child, 0)
+    return elapsed
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Time the passthrough's per-frame callbacks without MAME")
+    parser.add_argument('--frames', type=int, default=200000, help="frames to drive the callbacks for, for every repeat")
+    parser.add_argument('--repeats', nargs='+', type=int, default=[1, 4, 16], help="frames every input is held for")
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=300)
+    parser.add_argument('--with-frames', action='store_true', help="have every update send the frame along")
+    parser.add_argument('--options', default='', help="more passthrough options, as name=value")
+    options = parser.parse_args(arguments)
+
+    module = standin.load_module(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'passthrough'))
+    for repeat in options.repeats:
+        elapsed = run(module, options.frames, repeat, options.width, options.height, options.with_frames, options.options)
+        print("repeat %3d: %10.0f frames/s  %6.2fus per frame" % (repeat, options.frames / elapsed, elapsed * 1e6 / options.frames))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
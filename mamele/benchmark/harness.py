@@ -0,0 +1,267 @@
+"""
+Times Mamele against the stand-in emulator and writes the results as JSON, so that runs on different
+versions of the code can be compared
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+
+import numpy
+
+from ..mamele import Mamele, spawn
+from ..observation import ObservationFormat
+from ..protocol import TextProtocol
+from ..scheduling import CpuScheduler, available_cpus, usable_cpus, cgroup_cpu_limit, place_process
+from . import standin
+
+
+class StandInMamele(Mamele):
+    """
+    Mamele that starts the stand-in instead of MAME. The stand-in's settings are the keyword arguments
+    of StandInGame, and everything else goes to Mamele
+    """
+
+    def __init__(self, game_name, width=400, height=300, changing_rows=16, game_length=100000, **arguments):
+        self.standin_arguments = ['--width', str(width), '--height', str(height), '--changing-rows', str(changing_rows),
+                                  '--game-length', str(game_length)]
+        Mamele.__init__(self, game_name, **arguments)
+
+    def _mame_command(self, game, socket_path):
+        return [sys.executable, os.path.abspath(standin.__file__)] + self.standin_arguments + [self._le_options(socket_path)]
+
+
+# Mamele arguments for each of the ways of talking to the passthrough we measure
+Modes = {
+    'text': dict(protocol_version=TextProtocol),
+    'binary': dict(),
+    'shared_memory': dict(shared_memory=True),
+    'tiles': dict(tile_size=16),
+    'preprocess': dict(preprocess=ObservationFormat(grayscale=True, resize=(84, 84))),
+    'no_frames': dict(receive_frames=False),
+}
+
+# get_screen arguments for each kind of observation we can ask for every step
+Screens = {
+    'rgb': dict(),
+    'gray84': dict(grayscale=True, resize=(84, 84)),
+    'none': None,
+}
+
+# where the stand-ins and we run: wherever the kernel likes, or each stand-in on a core of its own with us on another
+Placements = ('none', 'cores')
+
+Percentiles = (50, 90, 99)
+
+
+def resident_memory(pid='self'):
+    """
+    Resident memory of process `pid` in bytes, or None where /proc doesn't tell us
+    """
+    try:
+        with open('/proc/%s/statm' % pid) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IOError, ValueError, IndexError):
+        return None
+
+
+def latency_summary(seconds):
+    """
+    Mean and percentiles of `seconds`, in microseconds
+    """
+    microseconds = seconds * 1e6
+    summary = {'mean': float(microseconds.mean())}
+    for percentile, value in zip(Percentiles, numpy.percentile(microseconds, Percentiles)):
+        summary['p%d' % percentile] = float(value)
+    return summary
+
+
+def run(mode, number_of_instances, steps, screen='rgb', standin_arguments=None, statistics=False, placement='none', nice=None):
+    """
+    Step `number_of_instances` instances talking as `mode` says for `steps` steps each, and return what
+    we measured as a dictionary. With `statistics`, the instances keep their own (see Mamele.stats) and
+    those of the first one are included. `placement` is one of Placements, and the stand-ins run at
+    niceness `nice`
+    """
+    arguments = dict(Modes[mode], statistics=statistics, **(standin_arguments or {}))
+    scheduler = None
+    if placement == 'cores':
+        scheduler = CpuScheduler('cores', nice=nice)
+    elif nice is not None:
+        arguments['nice'] = nice
+    screen_arguments = Screens[screen]
+    if mode == 'preprocess' and screen_arguments:
+        # comes converted already
+        screen_arguments = {}
+    if mode == 'no_frames':
+        screen_arguments = None
+
+    our_cpus = available_cpus()
+    if scheduler is not None:
+        scheduler.pin_client()
+
+    started = time.perf_counter()
+    environments = spawn('standin', number_of_instances, environment_class=StandInMamele, scheduler=scheduler, **arguments)
+    try:
+        startup = time.perf_counter() - started
+        for environment in environments:
+            environment.restart_game()
+
+        # alternate between scoring and doing nothing, so there's always something going on
+        spaces = environments[0].get_minimal_action_set()
+        nothing = tuple(actions[0] for _, actions in spaces)
+        fire = tuple('button1' if name == 'button1' else actions[0] for name, actions in spaces)
+        actions = (fire, nothing)
+
+        timings = {stage: numpy.zeros(steps * number_of_instances) for stage in ('send', 'receive', 'screen')}
+        bytes_received = sum(environment.mamele_connection.bytes_received for environment in environments)
+        bytes_sent = sum(environment.mamele_connection.bytes_sent for environment in environments)
+        restarts = 0
+
+        clock = time.perf_counter
+        started = clock()
+        sample = 0
+        for step in range(steps):
+            action = actions[step & 1]
+            first_sample = sample
+            for environment in environments:
+                before = clock()
+                environment.send_action(action)
+                timings['send'][sample] = clock() - before
+                sample += 1
+
+            sample = first_sample
+            for environment in environments:
+                before = clock()
+                environment.receive_update()
+                middle = clock()
+                if screen_arguments is not None:
+                    environment.get_screen(**screen_arguments)
+                timings['receive'][sample] = middle - before
+                timings['screen'][sample] = clock() - middle
+                sample += 1
+
+                if environment.is_game_over():
+                    restarts += 1
+                    environment.restart_game()
+        elapsed = clock() - started
+
+        bytes_received = sum(environment.mamele_connection.bytes_received for environment in environments) - bytes_received
+        bytes_sent = sum(environment.mamele_connection.bytes_sent for environment in environments) - bytes_sent
+        standin_memory = [resident_memory(environment.mame.pid) for environment in environments]
+        client_memory = resident_memory()
+        breakdown = environments[0].stats() if statistics else None
+    finally:
+        for environment in environments:
+            try:
+                environment.quit()
+                environment.mame.wait()
+            except Exception as error:
+                logging.error("Problems telling a stand-in to quit: %s" % error)
+        if scheduler is not None:
+            place_process(os.getpid(), our_cpus)
+
+    total_steps = steps * number_of_instances
+    return {
+        'mode': mode,
+        'instances': number_of_instances,
+        'steps': steps,
+        'screen': screen,
+        'standin': standin_arguments or {},
+        'placement': placement,
+        'nice': nice,
+        'startup_seconds': startup,
+        'elapsed_seconds': elapsed,
+        'steps_per_second': total_steps / elapsed,
+        'bytes_received_per_second': bytes_received / elapsed,
+        'bytes_sent_per_second': bytes_sent / elapsed,
+        'bytes_per_step': bytes_received / total_steps,
+        'restarts': restarts,
+        'latency_microseconds': dict((stage, latency_summary(seconds)) for stage, seconds in timings.items()),
+        'client_memory_bytes': client_memory,
+        'standin_memory_bytes': None if None in standin_memory else sum(standin_memory),
+        'statistics': breakdown,
+    }
+
+
+def machine_description():
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'processors': os.cpu_count(),
+        'available_processors': len(available_cpus()),
+        'usable_processors': usable_cpus(),
+        'cgroup_cpu_limit': cgroup_cpu_limit(),
+    }
+
+
+def compare(results, baseline):
+    """
+    Lines comparing the steps per second of `results` against those of the same runs in `baseline`
+    """
+    def key(result):
+        return (result['mode'], result['instances'], result['screen'], json.dumps(result['standin'], sort_keys=True),
+                result.get('statistics') is not None, result.get('placement', 'none'), result.get('nice'))
+
+    before = dict((key(result), result) for result in baseline['results'])
+    lines = []
+    for result in results:
+        previous = before.get(key(result))
+        if previous is None:
+            continue
+        lines.append("%-14s %-5s %4d instances: %10.1f -> %10.1f steps/s (%+.1f%%)" % (result['mode'], result.get('placement', 'none'), result['instances'],
+            previous['steps_per_second'], result['steps_per_second'],
+            100.0 * (result['steps_per_second'] / previous['steps_per_second'] - 1)))
+    return lines
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Measure Mamele against a stand-in for MAME")
+    parser.add_argument('--modes', nargs='+', choices=sorted(Modes), default=['text', 'binary', 'shared_memory', 'tiles', 'preprocess', 'no_frames'])
+    parser.add_argument('--instances', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--steps', type=int, default=2000, help="steps per instance")
+    parser.add_argument('--screen', choices=sorted(Screens), default='rgb', help="observation to get every step")
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=300)
+    parser.add_argument('--changing-rows', type=int, default=16)
+    parser.add_argument('--game-length', type=int, default=100000)
+    parser.add_argument('--statistics', action='store_true', help="have the instances keep statistics (see Mamele.stats)")
+    parser.add_argument('--placements', nargs='+', choices=Placements, default=['none'],
+                        help="where the stand-ins run: anywhere, or on cores of their own (see mamele.scheduling)")
+    parser.add_argument('--nice', type=int, help="niceness of the stand-ins")
+    parser.add_argument('--output', help="where to write the results as JSON")
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    options = parser.parse_args(arguments)
+
+    standin_arguments = dict(width=options.width, height=options.height, changing_rows=options.changing_rows, game_length=options.game_length)
+
+    results = []
+    for mode in options.modes:
+        for placement in options.placements:
+            for number_of_instances in options.instances:
+                result = run(mode, number_of_instances, options.steps, options.screen, standin_arguments, options.statistics,
+                             placement, options.nice)
+                results.append(result)
+                latency = result['latency_microseconds']
+                print("%-14s %-5s %4d instances: %10.1f steps/s %12.0f bytes/s  receive p50 %8.1fus  screen p50 %8.1fus" % (mode, placement,
+                    number_of_instances, result['steps_per_second'], result['bytes_received_per_second'], latency['receive']['p50'],
+                    latency['screen']['p50']))
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': machine_description(),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            for line in compare(results, json.load(baseline)):
+                print(line)
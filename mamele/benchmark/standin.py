@@ -0,0 +1,136 @@
+"""
+Stand-in for MAME and its python binding.
+
+It loads the passthrough module the way the binding does and drives it the same way: start once,
+then update (unless we were asked to skip frames), get_actions and should_we_reset on every frame.
+The game is a made up one where button1 scores and games last a fixed number of frames, and the
+frames are synthetic, with a band of rows that changes every frame
+"""
+
+import os
+import sys
+import struct
+import argparse
+import importlib
+
+import numpy
+
+
+class StandInGame(object):
+    """
+    Just enough of a game to exercise the passthrough. Player 1 starts a game, button1 scores 10 points
+    and the game is over after `game_length` frames
+    """
+
+    ButtonsUsed = '111111000011'
+    Button1 = 4
+    Player1 = 11
+
+    # what le_set_state_functions gets to save and load
+    State = struct.Struct('<qqqq')
+
+    def __init__(self, width, height, changing_rows, game_length):
+        self.width = width
+        self.height = height
+        self.changing_rows = min(changing_rows, height)
+        self.game_length = game_length
+
+        self.frame_number = 0
+        self.score = 0
+        self.playing = False
+        self.game_frames = 0
+
+        # a fixed background, different enough from row to row that nothing compresses trivially
+        self.frame = numpy.empty((height, width, 4), dtype=numpy.uint8)
+        self.frame[:] = (numpy.arange(height * width, dtype=numpy.uint32).reshape(height, width, 1) * numpy.array([7, 13, 29, 0], dtype=numpy.uint32)).astype(numpy.uint8)
+
+    def buttons_used(self):
+        return [used == '1' for used in self.ButtonsUsed]
+
+    def advance(self):
+        """
+        Emulate one frame
+        """
+        self.frame_number += 1
+        if self.changing_rows:
+            # the band moves down the screen, and changes colour as it goes
+            row = (self.frame_number * self.changing_rows) % self.height
+            self.frame[row:row + self.changing_rows, :, :3] = self.frame_number & 0xff
+
+        if self.playing:
+            self.game_frames += 1
+            if self.game_frames >= self.game_length:
+                self.playing = False
+
+    def press(self, buttons):
+        if self.playing:
+            if buttons[self.Button1]:
+                self.score += 10
+        elif buttons[self.Player1]:
+            self.playing = True
+            self.score = 0
+            self.game_frames = 0
+
+    def reset(self):
+        self.playing = False
+        self.score = 0
+        self.game_frames = 0
+
+    def save_state(self):
+        return self.State.pack(self.frame_number, self.score, self.playing, self.game_frames)
+
+    def load_state(self, state):
+        self.frame_number, self.score, playing, self.game_frames = self.State.unpack(bytes(state))
+        self.playing = bool(playing)
+
+
+def load_module(module_path):
+    """
+    Import the module at `module_path` (without the .py) the way the binding does
+    """
+    directory, name = os.path.split(module_path)
+    sys.path.insert(0, directory)
+    return importlib.import_module(name)
+
+
+def run(game, le_options, game_name='standin'):
+    # the binding splits le_options into the module and the rest, which goes to the module untouched
+    module_path, _, arguments = le_options.partition(' ')
+    module = load_module(module_path)
+
+    start, update, get_actions, should_we_reset, shutdown, _ = module.le_get_functions(arguments)
+    if hasattr(module, 'le_set_state_functions'):
+        module.le_set_state_functions(game.save_state, game.load_state)
+
+    start(game_name, game.width, game.height, game.buttons_used())
+    frames_to_skip = 0
+    try:
+        # the passthrough exits when told to quit
+        while True:
+            game.advance()
+            if frames_to_skip > 0:
+                frames_to_skip -= 1
+            else:
+                frames_to_skip = update(game.score, not game.playing, game.frame)
+            game.press(get_actions())
+            if should_we_reset():
+                game.reset()
+    except KeyboardInterrupt:
+        shutdown()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Drive the passthrough like MAME would, with a made up game")
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=300)
+    parser.add_argument('--changing-rows', type=int, default=16, help="rows of the frame that change every frame")
+    parser.add_argument('--game-length', type=int, default=100000, help="frames until game over")
+    parser.add_argument('le_options', help="module path and its options, as MAME gets them with -le_options")
+    options = parser.parse_args(arguments)
+
+    game = StandInGame(options.width, options.height, options.changing_rows, options.game_length)
+    run(game, options.le_options)
+
+
+if __name__ == '__main__':
+    main()
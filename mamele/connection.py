@@ -1,19 +1,49 @@
 import os
+import mmap
 import logging
 import socket
 import tempfile
 
+
+class ConnectionLost(IOError):
+    """
+    The other end closed the connection, or something went wrong with it
+    """
+
+class ConnectionTimeout(ConnectionLost):
+    """
+    Nothing came through the connection for longer than its timeout (see Socket.set_timeout)
+    """
+
+
 class Socket(object):
     """
     Thin wrapper around a socket connection to make dealing with them more sane
     """
 
-    def __init__(self):
-        # leftover from previous
-        self._leftover_message = b''
+    DefaultReceiveWindow = 1 << 20
+
+    # addresses of sockets handed down by our parent process, followed by the file descriptor
+    InheritedPrefix = 'fd:'
+    # addresses of TCP sockets, followed by host:port
+    TcpPrefix = 'tcp:'
+
+    def __init__(self, receive_window=DefaultReceiveWindow):
+        # everything we have received but nobody has asked for yet lives in _buffer[_start:_end]
+        self._buffer = bytearray(receive_window)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
 
         # mostly from https://docs.python.org/2/howto/sockets.html
+        self.socket = None
         self.connection = None
+        self.timeout = None
+        self.socket_path = None
+
+        # everything that went through the connection either way
+        self.bytes_received = 0
+        self.bytes_sent = 0
 
         self._we_created = False
 
@@ -33,75 +63,217 @@ class Socket(object):
 
         return self.socket_path
 
-    def start_client(self, socket_path):
+    def start_pair(self):
+        """
+        Connect to a new socket that has nothing on the filesystem, for a child process to inherit.
+        Returns the child's end, to be closed once it's been handed over, and the address the child
+        should give start_client
+        """
+        self.connection, other_end = socket.socketpair()
+        return other_end, '%s%d' % (self.InheritedPrefix, other_end.fileno())
+
+    def start_client(self, address):
+        """
+        Connect to the socket at `address`, either a path or one we inherited (see start_pair)
+        """
+        if address.startswith(self.InheritedPrefix):
+            self.connection = socket.socket(fileno=int(address[len(self.InheritedPrefix):]))
+            return
+        if address.startswith(self.TcpPrefix):
+            host, _, port = address[len(self.TcpPrefix):].rpartition(':')
+            self.connection = socket.create_connection((host, int(port)), timeout=self.timeout)
+            self._no_delay(self.connection)
+            return
+
         self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.connection.connect(socket_path)
+        self.connection.connect(address)
 
+    def start_tcp_server(self, host='', port=0, backlog=16):
+        """
+        Listen for TCP connections on `host` and `port`, any free port if that's 0. Returns the address
+        start_client should be given. Take the connections with `accept`
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        self._we_created = True
+        host, port = self.socket.getsockname()[:2]
+        return '%s%s:%d' % (self.TcpPrefix, host, port)
+
+    def accept(self):
+        """
+        Server-side wait for a connection, for servers that take more than one. Returns it as a Socket of its own
+        """
+        try:
+            connection, _ = self.socket.accept()
+        except socket.timeout:
+            raise ConnectionTimeout("Nobody connected within %s seconds" % self.timeout)
+        accepted = Socket()
+        accepted.connection = connection
+        if connection.family != socket.AF_UNIX:
+            self._no_delay(connection)
+        accepted.set_timeout(self.timeout)
+        return accepted
+
+    @staticmethod
+    def _no_delay(connection):
+        # our messages are small and we wait for the answer to each, so don't let them sit around to be joined up
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+    def set_timeout(self, seconds):
+        """
+        Give up with ConnectionTimeout when waiting for a connection, or for anything to arrive through
+        it, takes longer than `seconds`. None waits forever
+        """
+        self.timeout = seconds
+        if self.socket is not None:
+            self.socket.settimeout(seconds)
+        if self.connection is not None:
+            self.connection.settimeout(seconds)
 
     def wait_for_connection(self):
         """
         Server-side wait for a connection
         """
-        self.connection, _ = self.socket.accept()
+        try:
+            self.connection, _ = self.socket.accept()
+        except socket.timeout:
+            raise ConnectionTimeout("Nobody connected within %s seconds" % self.timeout)
+        self.connection.settimeout(self.timeout)
 
     def receive_until_character(self, stopper):
         """
         Receive until we see the stopper character
         """
 
-        where = self._leftover_message.find(stopper)
-        if where >= 0:
-            message = self._leftover_message[:where+1]
-            self._leftover_message = self._leftover_message[where+1:]
-            return message
-
-        parts = [self._leftover_message]
+        searched = self._start
         while True:
-            try:
-                next_chunk = self.connection.recv(4096)
-                where = next_chunk.find(stopper)
-                if where >= 0:
-                    parts.append(next_chunk[:where+1])
-                    self._leftover_message = next_chunk[where+1:]
-                    break
-                else:
-                    parts.append(next_chunk)
-            except Exception as error:
-                logging.error("issue receiving: %s" % error)
+            where = self._buffer.find(stopper, searched, self._end)
+            if where >= 0:
+                message = bytes(self._view[self._start:where+1])
+                self._start = where + 1
+                return message
+            searched = self._end
+            searched -= self._make_room(self._end - self._start + 1)
+            self._receive_some()
 
+    def receive_bytes(self, count):
+        """
+        Receive exactly `count` bytes. Meant for short messages, see receive_into for bulk data
+        """
+        while self._end - self._start < count:
+            self._make_room(count)
+            self._receive_some()
 
-        return b''.join(parts)
+        message = bytes(self._view[self._start:self._start+count])
+        self._start += count
+        return message
 
-    def receive_bytes(self, count):
-        received = len(self._leftover_message)
-        if received >= count:
-            message = self._leftover_message[:count]
-            self._leftover_message = self._leftover_message[count:]
-            return message
+    def receive_struct(self, structure):
+        """
+        Receive and unpack the next `structure` (a struct.Struct)
+        """
+        while self._end - self._start < structure.size:
+            self._make_room(structure.size)
+            self._receive_some()
 
+        values = structure.unpack_from(self._buffer, self._start)
+        self._start += structure.size
+        return values
 
-        parts = [self._leftover_message]
-        left = count - received
-        while True:
-            try:
-                next_chunk = self.connection.recv(4096)
-                length = len(next_chunk)
-                if length >= left:
-                    self._leftover_message = next_chunk[left:]
-                    parts.append(next_chunk[:left])
-                    break
-                else:
-                    left -= length
-                    parts.append(next_chunk)
-            except Exception as error:
-                logging.error("issue receiving: %s" % error)
+    def receive_into(self, destination):
+        """
+        Fill the writable buffer `destination` with the next len(destination) bytes
+        without going through any intermediate copies
+        """
+        destination = memoryview(destination).cast('B')
+        count = len(destination)
+
+        # first whatever we already had lying around
+        buffered = min(count, self._end - self._start)
+        destination[:buffered] = self._view[self._start:self._start+buffered]
+        self._start += buffered
+
+        received = buffered
+        while received < count:
+            received += self._receive(destination[received:], count - received)
+        self.bytes_received += count - buffered
+
+    def has_buffered_data(self):
+        return self._end > self._start
+
+    def _make_room(self, count):
+        """
+        Make sure that `count` bytes fit from the start of the unread data onwards.
+        Returns how far back the unread data was moved
+        """
+        if self._start + count <= len(self._buffer):
+            return 0
 
+        unread = self._end - self._start
+        if count > len(self._buffer):
+            # doesn't fit even from the start. Grow it
+            self._view.release()
+            self._buffer.extend(bytearray(count - len(self._buffer)))
+            self._view = memoryview(self._buffer)
 
-        return b''.join(parts)
+        moved = self._start
+        self._view[:unread] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = unread
+        return moved
+
+    def _receive_some(self):
+        received = self._receive(self._view[self._end:])
+        self._end += received
+        self.bytes_received += received
+
+    def _receive(self, destination, count=0):
+        """
+        Receive what's there into `destination`, up to `count` bytes if that's given, but at least one.
+        A closed connection would otherwise give us nothing forever
+        """
+        try:
+            received = self.connection.recv_into(destination, count)
+        except socket.timeout:
+            raise ConnectionTimeout("Nothing arrived within %s seconds" % self.timeout)
+        except (OSError, IOError) as error:
+            raise ConnectionLost("Problems receiving: %s" % error)
+        if not received:
+            raise ConnectionLost("The other end closed the connection")
+        return received
 
 
     def send(self, message):
-        return self.connection.sendall(message)
+        self.bytes_sent += len(message)
+        try:
+            return self.connection.sendall(message)
+        except socket.timeout:
+            raise ConnectionTimeout("Couldn't send within %s seconds" % self.timeout)
+        except (OSError, IOError) as error:
+            raise ConnectionLost("Problems sending: %s" % error)
+
+    def send_parts(self, parts):
+        """
+        Send all the buffers in `parts` one after the other without joining them first
+        """
+        parts = [part.cast('B') for part in map(memoryview, parts) if part.nbytes]
+        while parts:
+            try:
+                sent = self.connection.sendmsg(parts)
+            except socket.timeout:
+                raise ConnectionTimeout("Couldn't send within %s seconds" % self.timeout)
+            except (OSError, IOError) as error:
+                raise ConnectionLost("Problems sending: %s" % error)
+            self.bytes_sent += sent
+            # sendmsg is happy to send only some of it
+            while parts and sent >= len(parts[0]):
+                sent -= len(parts[0])
+                parts.pop(0)
+            if parts:
+                parts[0] = parts[0][sent:]
 
 
     def destroy(self):
@@ -109,10 +281,72 @@ class Socket(object):
         self.connection.close()
 
         if self._we_created:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()            
+            self.stop_server()
+
+    def stop_server(self):
+        """
+        Stop listening and clean up after the socket we created
+        """
+        if self._we_created:
+            self._we_created = False
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except (OSError, IOError):
+                # a listening TCP socket isn't connected to anything to shut down
+                pass
+            self.socket.close()
+            if self.socket_path is None:
+                return
             try:
                 os.remove(self.socket_path)
                 os.rmdir(os.path.dirname(self.socket_path))
             except (OSError, IOError) as error:
                 logging.error("Had problems removing the socket or the surrounding temporary directory: %s" % error)
+
+
+class SharedFrameBuffer(object):
+    """
+    A file-backed memory map that both ends of the connection can see frames through,
+    so that the socket only has to carry a notice that a new frame is ready
+    """
+
+    def __init__(self, path, size, create=False):
+        self.path = path
+        self.size = size
+
+        if create:
+            descriptor = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            access = mmap.ACCESS_WRITE
+        else:
+            descriptor = os.open(path, os.O_RDONLY)
+            access = mmap.ACCESS_READ
+
+        try:
+            if create:
+                os.ftruncate(descriptor, size)
+            self.map = mmap.mmap(descriptor, size, access=access)
+        finally:
+            # the mapping keeps its own reference to the file
+            os.close(descriptor)
+
+        self.view = memoryview(self.map)
+
+    def write(self, frame):
+        self.view[:] = memoryview(frame).cast('B')
+
+    def unlink(self):
+        """
+        Remove the backing file. Both sides keep their mappings
+        """
+        try:
+            os.remove(self.path)
+        except (OSError, IOError) as error:
+            logging.error("Had problems removing the shared frame buffer: %s" % error)
+
+    def close(self):
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # somebody is still looking at the frame. The mapping will go away with them
+            pass
@@ -0,0 +1,179 @@
+"""
+Counters and latency histograms, cheap enough to keep on while running
+"""
+
+import os
+import time
+import json
+import functools
+from collections import defaultdict
+
+
+class Histogram(object):
+    """
+    Durations in nanoseconds, counted in buckets that are a quarter of a power of two wide. Percentiles
+    are only as precise as the buckets, so they are the upper bound of the bucket they fall in
+    """
+
+    Buckets = 160
+
+    def __init__(self):
+        self.counts = [0] * self.Buckets
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    @staticmethod
+    def bucket(nanoseconds):
+        bits = nanoseconds.bit_length()
+        if bits < 3:
+            return nanoseconds
+        # the power of two, and which quarter of it from the two bits after the top one
+        return 4 * (bits - 2) + ((nanoseconds >> (bits - 3)) & 3)
+
+    @staticmethod
+    def upper_bound(bucket):
+        if bucket < 4:
+            return bucket + 1
+        power, quarter = divmod(bucket, 4)
+        return (5 + quarter) << (power - 1)
+
+    def record(self, nanoseconds):
+        self.counts[min(self.bucket(nanoseconds), self.Buckets - 1)] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if nanoseconds > self.maximum:
+            self.maximum = nanoseconds
+
+    def percentile(self, fraction):
+        """
+        Upper bound in nanoseconds of the bucket where `fraction` of the durations are at or below
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(self.upper_bound(bucket), self.maximum)
+        return self.maximum
+
+    def summary(self):
+        """
+        Count, and the mean, percentiles and maximum in microseconds
+        """
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count / 1e3,
+            'p50': self.percentile(0.5) / 1e3,
+            'p90': self.percentile(0.9) / 1e3,
+            'p99': self.percentile(0.99) / 1e3,
+            'max': self.maximum / 1e3,
+        }
+
+
+class Statistics(object):
+    """
+    Named counters and histograms. Names are created as they are used
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def record(self, name, nanoseconds):
+        self.histograms[name].record(nanoseconds)
+
+    def add(self, name, amount=1):
+        self.counters[name] += amount
+
+    def summary(self):
+        return {
+            'seconds': time.time() - self.started,
+            'counters': dict(self.counters),
+            'latency_microseconds': dict((name, histogram.summary()) for name, histogram in self.histograms.items()),
+        }
+
+    def to_prometheus(self, prefix='mamele', labels=None, counters=None, gauges=None):
+        """
+        Everything in Prometheus' text exposition format. Counters become `<prefix>_<name>_total` and
+        histograms `<prefix>_<name>_seconds`. `counters` replaces ours if it's given (for ours and those
+        kept elsewhere together), and `gauges` are values as they are now, as `<prefix>_<name>`
+        """
+        label_text = ','.join('%s="%s"' % (name, value) for name, value in sorted((labels or {}).items()))
+
+        def with_labels(extra=''):
+            text = ','.join(part for part in (label_text, extra) if part)
+            return '{%s}' % text if text else ''
+
+        lines = []
+        for name, value in sorted((self.counters if counters is None else counters).items()):
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %d' % (metric, with_labels(), value))
+
+        for name, value in sorted((gauges or {}).items()):
+            metric = '%s_%s' % (prefix, name)
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s%s %d' % (metric, with_labels(), value))
+
+        for name, histogram in sorted(self.histograms.items()):
+            metric = '%s_%s_seconds' % (prefix, name)
+            lines.append('# TYPE %s histogram' % metric)
+            cumulative = 0
+            for bucket, count in enumerate(histogram.counts[:-1]):
+                cumulative += count
+                if count:
+                    lines.append('%s_bucket%s %d' % (metric, with_labels('le="%g"' % (Histogram.upper_bound(bucket) / 1e9)), cumulative))
+            lines.append('%s_bucket%s %d' % (metric, with_labels('le="+Inf"'), histogram.count))
+            lines.append('%s_sum%s %.9f' % (metric, with_labels(), histogram.total / 1e9))
+            lines.append('%s_count%s %d' % (metric, with_labels(), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path, text):
+    """
+    Replace the file at `path` with `text` so that readers never see half of it
+    """
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as output:
+        output.write(text)
+    os.replace(temporary, path)
+
+
+def dump(statistics, path, format='json', labels=None, summary=None):
+    """
+    Write `summary` (that of `statistics` if it's None) to `path`. What the summary has besides the seconds,
+    counters and latencies only goes to Prometheus if it's a number, as a gauge
+    """
+    if summary is None:
+        summary = statistics.summary()
+    if format == 'json':
+        text = json.dumps(dict(summary, labels=labels or {}), indent=2)
+    elif format == 'prometheus':
+        gauges = dict((name, value) for name, value in summary.items()
+                      if name not in ('seconds', 'counters', 'latency_microseconds') and isinstance(value, int))
+        text = statistics.to_prometheus(labels=labels, counters=summary['counters'], gauges=gauges)
+    else:
+        raise ValueError("Don't know how to dump statistics as '%s'" % format)
+    write_atomically(path, text)
+
+
+def timed(statistics, name, function):
+    """
+    `function` recording how long each call takes under `name`
+    """
+    clock = time.perf_counter_ns
+    record = statistics.histograms[name].record
+
+    @functools.wraps(function)
+    def timed_function(*arguments, **keywords):
+        started = clock()
+        try:
+            return function(*arguments, **keywords)
+        finally:
+            record(clock() - started)
+    return timed_function
+
@@ -1,12 +1,59 @@
 import os, sys, logging
+import time
+import shlex
+import selectors
+import tempfile
 import subprocess
-import itertools
+import numbers
 from collections import defaultdict
 
-import numpy
-from PIL import Image
+# numpy, and the observation and tile modules that need it, are imported where they are used so that
+# importing mamele and starting MAME don't have to wait for them
 
-from .connection import Socket
+from .connection import Socket, SharedFrameBuffer
+from .states import Snapshot, StateCache
+from .instrumentation import Statistics, timed, dump
+from .protocol import (TextProtocol, BinaryProtocol, HighestProtocol, UpdateHeader, CommandHeader,
+    UpdateMessage, QuitMessage, StateMessage, FrameInSharedMemory, FrameOmitted, FrameTiles, StateUnsupported, TimingsAttached, ReplayTrace, FrameHashAttached, TileCount, Timings, TraceCount, FrameHash,
+    InputCommand, SkipCommand, ResetCommand, QuitCommand, SaveStateCommand, LoadStateCommand, ReplayCommand, MaxPoolFrames, NoFrame)
+
+
+class LazyMapping(dict):
+    """
+    A dictionary that works out the values it doesn't have yet with `compute` when they are first asked for
+    """
+
+    def __init__(self, compute):
+        dict.__init__(self)
+        self.compute = compute
+
+    def __missing__(self, key):
+        value = self[key] = self.compute(key)
+        return value
+
+
+class PendingStep(object):
+    """
+    An action sent with Mamele.act_async that MAME may still be busy with. `wait` gives what `act`
+    would have returned for it
+    """
+
+    __slots__ = ('environment', 'done', 'reward', 'game_over', 'frame_number')
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.done = False
+        self.reward = 0
+        self.game_over = False
+        self.frame_number = 0
+
+    def wait(self):
+        """
+        Wait for the update following the action and return the change in score it brought
+        """
+        if not self.done:
+            self.environment.receive_message()
+        return self.reward
 
 
 class Mamele(object):
@@ -18,22 +65,162 @@ class Mamele(object):
     ButtonsRange = range(4,10)
     MiscellaneousRange = range(10,12)
 
+    KeyframeInterval = 300 # when only sending the parts of frames that changed, send a full one this often
+
     ResetFrames = 20 # The reset time is handled on the MAME side, so just skip a little bit here
     CoinToStartFrames = 60 
     StartToLiveFrames = 20 
     PressFrames = 4
 
+    StateCacheSize = 256 << 20 # bytes of snapshots to keep around by default
+    ReplayBatchSize = 4096 # steps sent to the passthrough at a time when replaying
+
+
+    def __init__(self, game_name, watch=False, shared_memory=False, protocol_version=HighestProtocol, receive_frames=True,
+                 preprocess=None, tile_size=None, state_cache_size=StateCacheSize, fast_restart=False, inherit_socket=True,
+                 connect=True, statistics=False, cpus=None, nice=None, frame_hashes=False):
+        """
+        If `shared_memory` is set, frames are handed over through a memory-mapped file next to the socket 
+        instead of being pushed through the socket itself. In that case the frame is only valid until the
+        next command is sent.
+
+        `protocol_version` is the highest version of the protocol to ask the passthrough for. The text 
+        protocol (TextProtocol) is always available as a fallback.
+
+        If `receive_frames` is False the passthrough only sends the score and game over status, and the last
+        frame we got is kept around. It can be changed at any time, and overridden for a single action in `act`.
+        The text protocol always sends frames.
+
+        `preprocess` is an ObservationFormat for the passthrough to convert frames to before sending them. The
+        screen dimensions are then those of the converted frames, and get_screen hands them over as they come.
+
+        With a `tile_size`, the passthrough splits frames into tiles of that many pixels a side and only sends
+        those that changed, with a full frame every KeyframeInterval frames. It needs the binary protocol and
+        doesn't apply to shared memory
+
+        Snapshots taken with `snapshot` are kept in memory, up to `state_cache_size` bytes of them, dropping the
+        least recently used ones first. With `fast_restart`, the state right after the first restart_game is
+        kept and later restarts go straight back to it. Every game then starts from exactly the same state.
+        Both need the binary protocol, and a MAME binding that can save states
 
-    def __init__(self, game_name, watch=False):
+        With `inherit_socket`, MAME inherits its end of the connection instead of connecting to a socket we
+        create on the filesystem.
+
+        If `connect` is False, MAME is started but we don't wait for it. Call `finish_connecting` before
+        anything else. See `spawn` for starting many instances at once
+
+        With `statistics`, we keep count of how long each step takes and where the time goes, on both
+        sides with the binary protocol. See `stats` and `dump_statistics`
+
+        MAME runs only on the CPUs in `cpus` if that's given, and at niceness `nice`. See CpuScheduler in
+        mamele.scheduling for working out which
+
+        With `frame_hashes`, the passthrough sends a CRC-32 of every frame, as `frame_hash`, whether the frame
+        itself comes or not, and doesn't send frames we already have. `is_duplicate_frame` says whether the
+        frame is the same as the one before. Needs the binary protocol
+        """
+
+        self._initialise_state(game_name, watch, shared_memory, protocol_version, receive_frames, preprocess, tile_size,
+                               state_cache_size, fast_restart, inherit_socket, statistics, cpus, nice, frame_hashes)
+
+        self.mamele_connection = Socket()
+        if self.inherit_socket:
+            other_end, address = self.mamele_connection.start_pair()
+            if self.shared_memory:
+                self.frame_buffer_directory = tempfile.mkdtemp(prefix="mameleframes")
+                self.frame_buffer_path = os.path.join(self.frame_buffer_directory, 'framebuffer')
+            try:
+                self.mame = self._start_mame(game_name, address, pass_fds=(other_end.fileno(),))
+            finally:
+                # MAME has its own copy of it now
+                other_end.close()
+        else:
+            socket_path = self.mamele_connection.start_server()
+            if self.shared_memory:
+                self.frame_buffer_path = os.path.join(os.path.dirname(socket_path), 'framebuffer')
+            self.mame = self._start_mame(game_name, socket_path)
+
+        if connect:
+            self.finish_connecting()
+
+
+    def finish_connecting(self):
+        """
+        Wait for MAME to connect and go through the handshake
+        """
+        if self.mamele_connection.connection is None:
+            # wait for mame to connect
+            self.mamele_connection.wait_for_connection()
+
+        # we expect the mame module to send the size and the minimal button set
+        self.receive_message()
+        self.receive_message()
+        if self.requested_protocol > TextProtocol:
+            # and to tell us which protocol we'll be talking from now on
+            self.receive_message()
+
+    def connecting_socket(self):
+        """
+        What to wait on for the next step of connecting: the socket we listen on until MAME connects,
+        and then the connection itself
+        """
+        if self.mamele_connection.connection is None:
+            return self.mamele_connection.socket
+        return self.mamele_connection.connection
+
+    def abandon(self):
+        """
+        Kill MAME and clean up without talking to it, for when things didn't work out
+        """
+        if self.mame is not None and self.mame.poll() is None:
+            self.mame.kill()
+            self.mame.wait()
+        self._close_frame_buffer()
+        if self.mamele_connection.connection is not None:
+            self.mamele_connection.connection.close()
+        self.mamele_connection.stop_server()
+        self._remove_frame_buffer_directory()
 
+
+    class CommunicationError(Exception):
+        """
+        Generic error that happened somewhere in our communications
+        """
+
+    def _initialise_state(self, game_name, watch=False, shared_memory=False, protocol_version=HighestProtocol, receive_frames=True,
+                          preprocess=None, tile_size=None, state_cache_size=StateCacheSize, fast_restart=False, inherit_socket=True,
+                          statistics=False, cpus=None, nice=None, frame_hashes=False):
         self.game_name = game_name
+        self.cpus = cpus
+        self.nice = nice
+        self.frame_hashes = frame_hashes
+        self.frame_hash = None
+        self.is_duplicate_frame = False
         self.watch = watch
+        self.shared_memory = shared_memory
+        self.receive_frames = receive_frames
+        self.preprocess = preprocess
+        self.tile_size = tile_size
+        self.tile_grid = None
+
+        # how much frame data came through, and how much we didn't need thanks to tiles
+        self.transfer_statistics = {'full_frames': 0, 'tiled_frames': 0, 'frame_bytes': 0, 'frame_bytes_saved': 0, 'duplicate_frames': 0}
+        self.requested_protocol = protocol_version
+        # until we agree on something else
+        self.protocol = TextProtocol
 
         # we'll initialise these once we know what we are dealing with
         self.score = None
         self.latest_image_as_bytes = None
+        self.image_buffer = None
+        self._own_image_buffer = True
+        self.frame_number = 0
+        # converted observations of the latest frame, by format
+        self._observations = {}
+        self._observation_formats = {}
         self.previous_score = self.score = 0
         self.images_size_in_bytes = 0
+        self.frame_shape = None
         self.action_spaces = None
         self.width = None
         self.height = None
@@ -41,27 +228,42 @@ class Mamele(object):
         self.resetting = False
         self.buttons_used = None
 
-        self.action_to_description = {}
+        # what to send for each action, worked out as actions are first used since there can be many of them
+        self.action_to_mask = LazyMapping(self._mask_of_action)
+        self.action_to_description = LazyMapping(lambda action: self.mask_to_description[self.action_to_mask[action]])
+        self.mask_to_description = LazyMapping(self._describe_mask)
+        self.action_space_sizes = None
+        self.number_of_actions = 0
+        self._choice_masks = None
+        self._action_tables = None
         self.nothing_pressed = b'0' * len(self.SwitchesOrder) # template for the switches to send, all unpressed
 
-        self.mamele_connection = Socket()
-        socket_path = self.mamele_connection.start_server()
-        self.mame = self._start_mame(game_name, socket_path)
-
+        self.inherit_socket = inherit_socket
+        self.mame = None
+        self.frame_buffer = None
+        self.frame_buffer_path = None
+        # only when it's not the socket's
+        self.frame_buffer_directory = None
         self.last_received = False
+        # the act_async whose update hasn't arrived yet, if any
+        self._pending_step = None
+        # told about every step once its update arrives (see add_step_hook), and the step they'll be told about next
+        self._step_hooks = []
+        self._hooked_step = None
+        # where the scores and game over statuses of the steps being replayed go, and how many we got
+        self._trace = None
+        self._trace_length = 0
+
+        # saved states. Whether the passthrough can save them at all we only know once we ask
+        self.states = StateCache(state_cache_size)
+        self.states_supported = None
+        self.fast_restart = fast_restart
+        self._start_snapshot = None
+
+        self.statistics = None
+        if statistics:
+            self._start_statistics()
 
-        # wait for mame to connect
-        self.mamele_connection.wait_for_connection()
-
-        # we expect the mame module to send the size and the minimal button set
-        self.receive_message()
-        self.receive_message()
-
-
-    class CommunicationError(Exception):
-        """
-        Generic error that happened somewhere in our communications
-        """
 
     def send_message(self, message):
         if not self.last_received:
@@ -75,6 +277,11 @@ class Mamele(object):
 
     def receive_message(self):
         try:
+            if self.protocol == BinaryProtocol:
+                self._receive_binary_message()
+                self._settle_step()
+                return
+
             # we have a fixed command size of the first four characters
             # should do for now
 
@@ -87,6 +294,9 @@ class Mamele(object):
                 # get the switches that are used
                 switches_used_description = self.mamele_connection.receive_until_character(b'\n')
                 self._initialise_action_space(switches_used_description.strip())
+            elif command == b'prot':
+                protocol_description = self.mamele_connection.receive_until_character(b'\n')
+                self._set_protocol(protocol_description.strip())
             elif command == b'quit':
                 logging.info("Got a quit from the environment")
                 self.expected_quit()
@@ -94,12 +304,27 @@ class Mamele(object):
                 # combo update of score and image
                 score_description = self.mamele_connection.receive_until_character(b'\n')
                 game_over_description = self.mamele_connection.receive_until_character(b'\n')
-                self.latest_image_as_bytes = self.mamele_connection.receive_bytes(self.images_size_in_bytes)
+                self.mamele_connection.receive_into(self.image_buffer)
+                self.latest_image_as_bytes = self.image_buffer
+                self._observations.clear()
                 if not self.resetting:
                     # ignore score and game over status while we are resetting
                     self._set_score(score_description.strip())
                     self._set_game_over(game_over_description.strip())
                 self.last_received = True
+                self._settle_step()
+            elif command == b'frme':
+                # the frame is already in the shared frame buffer, we only get told about it
+                frame_number_description = self.mamele_connection.receive_until_character(b'\n')
+                score_description = self.mamele_connection.receive_until_character(b'\n')
+                game_over_description = self.mamele_connection.receive_until_character(b'\n')
+                self.frame_number = int(frame_number_description)
+                self._take_shared_frame()
+                if not self.resetting:
+                    self._set_score(score_description.strip())
+                    self._set_game_over(game_over_description.strip())
+                self.last_received = True
+                self._settle_step()
 
 
         except self.CommunicationError as error:
@@ -107,6 +332,194 @@ class Mamele(object):
             self.unexpected_quit()
 
 
+    def _receive_binary_message(self):
+        message, game_over, flags, frame_number, score, length = self.mamele_connection.receive_struct(UpdateHeader)
+        if message == UpdateMessage:
+            if flags & TimingsAttached:
+                self._record_passthrough_timings(self.mamele_connection.receive_struct(Timings))
+                length -= Timings.size
+            if flags & FrameHashAttached:
+                self._take_frame_hash(*self.mamele_connection.receive_struct(FrameHash))
+                length -= FrameHash.size
+            if flags & ReplayTrace:
+                length -= self._receive_trace()
+
+            if flags & FrameOmitted:
+                # we keep what we had
+                pass
+            elif flags & FrameInSharedMemory:
+                self._take_shared_frame()
+            elif flags & FrameTiles:
+                count, = self.mamele_connection.receive_struct(TileCount)
+                indices, contents = self._tiles_buffers(count, length)
+                self.mamele_connection.receive_into(indices)
+                self.mamele_connection.receive_into(contents)
+                self._apply_tiles(indices, contents)
+            elif length == self.images_size_in_bytes:
+                self.mamele_connection.receive_into(self.image_buffer)
+                self._take_full_frame()
+            else:
+                raise self.CommunicationError("Expected a frame of %d bytes but got told about %d" % (self.images_size_in_bytes, length))
+
+            self.frame_number = frame_number
+            self._update_status(score, game_over)
+            self.last_received = True
+        elif message == QuitMessage:
+            logging.info("Got a quit from the environment")
+            self.expected_quit()
+        else:
+            raise self.CommunicationError("Unknown message type: %d" % message)
+
+
+    def _take_frame_hash(self, frame_hash):
+        self.is_duplicate_frame = frame_hash == self.frame_hash
+        self.frame_hash = frame_hash
+        if self.is_duplicate_frame:
+            self.transfer_statistics['duplicate_frames'] += 1
+
+    def _take_full_frame(self):
+        # a full frame just landed in the image buffer
+        self.latest_image_as_bytes = self.image_buffer
+        self._observations.clear()
+        self.transfer_statistics['full_frames'] += 1
+        self.transfer_statistics['frame_bytes'] += self.images_size_in_bytes
+        if self.tile_grid is not None:
+            self.tile_grid.load(self.image_buffer)
+
+    def _tiles_buffers(self, count, length):
+        """
+        Where to put the indices and contents of `count` changed tiles in a message of `length` bytes
+        """
+        if length != TileCount.size + count * (4 + self.tile_grid.tile_size_in_bytes):
+            raise self.CommunicationError("Got %d bytes for %d tiles" % (length, count))
+        return self._tile_indices[:count], self._tile_contents[:count * self.tile_grid.tile_size_in_bytes]
+
+    def _apply_tiles(self, indices, contents):
+        self.tile_grid.patch(indices, contents)
+        self.tile_grid.copy_to(self.image_buffer)
+        self.latest_image_as_bytes = self.image_buffer
+        self._observations.clear()
+
+        received = TileCount.size + indices.nbytes + contents.nbytes
+        self.transfer_statistics['tiled_frames'] += 1
+        self.transfer_statistics['frame_bytes'] += received
+        self.transfer_statistics['frame_bytes_saved'] += self.images_size_in_bytes - received
+
+    def _take_shared_frame(self):
+        # the frame is already in the shared frame buffer
+        if self._own_image_buffer:
+            self.latest_image_as_bytes = self.frame_buffer.view
+        else:
+            # somebody wants their own copy
+            memoryview(self.image_buffer).cast('B')[:] = self.frame_buffer.view
+            self.latest_image_as_bytes = self.image_buffer
+        self._observations.clear()
+
+
+    def stats(self):
+        """
+        What we've measured so far: counters, and latencies in microseconds of
+            send, receive: sending a command and receiving an update
+            round_trip: from sending a command to having its update
+            screen: get_screen
+            passthrough_emulate, passthrough_prepare, passthrough_send, passthrough_wait: what the passthrough
+                spent emulating, preparing frames, sending and waiting between updates (binary protocol only)
+        """
+        if self.statistics is None:
+            raise ValueError("Statistics are off. Create the environment with statistics=True")
+        summary = self.statistics.summary()
+        summary['counters'].update(self.transfer_statistics)
+        summary['counters'].update(self._connection_counters())
+        summary['frame_number'] = self.frame_number
+        return summary
+
+    def dump_statistics(self, path, interval=None, format='json'):
+        """
+        Write the statistics to `path` as 'json' (what `stats` returns) or 'prometheus' (text exposition
+        format), and then again every `interval` seconds, as updates come in, if there is one
+        """
+        if self.statistics is None:
+            raise ValueError("Statistics are off. Create the environment with statistics=True")
+        self._statistics_dump = (path, interval, format)
+        self._dump_statistics()
+
+    def _start_statistics(self):
+        # everything we time is wrapped here, so that nothing changes when statistics are off
+        self.statistics = Statistics()
+        self._statistics_dump = None
+        self._next_dump = None
+        self._sent_at = None
+        self._untimed_send_message, self.send_message = self.send_message, self._timed_send_message
+        self._untimed_receive_message, self.receive_message = self.receive_message, self._timed_receive_message
+        self.get_screen = timed(self.statistics, 'screen', self.get_screen)
+
+    def _timed_send_message(self, message):
+        if not self.last_received:
+            # this receive is timed on its own
+            self.receive_message()
+        started = time.perf_counter_ns()
+        self._untimed_send_message(message)
+        self._sent_at = time.perf_counter_ns()
+        self.statistics.record('send', self._sent_at - started)
+
+    def _timed_receive_message(self):
+        started = time.perf_counter_ns()
+        frame_number = self.frame_number
+        self._untimed_receive_message()
+        self._count_update(started, frame_number)
+
+    def _count_update(self, started, frame_number):
+        now = time.perf_counter_ns()
+        self.statistics.record('receive', now - started)
+        if self._sent_at is not None:
+            self.statistics.record('round_trip', now - self._sent_at)
+            self._sent_at = None
+        self.statistics.add('updates')
+        if self.frame_number > frame_number:
+            self.statistics.add('frames', self.frame_number - frame_number)
+
+        if self._next_dump is not None and time.monotonic() >= self._next_dump:
+            self._dump_statistics()
+
+    def _record_passthrough_timings(self, timings):
+        if self.statistics is not None:
+            for name, microseconds in zip(('passthrough_emulate', 'passthrough_prepare', 'passthrough_send', 'passthrough_wait'), timings):
+                self.statistics.record(name, microseconds * 1000)
+
+    def _dump_statistics(self):
+        path, interval, format = self._statistics_dump
+        labels = {'game': self.game_name}
+        if self.mame is not None:
+            labels['pid'] = self.mame.pid
+        try:
+            # all that stats has, not only what the statistics counted themselves
+            dump(self.statistics, path, format, labels, self.stats())
+        except (OSError, IOError) as error:
+            logging.error("Couldn't write the statistics to %s: %s" % (path, error))
+        self._next_dump = None if interval is None else time.monotonic() + interval
+
+    def _connection_counters(self):
+        return {'bytes_received': self.mamele_connection.bytes_received, 'bytes_sent': self.mamele_connection.bytes_sent}
+
+
+    def set_image_buffer(self, image_buffer=None):
+        """
+        Have the following frames land directly in `image_buffer`, which can be anything writable that supports
+        the buffer protocol and is exactly the size of a frame (eg a slot in a numpy replay array).
+        Setting it to None goes back to our own buffer, which gets reused for every frame
+        """
+        if image_buffer is None:
+            self.image_buffer = bytearray(self.images_size_in_bytes)
+            self._own_image_buffer = True
+            return
+
+        size = memoryview(image_buffer).nbytes
+        if size != self.images_size_in_bytes:
+            raise ValueError("The image buffer should be %d bytes long but it is %d" % (self.images_size_in_bytes, size))
+        self.image_buffer = image_buffer
+        self._own_image_buffer = False
+
+
     def get_screen_dimensions(self):
         return self.width, self.height
 
@@ -116,23 +529,79 @@ class Mamele(object):
     def is_game_over(self):
         return self.game_over
 
-    def get_screen_rgb(self):
-        # we get the data as BGRA. Convert it to RGB in numpy
-        image = Image.frombytes("RGBA",(self.width, self.height), self.latest_image_as_bytes,'raw', "RGBA", 0, 1)
-        arrayed = numpy.asarray(image)
-        return arrayed[:, :, [2, 1, 0]]
+    def get_screen_rgb(self, out=None):
+        """
+        The latest frame as a height x width x 3 RGB array, or as the passthrough preprocessed it
+        """
+        return self.get_screen(out=out)
+
+    def get_screen(self, grayscale=False, crop=None, downsample=1, layout='HWC', resize=None, out=None):
+        """
+        The latest frame converted to the format described (see ObservationFormat). 
+        
+        The conversion is done once per frame and format. Without `out` you get a new array for every 
+        frame, which is shared between calls for the same frame, so copy it if you are going to modify it.
+        With `out` the observation is written there instead.
+
+        If the passthrough is preprocessing frames, they are returned as they come and can't be converted further
+        """
+        key = (grayscale, crop if crop is None else tuple(crop), downsample, layout, resize if resize is None else tuple(resize))
+        observation = self._observations.get(key)
+        if observation is None:
+            import numpy
+            from .observation import ObservationFormat
+
+            frame = numpy.frombuffer(self.latest_image_as_bytes, dtype=numpy.uint8).reshape(self.frame_shape)
+            if self.preprocess is not None:
+                if key != (False, None, 1, 'HWC', None):
+                    raise ValueError("The passthrough already converts the frames, they can't be converted again")
+                if out is not None:
+                    numpy.copyto(out, frame)
+                    return out
+                observation = frame.copy()
+            else:
+                observation_format = self._observation_formats.get(key)
+                if observation_format is None:
+                    observation_format = self._observation_formats[key] = ObservationFormat(grayscale, crop, downsample, layout, resize)
+
+                # we get the data as BGRA
+                if out is not None:
+                    # don't hang on to the caller's array, they might change it
+                    return observation_format.convert(frame, out)
+                observation = observation_format.convert(frame)
+            self._observations[key] = observation
+        elif out is not None:
+            import numpy
+            numpy.copyto(out, observation)
+            return out
+
+        return observation
+
+    def get_observation_shape(self, grayscale=False, crop=None, downsample=1, layout='HWC', resize=None):
+        """
+        The shape of what get_screen returns for those arguments
+        """
+        from .observation import ObservationFormat
+
+        if self.preprocess is not None:
+            return self.frame_shape
+        return ObservationFormat(grayscale, crop, downsample, layout, resize).shape(self.width, self.height)
 
     def restart_game(self):
         # Restart the game
         # If we are in game over, just insert a coin and press start player 1
         # otherwise reset the machine, insert a coin, press player 1
 
+        if self._start_snapshot is not None:
+            self._restore_snapshot(self._start_snapshot)
+            return
+
         self.resetting = True
         if not self.last_received:
             # make sure it's waiting for us
             self.receive_message()
         if not self.game_over:
-            self.send_message(b'rest')
+            self.reset()
             self.skip(self.ResetFrames)
         self.insert_coin()
         self.skip(self.PressFrames)
@@ -146,41 +615,383 @@ class Mamele(object):
         self.score = self.previous_score = 0
         self.resetting = False
 
+        if self._wants_start_snapshot():
+            try:
+                self._start_snapshot = self._take_snapshot()
+            except NotImplementedError:
+                logging.info("MAME can't save states, restarting the long way")
 
-    def act(self, action):
+
+    def snapshot(self):
+        """
+        Save the state of the machine, along with the score and the latest frame, and return a handle
+        to `restore` it with later. The handle stops working once the snapshot gets dropped from the cache.
+
+        Raises NotImplementedError if MAME can't save states
+        """
+        return self.states.add(self._take_snapshot())
+
+    def restore(self, handle):
         """
-        The `action` parameter describes what we do in each action space
+        Go back to the state saved by `snapshot` as `handle`. Raises KeyError if it's not in the cache
+        """
+        self._restore_snapshot(self.states.get(handle))
+
+    def _take_snapshot(self):
+        self._check_states_supported()
+        if not self.last_received:
+            self.receive_message()
+        self.mamele_connection.send(self._save_state_message())
+        return self._snapshot_of(self._receive_state())
+
+    def _restore_snapshot(self, snapshot):
+        self._check_states_supported()
+        if not self.last_received:
+            self.receive_message()
+        self.mamele_connection.send_parts(self._load_state_message(snapshot.state))
+        self._receive_state()
+        self._apply_snapshot(snapshot)
+
+    def _receive_state(self):
+        message, _, flags, _, _, length = self.mamele_connection.receive_struct(UpdateHeader)
+        self._check_state_message(message, flags)
+        return self.mamele_connection.receive_bytes(length)
+
+    def _check_states_supported(self):
+        if self.protocol != BinaryProtocol:
+            raise ValueError("Saving and loading states needs the binary protocol")
+        if self.states_supported is False:
+            raise NotImplementedError("MAME can't save or load states")
+
+    def _check_state_message(self, message, flags):
+        if message != StateMessage:
+            raise self.CommunicationError("Expected an answer about a state, but got message type %d" % message)
+        if flags & StateUnsupported:
+            self.states_supported = False
+            raise NotImplementedError("MAME can't save or load states")
+        self.states_supported = True
+
+    def _wants_start_snapshot(self):
+        return self.fast_restart and self.protocol == BinaryProtocol and self.states_supported is not False
+
+    def _snapshot_of(self, state):
+        frame = None if self.latest_image_as_bytes is None else bytes(self.latest_image_as_bytes)
+        return Snapshot(bytes(state), frame, self.frame_number, self.score, self.game_over)
+
+    def _apply_snapshot(self, snapshot):
+        if snapshot.frame is not None:
+            memoryview(self.image_buffer).cast('B')[:] = snapshot.frame
+            self.latest_image_as_bytes = self.image_buffer
+            self._observations.clear()
+            if self.tile_grid is not None:
+                self.tile_grid.load(self.image_buffer)
+        self.frame_number = snapshot.frame_number
+        self.score = self.previous_score = snapshot.score
+        self.game_over = snapshot.game_over
+        # the passthrough sends the next frame whatever it hashes to
+        self.frame_hash = None
+        self.is_duplicate_frame = False
+
+
+    def act(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        The `action` parameter describes what we do in each action space, as anything encode_action takes.
+
+        The action is held for `repeat` frames, or until the game is over, and the change in score over all of
+        them is returned. With `max_pool`, the frame you see afterwards is the maximum of the last two.
+        `with_frame` says whether we want the frame after this action, defaulting to `receive_frames`
+        """
+        if repeat > 1 and self.protocol == TextProtocol:
+            # the text protocol can't ask the passthrough to hold the input, so do it from here
+            if max_pool:
+                raise ValueError("Pooling frames needs the binary protocol")
+            starting_score = self.score
+            for _ in range(repeat):
+                self.send_action(action, with_frame=with_frame)
+                self.receive_update()
+                if self.game_over:
+                    break
+            return self.score - starting_score
+
+        self.send_action(action, repeat, max_pool, with_frame)
+        return self.receive_update()
+
+    def send_action(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        First half of `act`: send the action without waiting for the result
+        """
+        self._send_input(action, repeat, max_pool, with_frame)
+        if self._step_hooks:
+            # the frame number the action starts on, now that anything still on its way to us before it went out has arrived
+            self._hooked_step = (self.encode_action(action), self.frame_number)
+
+    def receive_update(self):
+        """
+        Second half of `act`: wait for the frame following the last action and return the change in score
         """
-        self.send_message(b"inpt %s\n" % self.action_to_description[tuple(action)])
         self.receive_message()
         return self.score - self.previous_score
 
+    def act_async(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        Like `act`, but return as soon as the action is on its way, with a PendingStep to `wait` on for
+        the change in score. MAME emulates while we get on with something else, like working out the next
+        action. Calling act_async again first waits for the step before, so the screen, score and game over
+        status are always those after the step before the one in flight: the price of keeping both sides
+        busy is acting on what we saw one step late.
+
+        Frames in shared memory are copied out before the next action goes, since MAME will write the
+        next one over them while we are still looking
+        """
+        if repeat > 1 and self.protocol == TextProtocol:
+            raise ValueError("The text protocol can only send an input for one frame at a time")
+        self.send_action(action, repeat, max_pool, with_frame)
+        self._pending_step = PendingStep(self)
+        return self._pending_step
+
+    def add_step_hook(self, hook):
+        """
+        Have `hook(environment, buttons, start_frame_number, reward)` called for every action sent with act,
+        send_action or act_async, as soon as the update following it arrives: with the buttons pressed as a
+        bitmask (see action_to_mask), the frame number the action started on and the change in score. The
+        screen, score, game over status and frame number after the step are on the environment
+        """
+        self._step_hooks.append(hook)
+
+    def remove_step_hook(self, hook):
+        self._step_hooks.remove(hook)
+
+    def _settle_step(self):
+        # an update arrived. If it's for an act_async, that one's done, and the hooks hear about the step
+        if not self.last_received:
+            return
+        step = self._pending_step
+        if step is not None:
+            self._pending_step = None
+            step.reward = self.score - self.previous_score
+            step.game_over = self.game_over
+            step.frame_number = self.frame_number
+            step.done = True
+            if self.frame_buffer is not None and self.latest_image_as_bytes is self.frame_buffer.view:
+                # MAME will write the next frame here while we still want to look at this one
+                memoryview(self.image_buffer).cast('B')[:] = self.frame_buffer.view
+                self.latest_image_as_bytes = self.image_buffer
+
+        if self._hooked_step is not None:
+            buttons, start_frame_number = self._hooked_step
+            self._hooked_step = None
+            reward = self.score - self.previous_score
+            for hook in self._step_hooks:
+                hook(self, buttons, start_frame_number, reward)
+
+    def replay(self, buttons, frames_per_step, checkpoints=(), batch_size=ReplayBatchSize):
+        """
+        Play back a list of inputs as fast as MAME can go. `buttons` has one button mask per step (see
+        action_to_mask), and each is held for `frames_per_step` frames (one number for every step, or one
+        per step). The steps are sent to the passthrough `batch_size` at a time, and it only answers once
+        it's done with them, without sending any frames except for the steps in `checkpoints`.
+
+        Stops early at game over. Returns the score and game over status after each step that was played,
+        and a dictionary from checkpoint step to a copy of the frame after it. Needs the binary protocol
+        """
+        import numpy
+
+        if self.protocol != BinaryProtocol:
+            raise ValueError("Replaying needs the binary protocol")
+
+        steps = numpy.empty((len(buttons), 2), dtype='<u2')
+        steps[:, 0] = buttons
+        steps[:, 1] = frames_per_step
+        scores = numpy.zeros(len(steps), dtype=numpy.int64)
+        game_overs = numpy.zeros(len(steps), dtype=numpy.uint8)
+        frames = {}
+
+        # batches end at checkpoints, so that we can ask for the frame at the end of those
+        ends = sorted(set(checkpoint + 1 for checkpoint in checkpoints if 0 <= checkpoint < len(steps)) | {len(steps)})
+        start = 0
+        for end in ends:
+            while start < end:
+                stop = min(end, start + batch_size)
+                with_frame = stop == end and end - 1 in checkpoints
+                if not self.last_received:
+                    self.receive_message()
+                self._trace = (scores[start:stop], game_overs[start:stop])
+                try:
+                    self.mamele_connection.send_parts(self._replay_message(steps[start:stop], with_frame))
+                    self.last_received = False
+                    self.receive_message()
+                finally:
+                    self._trace = None
+
+                played = self._trace_length
+                if with_frame and played == stop - start:
+                    frames[stop - 1] = numpy.frombuffer(self.latest_image_as_bytes, dtype=numpy.uint8).reshape(self.frame_shape).copy()
+                if played < stop - start or self.game_over:
+                    return scores[:start + played], game_overs[:start + played].astype(bool), frames
+                start = stop
+
+        return scores, game_overs.astype(bool), frames
+
+    def _receive_trace(self):
+        """
+        Receive the scores and game over statuses of the steps replayed into where `replay` wants them.
+        Returns how many bytes they took
+        """
+        count, = self.mamele_connection.receive_struct(TraceCount)
+        if self._trace is None or count > len(self._trace[0]):
+            raise self.CommunicationError("Got a trace of %d steps we weren't expecting" % count)
+        scores, game_overs = self._trace
+        self.mamele_connection.receive_into(scores[:count])
+        self.mamele_connection.receive_into(game_overs[:count])
+        self._trace_length = count
+        return TraceCount.size + count * (scores.itemsize + game_overs.itemsize)
+
+    def encode_action(self, action):
+        """
+        The buttons bitmask for `action`, which can be
+            a tuple or list with a choice from each action space (see get_minimal_action_set)
+            an integer below number_of_actions, counting through the combinations of choices like
+                itertools.product does over the action spaces
+            an integer array with the index of the choice in each action space
+        """
+        try:
+            return self.action_to_mask[action]
+        except TypeError:
+            # not hashable: a list, or an array of choices
+            if getattr(action, 'dtype', None) is not None and action.dtype.kind in 'iu':
+                if action.ndim == 0:
+                    return self.action_to_mask[int(action)]
+                if len(action) != len(self._choice_masks):
+                    raise ValueError("Expected a choice for each of the %d action spaces, got %d" % (len(self._choice_masks), len(action)))
+                return sum(masks[choice] for masks, choice in zip(self._choice_masks, action.tolist()))
+            return self.action_to_mask[tuple(action)]
+
+    def encode_actions(self, actions):
+        """
+        encode_action for many actions at once, as a uint16 array. An integer array of one dimension
+        has an action number for each action, and one of two dimensions has a row of choices for each
+        """
+        import numpy
+
+        table, choice_tables = self._encoding_tables()
+        if isinstance(actions, numpy.ndarray) and actions.dtype.kind in 'iu':
+            if actions.ndim == 1:
+                return table[actions]
+            if actions.ndim == 2 and actions.shape[1] == len(choice_tables):
+                masks = numpy.zeros(len(actions), dtype=numpy.uint16)
+                for space, choice_table in enumerate(choice_tables):
+                    masks |= choice_table[actions[:, space]]
+                return masks
+            raise ValueError("Can't make actions out of an array of shape %s" % (actions.shape,))
+        return numpy.fromiter((self.encode_action(action) for action in actions), dtype=numpy.uint16, count=len(actions))
+
+    def _encoding_tables(self):
+        """
+        The mask of every action number, and the masks of the choices of each action space, as arrays
+        """
+        import numpy
+
+        if self._action_tables is None:
+            choice_tables = [numpy.array(masks, dtype=numpy.uint16) for masks in self._choice_masks]
+            # same order as itertools.product: the last action space changes fastest
+            table = numpy.zeros(1, dtype=numpy.uint16)
+            for choice_table in choice_tables:
+                table = (table[:, numpy.newaxis] | choice_table[numpy.newaxis, :]).reshape(-1)
+            self._action_tables = (table, choice_tables)
+        return self._action_tables
+
+    def fileno(self):
+        """
+        File descriptor of the connection to the passthrough, so we can be waited on with select and friends
+        """
+        return self.mamele_connection.connection.fileno()
+
+    def has_pending_data(self):
+        """
+        Whether there's something received but not processed yet, which select won't tell you about
+        """
+        return self.mamele_connection.has_buffered_data()
+
     def expected_quit(self):
         # mame-side expected quit
+        self._close_frame_buffer()
         self.mamele_connection.destroy()
 
     def unexpected_quit(self):
         # mame-side hang up unexpectedly
 
+        self._close_frame_buffer()
         self.mamele_connection.destroy()
         # now bail
         raise IOError("Could not connect to our module in mamele land")
 
 
     def quit(self):
-        self.send_message(b'quit')
+        self.send_message(self._quit_message())
+
+    def reset(self):
+        """
+        Reset the machine
+        """
+        self.send_message(self._reset_message())
 
     def insert_coin(self):
-        self.send_message(b"inpt %s\n" % self.action_to_description['coin'])
+        self._send_input('coin')
 
     def start_player1(self):
-        self.send_message(b"inpt %s\n" % self.action_to_description['player1'])
+        self._send_input('player1')
 
     def press_nothing(self):
-        self.send_message(b"inpt %s\n" % self.nothing_pressed)
+        self._send_input('nothing')
 
     def skip(self, frames):
-        self.send_message(b'skip %d\n' % frames)        
+        self.send_message(self._skip_message(frames))
+
+    def _send_input(self, key, repeat=1, max_pool=False, with_frame=None):
+        self.send_message(self._input_message(key, repeat, max_pool, with_frame))
+
+    # What goes down the wire for each command in the protocol we are talking
+
+    def _frame_flags(self, with_frame=None):
+        if with_frame is None:
+            with_frame = self.receive_frames
+        return 0 if with_frame else NoFrame
+
+    def _input_message(self, key, repeat=1, max_pool=False, with_frame=None):
+        if self.protocol == BinaryProtocol:
+            flags = self._frame_flags(with_frame)
+            if max_pool:
+                flags |= MaxPoolFrames
+            return CommandHeader.pack(InputCommand, flags, self.encode_action(key), repeat, 0)
+        if repeat > 1:
+            raise ValueError("The text protocol can only send an input for one frame at a time")
+        return b"inpt %s\n" % self.mask_to_description[self.encode_action(key)]
+
+    def _skip_message(self, frames):
+        if self.protocol == BinaryProtocol:
+            return CommandHeader.pack(SkipCommand, self._frame_flags(), 0, frames, 0)
+        return b'skip %d\n' % frames
+
+    def _reset_message(self):
+        if self.protocol == BinaryProtocol:
+            return CommandHeader.pack(ResetCommand, self._frame_flags(), 0, 0, 0)
+        return b'rest'
+
+    def _save_state_message(self):
+        return CommandHeader.pack(SaveStateCommand, 0, 0, 0, 0)
+
+    def _load_state_message(self, state):
+        # the header and the state, to be sent one after the other
+        return CommandHeader.pack(LoadStateCommand, 0, 0, 0, len(state)), state
+
+    def _replay_message(self, steps, with_frame):
+        # the header and the steps, to be sent one after the other
+        return CommandHeader.pack(ReplayCommand, self._frame_flags(with_frame), 0, len(steps), steps.nbytes), steps
+
+    def _quit_message(self):
+        if self.protocol == BinaryProtocol:
+            return CommandHeader.pack(QuitCommand, 0, 0, 0, 0)
+        return b'quit'
 
 
     def _initialise_screen(self, description):
@@ -197,7 +1008,47 @@ class Mamele(object):
         except ValueError as error:
             raise self.CommunicationError("Either width or height weren't integers")
 
-        self.images_size_in_bytes = self.height * self.width * 4 # comes as BGRA
+        from .observation import ObservationFormat
+
+        if self.preprocess is not None:
+            # comes already converted, with the size being that of the converted frames
+            self.frame_shape = ObservationFormat(self.preprocess.grayscale, layout=self.preprocess.layout).shape(self.width, self.height)
+        else:
+            self.frame_shape = (self.height, self.width, 4) # comes as BGRA
+        self.images_size_in_bytes = 1
+        for dimension in self.frame_shape:
+            self.images_size_in_bytes *= dimension
+        self.set_image_buffer(None)
+
+        if self.tile_size and not self.shared_memory:
+            import numpy
+            from .tiles import TileGrid
+
+            channels_first = self.preprocess is not None and self.preprocess.layout == 'CHW' and not self.preprocess.grayscale
+            self.tile_grid = TileGrid(self.frame_shape, self.tile_size, channels_first)
+            self._tile_indices = numpy.empty(self.tile_grid.number_of_tiles, dtype=numpy.uint32)
+            self._tile_contents = numpy.empty(self.tile_grid.number_of_tiles * self.tile_grid.tile_size_in_bytes, dtype=numpy.uint8)
+
+        if self.shared_memory:
+            # the passthrough has created and sized the frame buffer before telling us the size.
+            # Once we've mapped it too, nobody needs the file itself anymore
+            self.frame_buffer = SharedFrameBuffer(self.frame_buffer_path, self.images_size_in_bytes)
+            self.frame_buffer.unlink()
+            self._remove_frame_buffer_directory()
+
+    def _remove_frame_buffer_directory(self):
+        if self.frame_buffer_directory is not None:
+            try:
+                os.rmdir(self.frame_buffer_directory)
+            except (OSError, IOError) as error:
+                logging.error("Had problems removing the frame buffer's temporary directory: %s" % error)
+            self.frame_buffer_directory = None
+
+    def _close_frame_buffer(self):
+        if self.frame_buffer is not None:
+            self.latest_image_as_bytes = None
+            self.frame_buffer.close()
+            self.frame_buffer = None
 
 
     def _initialise_action_space(self, switches_used_description):
@@ -235,33 +1086,69 @@ class Mamele(object):
 
     def generate_switch_mapping(self):
         """
-        Pre-generate all switch configurations mapping to what we send back
+        Work out the masks of the choices in each action space. The masks of whole actions are put
+        together from those as they are asked for (see encode_action)
         """
-        SwitchIndex = {}
-        for index, switch in enumerate(self.SwitchesOrder):
-            SwitchIndex[switch] = index
-
-
-        number_of_switches = len(self.SwitchesOrder)
-
-        coin_button = SwitchIndex['coin']
-        player1_button = SwitchIndex['player1']
-        self.action_to_description['coin'] = b''.join(b'0' if index != coin_button else b'1' for index in range(number_of_switches))
-        self.action_to_description['player1'] = b''.join(b'0' if index != player1_button else b'1' for index in range(number_of_switches))
-
-
-        # iterate over all our action spaces and generate a description for each one
-        all_spaces = [action_space[1] for action_space in self.action_spaces]
-        for action in itertools.product(*all_spaces):
-            switches = set()
-
-            for component in action:
-                if component != 'noop':
-                    switches.add(SwitchIndex[component])
-
-            # create the description
-            self.action_to_description[action] = b''.join(b'1' if index in switches else b'0' for index in range(number_of_switches))
-
+        self.action_to_mask.clear()
+        self.action_to_description.clear()
+        self._action_tables = None
+
+        switch_index = dict((switch, index) for index, switch in enumerate(self.SwitchesOrder))
+        self.action_to_mask['coin'] = 1 << switch_index['coin']
+        self.action_to_mask['player1'] = 1 << switch_index['player1']
+        self.action_to_mask['nothing'] = 0
+
+        self._choice_masks = [[0 if choice == 'noop' else 1 << switch_index[choice] for choice in choices]
+                              for _, choices in self.action_spaces]
+        self.action_space_sizes = [len(masks) for masks in self._choice_masks]
+        self.number_of_actions = 1
+        for size in self.action_space_sizes:
+            self.number_of_actions *= size
+
+    def _mask_of_action(self, action):
+        if isinstance(action, numbers.Integral):
+            if not 0 <= action < self.number_of_actions:
+                raise KeyError("There are only %d actions, not %d" % (self.number_of_actions, action))
+            # the choice in each action space, from the last one back
+            mask = 0
+            for space in range(len(self._choice_masks) - 1, -1, -1):
+                action, choice = divmod(action, self.action_space_sizes[space])
+                mask |= self._choice_masks[space][choice]
+            return mask
+
+        if not isinstance(action, tuple) or len(action) != len(self.action_spaces):
+            raise KeyError("Not an action: %r" % (action,))
+        mask = 0
+        for (_, choices), masks, choice in zip(self.action_spaces, self._choice_masks, action):
+            try:
+                mask |= masks[choices.index(choice)]
+            except ValueError:
+                raise KeyError("%r isn't one of %s" % (choice, choices))
+        return mask
+
+    def _describe_mask(self, mask):
+        # what the text protocol sends for `mask`
+        return b''.join(b'1' if mask & (1 << index) else b'0' for index in range(len(self.SwitchesOrder)))
+
+
+    def _set_protocol(self, description):
+        try:
+            version = int(description)
+        except ValueError:
+            raise self.CommunicationError("Got a protocol version that isn't an integer: %s" % description)
+
+        if version not in (TextProtocol, BinaryProtocol) or version > self.requested_protocol:
+            raise self.CommunicationError("The passthrough wants to speak protocol version %d, which we didn't ask for" % version)
+        self.protocol = version
+        logging.info("Talking protocol version %d" % self.protocol)
+
+    def _update_status(self, score, game_over):
+        if not self.resetting:
+            # ignore score and game over status while we are resetting
+            self.previous_score = self.score
+            self.score = score
+            if game_over:
+                self.game_over = True
 
     def _set_score(self, description):
         self.previous_score = self.score
@@ -273,10 +1160,40 @@ class Mamele(object):
             self.game_over = True
 
 
-    def _start_mame(self, game, socket_path):
+    def _passthrough_options(self):
+        """
+        Options for the passthrough module as a list of (name, value) pairs
+        """
+        options = []
+        if self.shared_memory:
+            options.append(('framebuffer', self.frame_buffer_path))
+        if self.requested_protocol > TextProtocol:
+            options.append(('protocol', self.requested_protocol))
+        if self.preprocess is not None:
+            options.extend(self.preprocess.to_options())
+        if self.tile_size and not self.shared_memory:
+            options.append(('tiles', self.tile_size))
+            options.append(('keyframe', self.KeyframeInterval))
+        if self.statistics is not None:
+            options.append(('timings', 1))
+        if self.frame_hashes:
+            options.append(('hashes', 1))
+        return options
+
+
+    def _start_mame(self, game, socket_path, pass_fds=()):
+        mame = subprocess.Popen(self._mame_command(game, socket_path), stderr=subprocess.STDOUT, close_fds=True, pass_fds=pass_fds)
+        self._place_mame(mame.pid)
+        return mame
+
+    def _place_mame(self, pid):
+        if self.cpus is not None or self.nice is not None:
+            from .scheduling import place_process
+            place_process(pid, self.cpus, self.nice)
+
+    def _mame_command(self, game, socket_path):
 
         this_directory = os.path.realpath(os.path.dirname(__file__))
-        passthrough_module = os.path.join(this_directory, 'passthrough')
 
         # mame is one down, the python bindings are three down
         mame_binary = os.path.join(this_directory, 'mamele_real', 'mame64')
@@ -291,10 +1208,51 @@ class Mamele(object):
             command.extend('-nothrottle -noswitchres -video none -nole_show -sound none'.split())
         command.extend('-noautosave -frameskip 0 -skip_gameinfo -noautoframeskip -use_le -le_library'.split())
         command.extend([python_bindings, '-rompath', roms_directory, '-le_datapath', description_directory, '-le_options'])
+        command.append(self._le_options(socket_path))
 
+        return command
+
+    def _le_options(self, socket_path):
         # le_options is one parameter, the python bindings of mamele split it into the module name,
         # and the rest. That rest is passed to the module which can do with it as it pleases
-        command.append("%s %s" % (passthrough_module, socket_path))
-        process = subprocess.Popen(command, stderr=subprocess.STDOUT, close_fds=True)
-
-        return process
+        passthrough_module = os.path.join(os.path.realpath(os.path.dirname(__file__)), 'passthrough')
+        options = [socket_path] + ['%s=%s' % option for option in self._passthrough_options()]
+        return "%s %s" % (passthrough_module, ' '.join(shlex.quote(option) for option in options))
+
+
+def spawn(game_name, number_of_instances, environment_class=Mamele, scheduler=None, **arguments):
+    """
+    Start `number_of_instances` instances of `game_name` all at once, and finish connecting to each one
+    as soon as it's ready rather than one after the other. Keyword arguments go to `environment_class`.
+    With a `scheduler` (see mamele.scheduling.CpuScheduler), each instance gets the CPUs it assigns
+    """
+    environments = []
+    selector = selectors.DefaultSelector()
+    try:
+        for _ in range(number_of_instances):
+            if scheduler is not None:
+                arguments.update(scheduler.mame_arguments())
+            environment = environment_class(game_name, connect=False, **arguments)
+            environments.append(environment)
+            selector.register(environment.connecting_socket(), selectors.EVENT_READ, environment)
+
+        connecting = number_of_instances
+        while connecting:
+            for key, _ in selector.select():
+                environment = key.data
+                selector.unregister(key.fileobj)
+                if environment.mamele_connection.connection is None:
+                    # it only just connected, the handshake comes once the game is loaded
+                    environment.mamele_connection.wait_for_connection()
+                    selector.register(environment.connecting_socket(), selectors.EVENT_READ, environment)
+                else:
+                    environment.finish_connecting()
+                    connecting -= 1
+    except BaseException:
+        for environment in environments:
+            environment.abandon()
+        raise
+    finally:
+        selector.close()
+
+    return environments
@@ -0,0 +1,170 @@
+"""
+Conversion of the BGRA frames that come out of MAME into the formats agents train on
+"""
+
+import numpy
+
+
+class ObservationFormat(object):
+    """
+    Describes what an observation should look like.
+
+    `crop` is a (left, top, right, bottom) box in pixels of the original screen, `downsample` keeps
+    one pixel out of every `downsample` in each direction, `resize` is a (width, height) to scale to with 
+    nearest neighbour sampling instead, and `layout` is either 'HWC' or 'CHW'.
+    Grayscale observations have no channel dimension at all
+    """
+
+    Layouts = ('HWC', 'CHW')
+
+    # ITU-R 601 luma weights, scaled so they add up to 256
+    GrayWeights = (29, 150, 77) # blue, green, red
+
+    def __init__(self, grayscale=False, crop=None, downsample=1, layout='HWC', resize=None):
+        if layout not in self.Layouts:
+            raise ValueError("layout should be one of %s, not '%s'" % (', '.join(self.Layouts), layout))
+        if int(downsample) != downsample or downsample < 1:
+            raise ValueError("downsample should be a positive integer, not %s" % downsample)
+        if crop is not None:
+            crop = tuple(int(value) for value in crop)
+            if len(crop) != 4 or crop[0] >= crop[2] or crop[1] >= crop[3]:
+                raise ValueError("crop should be a (left, top, right, bottom) box, not %s" % (crop,))
+        if resize is not None:
+            resize = tuple(int(value) for value in resize)
+            if len(resize) != 2 or min(resize) < 1:
+                raise ValueError("resize should be a (width, height), not %s" % (resize,))
+            if downsample != 1:
+                raise ValueError("Either downsample or resize, not both")
+
+        self.grayscale = bool(grayscale)
+        self.crop = crop
+        self.downsample = int(downsample)
+        self.layout = layout
+        self.resize = resize
+
+        # intermediate buffers for the grayscale conversion so we don't allocate on every frame
+        self._scratch = None
+        # where each resized pixel comes from, and where they go
+        self._resize_indices = None
+        self._resized = None
+
+    def to_options(self):
+        """
+        This format as (name, value) passthrough options
+        """
+        options = []
+        if self.grayscale:
+            options.append(('grayscale', 1))
+        if self.crop is not None:
+            options.append(('crop', '%d,%d,%d,%d' % self.crop))
+        if self.downsample != 1:
+            options.append(('downsample', self.downsample))
+        if self.resize is not None:
+            options.append(('resize', '%dx%d' % self.resize))
+        # always there, so that the passthrough converts to RGB even when the format keeps the whole screen
+        options.append(('layout', self.layout))
+        return options
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        The format described by the passthrough options dictionary `options`, or None if there isn't one
+        """
+        names = ('grayscale', 'crop', 'downsample', 'resize', 'layout')
+        if not any(name in options for name in names):
+            return None
+
+        crop = options.get('crop')
+        resize = options.get('resize')
+        return cls(grayscale=options.get('grayscale') == '1',
+                   crop=crop.split(',') if crop else None,
+                   downsample=int(options.get('downsample', 1)),
+                   layout=options.get('layout', 'HWC'),
+                   resize=resize.split('x') if resize else None)
+
+    def dimensions(self, width, height):
+        """
+        The (width, height) of observations in this format for a screen of `width` x `height`
+        """
+        if self.crop is not None:
+            left, top, right, bottom = self.crop
+            width = min(right, width) - left
+            height = min(bottom, height) - top
+
+        if self.resize is not None:
+            return self.resize
+        return (width + self.downsample - 1) // self.downsample, (height + self.downsample - 1) // self.downsample
+
+    def shape(self, width, height):
+        """
+        Shape of the observations in this format for a screen of `width` x `height`
+        """
+        width, height = self.dimensions(width, height)
+        if self.grayscale:
+            return (height, width)
+        if self.layout == 'CHW':
+            return (3, height, width)
+        return (height, width, 3)
+
+    def select(self, frame):
+        """
+        View of the pixels of the height x width x 4 `frame` that we keep
+        """
+        if self.resize is not None:
+            return self._resample(frame)
+
+        if self.crop is not None:
+            left, top, right, bottom = self.crop
+            frame = frame[top:bottom, left:right]
+        if self.downsample > 1:
+            frame = frame[::self.downsample, ::self.downsample]
+        return frame
+
+    def _resample(self, frame):
+        height, width = frame.shape[:2]
+        if self._resize_indices is None or self._resize_indices[0] != (height, width):
+            left, top, right, bottom = self.crop if self.crop is not None else (0, 0, width, height)
+            right, bottom = min(right, width), min(bottom, height)
+            target_width, target_height = self.resize
+            # sample from the middle of where each target pixel would be
+            columns = left + ((numpy.arange(target_width) + 0.5) * (right - left) / target_width).astype(numpy.intp)
+            rows = top + ((numpy.arange(target_height) + 0.5) * (bottom - top) / target_height).astype(numpy.intp)
+            self._resize_indices = ((height, width), rows[:, None] * width + columns[None, :])
+            self._resized = numpy.empty((target_height, target_width, 4), dtype=numpy.uint8)
+
+        numpy.take(frame.reshape(-1, 4), self._resize_indices[1], axis=0, out=self._resized)
+        return self._resized
+
+    def convert(self, frame, out=None):
+        """
+        Convert the height x width x 4 BGRA `frame` into this format, into `out` if given
+        """
+        selected = self.select(frame)
+
+        if out is None:
+            out = numpy.empty(self.shape(frame.shape[1], frame.shape[0]), dtype=numpy.uint8)
+
+        if self.grayscale:
+            self._to_gray(selected, out)
+        else:
+            # copying a channel at a time is a lot faster than numpy's general path for reversed strides
+            channels_first = self.layout == 'CHW'
+            for index in range(3):
+                if channels_first:
+                    out[index] = selected[:, :, 2 - index]
+                else:
+                    out[:, :, index] = selected[:, :, 2 - index]
+        return out
+
+    def _to_gray(self, selected, out):
+        shape = selected.shape[:2]
+        if self._scratch is None or self._scratch[0].shape != shape:
+            self._scratch = (numpy.empty(shape, dtype=numpy.uint16), numpy.empty(shape, dtype=numpy.uint16))
+        total, channel = self._scratch
+
+        numpy.multiply(selected[:, :, 0], self.GrayWeights[0], out=total, dtype=numpy.uint16)
+        for index in (1, 2):
+            numpy.multiply(selected[:, :, index], self.GrayWeights[index], out=channel, dtype=numpy.uint16)
+            total += channel
+        numpy.right_shift(total, 8, out=out, casting='unsafe')
+
@@ -4,12 +4,26 @@ Passthrough controller that connects to the Gym environent
 
 import os
 import sys
+import time
+import shlex
 import socket
+import zlib
 import random
 import logging
 
+import numpy
+
 sys.path.insert(0, '.')
-from connection import Socket
+from connection import Socket, SharedFrameBuffer, ConnectionLost
+import protocol
+from observation import ObservationFormat
+from tiles import TileGrid
+
+# the controller for this MAME, so the state functions below can find it
+controller = None
+
+# for reading text inputs, where anything that isn't a 1 is a button that's not pressed
+InputCharacters = bytes(character if character == ord('1') else ord('0') for character in range(256))
 
 def le_get_functions(args):
     """
@@ -21,10 +35,21 @@ def le_get_functions(args):
     agent input, and the function to be called when MAME shuts down.  Any of them can be set to None if you don't
     want to be notified of that event type.
     """
-    state = PassthroughController(args)
+    global controller
+    state = controller = PassthroughController(args)
     return (state.start, state.update, state.get_actions, state.should_we_reset, state.shutdown, None)
 
 
+def le_set_state_functions(save, load):
+    """
+    For bindings that can save and restore the state of the machine. `save` should return the state as
+    something that supports the buffer interface, and `load` should take that back.
+    Without them, the other side gets told that states are unsupported
+    """
+    controller.save_state = save
+    controller.load_state = load
+
+
 
 class PassthroughController(object):
     class CommunicationError(Exception):
@@ -64,18 +89,67 @@ class PassthroughController(object):
         self.game_buttons = self.arrow_buttons + self.action_buttons
         self.misc_buttons = (self.coin_button, self.player1_button)
         self.button_order = self.arrow_buttons + self.action_buttons + self.misc_buttons
-        self.actions = [False for i in self.button_order]
+
+        # the buttons held down as a bitmask in button order, and those of them the game uses. get_actions
+        # hands back the same list until the buttons change, and there's a list for every combination we've
+        # seen, so nothing is built on a frame unless an input changed something
+        self.input_mask = 0
+        self.all_buttons_mask = self.used_mask = (1 << len(self.button_order)) - 1
+        self.action_lists = {}
+        self.actions = self._action_list(0)
 
         self.update_count = 0
+        # frames we've held the current input for without counting them, see update
+        self.frames_held = 0
         self.current_score = 0
         self.frames_to_skip = 0
 
+        # frames left to hold the current input for before answering, and whether to answer with
+        # the maximum of the last two frames
+        self.repeats_left = 0
+        self.max_pool = False
+        self.pooled_frame = None
+        self.pooled_frame_ready = False
+
+        # whether the other side wants a frame in the next update
+        self.frame_wanted = True
+
+        # with the hashes option, the hash of the frame of the update being sent, and of the last frame the other side got
+        self.frame_hash = None
+        self.delivered_hash = None
+
+        # steps being replayed (buttons, frames) without talking to the other side, which step we are on, how
+        # many frames of it are left, and the score and game over status after each step
+        self.replay = None
+        self.replay_index = 0
+        self.replay_frames_left = 0
+        self.replay_scores = None
+        self.replay_game_overs = None
+
         self.we_should_reset = False
 
+        # see le_set_state_functions
+        self.save_state = None
+        self.load_state = None
+
         # connect to the Gym driver
-        socket_path = args
+        address, self.options = self._parse_arguments(args)
+        # what the other side wants to see, if it's not the raw screen
+        self.observation_format = ObservationFormat.from_options(self.options)
+        self.observation = None
+        self.frame_buffer = None
+        # for only sending the parts of the frame that changed, with a full frame every so often
+        self.tile_grid = None
+        self.keyframe_interval = int(self.options.get('keyframe', 0))
+        self.frames_since_keyframe = 0
+        self.protocol = protocol.TextProtocol
         self.controller_connection = Socket()
-        self.controller_connection.start_client(socket_path)
+        self.controller_connection.start_client(address)
+
+        if self.options.get('timings') == '1' and int(self.options.get('protocol', protocol.TextProtocol)) >= protocol.BinaryProtocol:
+            self._start_timing()
+        if self.options.get('hashes') == '1' and int(self.options.get('protocol', protocol.TextProtocol)) >= protocol.BinaryProtocol:
+            self._start_hashing()
 
 
     def start(self, game_name, width, height, buttons_used):
@@ -83,11 +157,39 @@ class PassthroughController(object):
         self.width = width
         self.height = height
         self.buttons_used = buttons_used
+        self.used_mask = sum(1 << index for index, used in enumerate(buttons_used) if used)
+        self.action_lists.clear()
+        self.actions = self._action_list(self.input_mask)
+
+        observed_width, observed_height = self.width, self.height
+        frame_size = self.width * self.height * 4
+        if self.observation_format is not None:
+            # we'll be sending preprocessed observations instead of the screen
+            observed_width, observed_height = self.observation_format.dimensions(self.width, self.height)
+            self.observation = numpy.empty(self.observation_format.shape(self.width, self.height), dtype=numpy.uint8)
+            frame_size = self.observation.nbytes
+
+        if 'framebuffer' in self.options:
+            # the frame buffer has to exist before the other side hears about the size
+            self.frame_buffer = SharedFrameBuffer(self.options['framebuffer'], frame_size, create=True)
+        elif 'tiles' in self.options:
+            if self.observation is not None:
+                channels_first = self.observation_format.layout == 'CHW' and not self.observation_format.grayscale
+                self.tile_grid = TileGrid(self.observation.shape, int(self.options['tiles']), channels_first)
+            else:
+                self.tile_grid = TileGrid((self.height, self.width, 4), int(self.options['tiles']))
+            # start with a full frame
+            self.frames_since_keyframe = self.keyframe_interval
 
         # send dimensions
-        self.controller_connection.send(b"size %dx%d\n" % (self.width, self.height))
+        self.controller_connection.send(b"size %dx%d\n" % (observed_width, observed_height))
         self.controller_connection.send(b"used %s\n" % (b''.join(b'1' if used else b'0' for used in self.buttons_used)))
 
+        if 'protocol' in self.options:
+            # they've told us the highest they can speak. Settle on what both of us can
+            self.protocol = min(int(self.options['protocol']), protocol.HighestProtocol)
+            self.controller_connection.send(b"prot %d\n" % self.protocol)
+
         
     def update(self, score, game_over, video_frame):
         """
@@ -95,17 +197,53 @@ class PassthroughController(object):
         
         Return the number of frames you want skipped before being called again.  Due to conversions, it's much faster
         to return a positive number here than to keep an internal count on when to react
-        """        
-        self.update_count += 1
+        """
+        if self.repeats_left > 1 and not game_over and self.replay is None and not self.frames_to_skip:
+            # still holding the last input, and it's not the frame before the last either, which we may
+            # have to keep for pooling. This is most frames, so it doesn't allocate anything: the frames
+            # are counted when we next send an update, and the score is only looked at then
+            self.repeats_left -= 1
+            self.frames_held += 1
+            return 0
+
+        self.update_count += 1 + self.frames_held
+        self.frames_held = 0
         self.current_score = score
         self.game_over = game_over
 
+        if self.replay is not None:
+            return self._replay_update(score, game_over, video_frame)
+
         frames_to_skip = self.frames_to_skip - 1
-        if frames_to_skip < 0:
+        if frames_to_skip < 0 and self.repeats_left > 0 and not game_over:
+            # still holding the last input. Keep the last frame before the one we send if we'll pool them
             frames_to_skip = 0
-            self.controller_connection.send(b'updt %d\n%d\n' % (score, game_over) + video_frame.tobytes())
+            self.repeats_left -= 1
+            if self.repeats_left == 0 and self.max_pool and self.frame_wanted:
+                frame = self._observe(video_frame)
+                if self.pooled_frame is None:
+                    self.pooled_frame = numpy.empty_like(frame)
+                numpy.copyto(self.pooled_frame, frame)
+                self.pooled_frame_ready = True
+        elif frames_to_skip < 0:
+            frames_to_skip = 0
+            frame = self._observe(video_frame)
+            if self.pooled_frame_ready:
+                numpy.maximum(self.pooled_frame, frame, out=self.pooled_frame)
+                frame = self.pooled_frame
+            self.repeats_left = 0
+            self.max_pool = self.pooled_frame_ready = False
+            if self.protocol == protocol.BinaryProtocol:
+                self._send_binary_update(score, game_over, frame)
+            elif self.frame_buffer is not None:
+                self.frame_buffer.write(frame)
+                self.controller_connection.send(b'frme %d\n%d\n%d\n' % (self.update_count, score, game_over))
+            else:
+                self.controller_connection.send(b'updt %d\n%d\n' % (score, game_over) + frame.tobytes())
             self.receive_message()
         else:
+            # MAME won't call us for the frames it skips, so they are counted now
+            self.update_count += frames_to_skip
             self.frames_to_skip = 0
         return frames_to_skip #number of frames you want to skip
 
@@ -115,16 +253,9 @@ class PassthroughController(object):
         """
         This will also be called on each frame update to get the actions of the agent.
 
-        A list of the state of the 12 buttons should be returned
+        A list of the state of the 12 buttons should be returned. It's the same list until the buttons
+        change, so it mustn't be changed
         """
-
-        # update each button. Each one has a 3% chance of toggling
-        self.actions = []
-        for button, used in zip(self.button_order, self.buttons_used):
-            if used:
-                self.actions.append(button.state)
-            else:
-                self.actions.append(False)
         return self.actions
 
     
@@ -142,11 +273,21 @@ class PassthroughController(object):
 
         # tell Gym that we are shutting down
 
-        self.controller_connection.send(b"quit")
+        if self.protocol == protocol.BinaryProtocol:
+            self.controller_connection.send(protocol.UpdateHeader.pack(protocol.QuitMessage, 0, 0, self.update_count, 0, 0))
+        else:
+            self.controller_connection.send(b"quit")
         self.controller_connection.destroy()
     
     
     def receive_message(self):
+        if self.protocol == protocol.BinaryProtocol:
+            try:
+                self._receive_binary_message()
+            except ConnectionLost as error:
+                self._lost_connection(error)
+            return
+
         try:
             # we have a fixed command size of the first four characters
             # should do for now
@@ -169,6 +310,274 @@ class PassthroughController(object):
         except self.CommunicationError as error:
             logging.error("Something went wrong talking to mamele: %s" % error)
             self.shutdown()
+        except ConnectionLost as error:
+            self._lost_connection(error)
+
+    def _lost_connection(self, error):
+        # nobody is left to play, so there's no point in MAME going on
+        logging.error("Lost the connection to mamele, quitting: %s" % error)
+        sys.exit(1)
+
+
+    def _observe(self, video_frame):
+        """
+        What we send the other side for `video_frame`, as a numpy array
+        """
+        frame = numpy.frombuffer(video_frame, dtype=numpy.uint8)
+        if self.observation_format is None:
+            return frame
+        return self.observation_format.convert(frame.reshape(self.height, self.width, 4), self.observation)
+
+
+    def _replay_update(self, score, game_over, video_frame):
+        # the buttons are held for every frame of the step, and there's nothing for us to do until the last one
+        self.replay_frames_left -= 1
+        if self.replay_frames_left > 0:
+            return self._skip_replay_frames(self.replay_frames_left - 1)
+
+        index = self.replay_index
+        self.replay_scores[index] = score
+        self.replay_game_overs[index] = bool(game_over)
+        index = self.replay_index = index + 1
+        if index < len(self.replay) and not game_over:
+            self._set_input_mask(int(self.replay[index, 0]))
+            return self._skip_replay_frames(max(int(self.replay[index, 1]), 1) - 1)
+
+        # all done, or there's no point going on
+        self.replay = None
+        count = protocol.TraceCount.pack(index)
+        scores = self.replay_scores[:index]
+        game_overs = self.replay_game_overs[:index]
+        flags = protocol.ReplayTrace
+        parts = (count, scores, game_overs)
+        length = len(count) + scores.nbytes + game_overs.nbytes
+        if not self.frame_wanted:
+            flags |= protocol.FrameOmitted
+        elif self.frame_buffer is not None:
+            self.frame_buffer.write(self._observe(video_frame))
+            flags |= protocol.FrameInSharedMemory
+        else:
+            frame = memoryview(self._observe(video_frame)).cast('B')
+            parts += (frame,)
+            length += len(frame)
+        # the other side's idea of the last frame is out of date for tiles, and we don't know its hash
+        self.frames_since_keyframe = self.keyframe_interval
+        if self.frame_wanted:
+            self.delivered_hash = None
+        self._send_update(score, game_over, flags, length, parts)
+        self.receive_message()
+        return 0
+
+    def _skip_replay_frames(self, frames_to_skip):
+        # frame numbers go on counting the frames we don't see, so they come out as if we'd been called for all of them
+        self.update_count += frames_to_skip
+        self.replay_frames_left = 1
+        return frames_to_skip
+
+    def _start_replay(self, steps, length):
+        replay = numpy.empty((steps, 2), dtype='<u2')
+        if length != replay.nbytes:
+            raise self.CommunicationError("Got %d bytes for %d steps to replay" % (length, steps))
+        self.controller_connection.receive_into(replay)
+        if not steps:
+            logging.error("Ignoring a replay with nothing in it")
+            return
+
+        self.replay = replay
+        self.replay_index = 0
+        self.replay_scores = numpy.empty(steps, dtype=numpy.int64)
+        self.replay_game_overs = numpy.empty(steps, dtype=numpy.uint8)
+        self._set_input_mask(int(replay[0, 0]))
+        self.replay_frames_left = max(int(replay[0, 1]), 1)
+
+    def _send_binary_update(self, score, game_over, frame):
+        if not self.frame_wanted:
+            self._send_update(score, game_over, protocol.FrameOmitted, 0)
+        elif self.frame_buffer is not None:
+            self.frame_buffer.write(frame)
+            self._send_update(score, game_over, protocol.FrameInSharedMemory, 0)
+        elif self.tile_grid is None or not self._send_tiles(score, game_over, frame):
+            self._send_full_frame(score, game_over, frame)
+
+    def _send_full_frame(self, score, game_over, frame):
+        frame = memoryview(frame).cast('B')
+        self._send_update(score, game_over, 0, len(frame), (frame,))
+
+    def _send_update(self, score, game_over, flags, length, parts=()):
+        """
+        Send an update message with a payload of `length` bytes made up of `parts`
+        """
+        header = protocol.UpdateHeader.pack(protocol.UpdateMessage, bool(game_over), flags, self.update_count, score, length)
+        if parts:
+            self.controller_connection.send_parts((header,) + parts)
+        else:
+            self.controller_connection.send(header)
+
+    def _send_tiles(self, score, game_over, frame):
+        """
+        Send only the tiles that changed, unless it's time for a full frame or it's not worth it. 
+        Returns whether we sent anything
+        """
+        indices, contents = self.tile_grid.changes(frame)
+        self.frames_since_keyframe += 1
+        if self.frames_since_keyframe >= self.keyframe_interval > 0 or len(indices) * 2 > self.tile_grid.number_of_tiles:
+            self.frames_since_keyframe = 0
+            return False
+
+        count = protocol.TileCount.pack(len(indices))
+        length = len(count) + indices.nbytes + contents.nbytes
+        self._send_update(score, game_over, protocol.FrameTiles, length, (count, indices, contents))
+        return True
+
+
+    def _start_timing(self):
+        """
+        Keep track of where the time goes and send it along with every update (see protocol.Timings).
+        Everything that gets timed is wrapped here so that nothing changes when we are not timing
+        """
+        # nanoseconds emulating, preparing frames, sending and waiting since the last update we sent
+        self.time_spent = [0, 0, 0, 0]
+        self.left_update = time.perf_counter_ns()
+
+        self._untimed_update, self.update = self.update, self._timed_update
+        self._untimed_observe, self._observe = self._observe, self._timed_observe
+        self._untimed_receive_message, self.receive_message = self.receive_message, self._timed_receive_message
+        self._send_update = self._send_timed_update
+
+    def _start_hashing(self):
+        """
+        Send the hash of every frame (see protocol.FrameHash), and leave out frames the other side already
+        has. Wrapped like for the timings, so nothing changes without the hashes option
+        """
+        self._unhashed_send_binary_update, self._send_binary_update = self._send_binary_update, self._hashed_binary_update
+        self._unhashed_send_update, self._send_update = self._send_update, self._send_hashed_update
+
+    def _hashed_binary_update(self, score, game_over, frame):
+        frame_hash = self.frame_hash = zlib.crc32(frame)
+        try:
+            if self.frame_wanted and frame_hash == self.delivered_hash:
+                # they've got this one already
+                self._send_update(score, game_over, protocol.FrameOmitted, 0)
+            else:
+                self._unhashed_send_binary_update(score, game_over, frame)
+                if self.frame_wanted:
+                    self.delivered_hash = frame_hash
+        finally:
+            self.frame_hash = None
+
+    def _send_hashed_update(self, score, game_over, flags, length, parts=()):
+        if self.frame_hash is not None:
+            frame_hash = protocol.FrameHash.pack(self.frame_hash)
+            flags |= protocol.FrameHashAttached
+            length += len(frame_hash)
+            parts = (frame_hash,) + parts
+        self._unhashed_send_update(score, game_over, flags, length, parts)
+
+    def _timed_update(self, score, game_over, video_frame):
+        # whatever happened since we last returned is MAME's doing
+        self.time_spent[0] += time.perf_counter_ns() - self.left_update
+        try:
+            return self._untimed_update(score, game_over, video_frame)
+        finally:
+            self.left_update = time.perf_counter_ns()
+
+    def _timed_observe(self, video_frame):
+        started = time.perf_counter_ns()
+        frame = self._untimed_observe(video_frame)
+        self.time_spent[1] += time.perf_counter_ns() - started
+        return frame
+
+    def _timed_receive_message(self):
+        started = time.perf_counter_ns()
+        self._untimed_receive_message()
+        self.time_spent[3] += time.perf_counter_ns() - started
+
+    def _send_timed_update(self, score, game_over, flags, length, parts=()):
+        started = time.perf_counter_ns()
+        timings = protocol.Timings.pack(*[min(spent // 1000, 0xffffffff) for spent in self.time_spent])
+        self.time_spent[:] = (0, 0, 0, 0)
+        header = protocol.UpdateHeader.pack(protocol.UpdateMessage, bool(game_over), flags | protocol.TimingsAttached, self.update_count, score,
+                                            length + len(timings))
+        self.controller_connection.send_parts((header, timings) + parts)
+        self.time_spent[2] += time.perf_counter_ns() - started
+
+
+    def _receive_binary_message(self):
+        command, flags, buttons, argument, length = self.controller_connection.receive_struct(protocol.CommandHeader)
+        while command in (protocol.SaveStateCommand, protocol.LoadStateCommand):
+            # these don't let any frames go by, so keep going until we get something that does
+            if command == protocol.SaveStateCommand:
+                self._send_state()
+            else:
+                self._receive_state(length)
+            command, flags, buttons, argument, length = self.controller_connection.receive_struct(protocol.CommandHeader)
+
+        self.frame_wanted = not flags & protocol.NoFrame
+        if command == protocol.InputCommand:
+            self._set_input_mask(buttons)
+            # hold it for this many frames in total
+            self.repeats_left = max(argument - 1, 0)
+            self.max_pool = bool(flags & protocol.MaxPoolFrames) and self.repeats_left > 0
+        elif command == protocol.ResetCommand:
+            self.we_should_reset = True
+        elif command == protocol.SkipCommand:
+            self.frames_to_skip = argument
+        elif command == protocol.ReplayCommand:
+            self._start_replay(argument, length)
+        elif command == protocol.QuitCommand:
+            logging.info("We've been told to quit")
+            self.controller_connection.destroy()
+            sys.exit(0)
+        else:
+            logging.error("Ignoring unknown command from mamele: %d" % command)
+            self.controller_connection.receive_bytes(length)
+
+
+    def _send_state(self):
+        if self.save_state is None:
+            self._send_state_message(protocol.StateUnsupported)
+            return
+
+        state = memoryview(self.save_state()).cast('B')
+        header = protocol.UpdateHeader.pack(protocol.StateMessage, 0, 0, self.update_count, self.current_score, len(state))
+        self.controller_connection.send_parts((header, state))
+
+    def _receive_state(self, length):
+        state = bytearray(length)
+        self.controller_connection.receive_into(state)
+        if self.load_state is None:
+            self._send_state_message(protocol.StateUnsupported)
+            return
+
+        self.load_state(state)
+        # whatever we were in the middle of doesn't apply to this state, and the other side's idea of
+        # what the last frame looked like may be out of date
+        self.repeats_left = 0
+        self.max_pool = self.pooled_frame_ready = False
+        self.frames_since_keyframe = self.keyframe_interval
+        if self.tile_grid is not None:
+            self.tile_grid.frame[:] = 0
+        # it has the snapshot's frame now, whose hash we don't know
+        self.delivered_hash = None
+        self._send_state_message(0)
+
+    def _send_state_message(self, flags):
+        self.controller_connection.send(protocol.UpdateHeader.pack(protocol.StateMessage, 0, flags, self.update_count, self.current_score, 0))
+
+
+    def _parse_arguments(self, args):
+        """
+        The arguments are the address of the socket (see Socket.start_client) followed by name=value options
+        """
+        parts = shlex.split(args)
+        if not parts:
+            raise self.CommunicationError("We need at least the address of the socket to connect to")
+
+        options = {}
+        for part in parts[1:]:
+            name, _, value = part.partition('=')
+            options[name] = value
+        return parts[0], options
 
 
     def _set_input(self, description):
@@ -181,18 +590,47 @@ class PassthroughController(object):
         if not len(description) == 12:
             raise self.CommunicationError("input should pass through the state of the 12 buttons. We saw '%s' of length '%s'" % (description, len(description)))
 
-        for index, state in enumerate(description.decode('ascii')):
-            if state == u'1':
-                self.button_order[index].press()
-            else:
-                self.button_order[index].release()
+        # the first button is the lowest bit
+        self._set_input_mask(int(description.translate(InputCharacters)[::-1], 2))
+
+    def _set_input_mask(self, mask):
+        """
+        Set the state of our buttons from a bitmask in button order
+        """
+        # there's nothing to do with bits beyond our buttons
+        mask &= self.all_buttons_mask
+        changed = mask ^ self.input_mask
+        if not changed:
+            return
+
+        self.input_mask = mask
+        self.actions = self._action_list(mask)
+        # only the buttons that changed need telling
+        index = 0
+        while changed:
+            if changed & 1:
+                self.button_order[index].state = bool(mask & (1 << index))
+            changed >>= 1
+            index += 1
+
+    def _action_list(self, mask):
+        """
+        What get_actions returns while the buttons in `mask` are held down
+        """
+        mask &= self.used_mask
+        actions = self.action_lists.get(mask)
+        if actions is None:
+            actions = self.action_lists[mask] = [bool(mask & (1 << index)) for index in range(len(self.button_order))]
+        return actions
 
 
 
 class Button(object):
     """
-    Button class
+    Button class. The controller keeps what's held down as a bitmask, and keeps `state` up to date
     """
+    __slots__ = ('state', 'last_state', 'number_in_c')
+
     def __init__(self, number_in_c):
         self.state = False
         self.last_state = False
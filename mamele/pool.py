@@ -0,0 +1,181 @@
+"""
+MAME instances started ahead of time, so getting one doesn't mean waiting for MAME to boot
+"""
+
+import logging
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .mamele import Mamele
+
+
+class MamelePool(object):
+    """
+    Keeps `instances_per_game` instances of each game booted, handshaken and with a game started, ready
+    to be handed out by `acquire`. Every acquire has another one booted in the background to take the
+    place of the one handed out, so that the next acquire doesn't wait either. Instances given back with
+    `release` are restarted and go back to the pool if it's short of them, and quit otherwise.
+
+    There are never more than `maximum_per_game` instances of a game, counting those handed out, if
+    that's given. Acquiring one more than that raises ValueError.
+
+    If a game fails to boot, nothing more of it is booted in the background until a boot works again,
+    and `acquire` raises what went wrong instead of trying forever.
+
+    Any keyword arguments go to `environment_class`, and are the same for every instance
+    """
+
+    def __init__(self, instances_per_game=2, maximum_per_game=None, environment_class=Mamele, **mamele_arguments):
+        if instances_per_game < 1:
+            raise ValueError("We need to keep at least one instance per game, not %d" % instances_per_game)
+        if maximum_per_game is not None and maximum_per_game < instances_per_game:
+            raise ValueError("Can't keep %d instances ready with at most %d of them" % (instances_per_game, maximum_per_game))
+
+        self.instances_per_game = instances_per_game
+        self.maximum_per_game = maximum_per_game
+        self.environment_class = environment_class
+        self.mamele_arguments = mamele_arguments
+
+        # futures of the instances on their way to being ready, oldest first, by game
+        self._instances = defaultdict(deque)
+        # instances out with whoever acquired them, and boots that failed in a row, by game
+        self._out = defaultdict(int)
+        self._failures = defaultdict(int)
+        self._lock = threading.Lock()
+        self._workers = ThreadPoolExecutor(max_workers=instances_per_game)
+        self._closed = False
+
+    def warm(self, game_name):
+        """
+        Start booting instances of `game_name` if there aren't enough of them already
+        """
+        with self._lock:
+            self._failures[game_name] = 0
+            self._top_up(game_name)
+
+    def acquire(self, game_name):
+        """
+        An instance of `game_name` with a game just started. It's yours until you `release` it. If the
+        one from the pool didn't make it, a new one is booted, and if that fails too we give up and raise
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("The pool is closed")
+            instances = self._instances[game_name]
+            if not instances:
+                if not self._room_for(game_name):
+                    raise ValueError("All %d instances of %s are out already" % (self.maximum_per_game, game_name))
+                instances.append(self._start_boot(game_name))
+            # pick one that's ready if there is one, otherwise the one that's been going for longest
+            instance = next((instance for instance in instances if instance.done()), instances[0])
+            instances.remove(instance)
+            self._out[game_name] += 1
+            self._top_up(game_name)
+
+        try:
+            try:
+                return instance.result()
+            except Exception as error:
+                logging.error("An instance of %s didn't make it into the pool, booting another: %s" % (game_name, error))
+            return self._boot_counted(game_name)
+        except BaseException:
+            with self._lock:
+                self._out[game_name] -= 1
+            raise
+
+    def release(self, environment):
+        """
+        Give back an instance from `acquire`. It gets restarted and goes back to the pool, or quits if
+        the pool has enough of them already
+        """
+        with self._lock:
+            game_name = environment.game_name
+            self._out[game_name] -= 1
+            instances = self._instances[game_name]
+            if not self._closed and len(instances) < self.instances_per_game:
+                instances.append(self._workers.submit(self._recycle, environment))
+                return
+
+        self._quit(environment)
+
+    def forget(self, environment):
+        """
+        Tell the pool that an instance from `acquire` isn't coming back (it quit, or died), so that it
+        doesn't count towards `maximum_per_game` any more
+        """
+        with self._lock:
+            self._out[environment.game_name] -= 1
+            if not self._closed:
+                self._top_up(environment.game_name)
+
+    def close(self):
+        """
+        Quit all the instances in the pool. Those that are out stay with whoever acquired them
+        """
+        with self._lock:
+            self._closed = True
+            instances = [instance for game_instances in self._instances.values() for instance in game_instances]
+            self._instances.clear()
+
+        for instance in instances:
+            try:
+                environment = instance.result()
+            except Exception:
+                # already logged by whoever tried to get it ready
+                continue
+            self._quit(environment)
+        self._workers.shutdown()
+
+    def _top_up(self, game_name):
+        if self._failures[game_name]:
+            # no point booting more of what doesn't boot. The next acquire or warm tries again
+            return
+        instances = self._instances[game_name]
+        while len(instances) < self.instances_per_game and self._room_for(game_name):
+            instances.append(self._start_boot(game_name))
+
+    def _room_for(self, game_name):
+        # whether another instance of the game can be started
+        return self.maximum_per_game is None or len(self._instances[game_name]) + self._out[game_name] < self.maximum_per_game
+
+    def _start_boot(self, game_name):
+        return self._workers.submit(self._boot_counted, game_name)
+
+    def _boot_counted(self, game_name):
+        # _boot, keeping count of the failures
+        try:
+            environment = self._boot(game_name)
+        except Exception as error:
+            logging.error("Couldn't boot an instance of %s: %s" % (game_name, error))
+            with self._lock:
+                self._failures[game_name] += 1
+            raise
+        with self._lock:
+            self._failures[game_name] = 0
+        return environment
+
+    def _boot(self, game_name):
+        environment = self.environment_class(game_name, **self.mamele_arguments)
+        try:
+            environment.restart_game()
+        except Exception:
+            self._quit(environment)
+            raise
+        return environment
+
+    def _recycle(self, environment):
+        try:
+            environment.restart_game()
+        except Exception as error:
+            logging.error("Couldn't restart a released instance of %s, booting a new one: %s" % (environment.game_name, error))
+            self._quit(environment)
+            return self._boot_counted(environment.game_name)
+        return environment
+
+    @staticmethod
+    def _quit(environment):
+        try:
+            environment.quit()
+        except Exception as error:
+            logging.error("Problems telling an instance to quit: %s" % error)
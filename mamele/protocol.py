@@ -0,0 +1,65 @@
+"""
+Binary framing used between the passthrough and Mamele once both sides have agreed on it.
+
+The handshake (size, used and prot) is always text. The client asks for the highest protocol it
+speaks in the passthrough options, and the passthrough answers with 'prot <version>\\n', picking the
+highest one both sides know about. Without that answer everybody keeps talking text
+"""
+
+import struct
+
+TextProtocol = 1
+BinaryProtocol = 2
+HighestProtocol = BinaryProtocol
+
+# passthrough to Mamele: message type, game over, flags, frame number, score, payload length
+UpdateHeader = struct.Struct('<BBHIqI')
+
+# message types
+UpdateMessage = 1
+QuitMessage = 2
+StateMessage = 3 # answer to the state commands, with the saved state as payload for SaveStateCommand
+
+# update flags
+FrameInSharedMemory = 1 << 0
+FrameOmitted = 1 << 1 # no frame this time, keep the last one
+FrameTiles = 1 << 2 # only the tiles that changed since the last frame, see TileCount
+StateUnsupported = 1 << 3 # in a StateMessage, MAME can't save or load states
+TimingsAttached = 1 << 4 # the payload starts with Timings
+ReplayTrace = 1 << 5 # answer to a ReplayCommand, see TraceCount
+FrameHashAttached = 1 << 6 # the payload has a FrameHash after any Timings
+
+# where the passthrough spent its time since the last update, in microseconds: emulating, preparing
+# frames, sending updates and waiting for commands. Only sent if asked for with the timings option
+Timings = struct.Struct('<IIII')
+
+# CRC-32 of the frame of an update (as sent, so after any conversion or pooling), only sent if asked for with
+# the hashes option. Frames the other side already has are then left out (FrameOmitted) even if they were wanted
+FrameHash = struct.Struct('<I')
+
+# a FrameTiles payload is the number of tiles, their indices as uint32 and then their contents
+TileCount = struct.Struct('<I')
+
+# a ReplayTrace payload (after any Timings) is the number of steps replayed, the score after each of them
+# as int64, whether the game was over after each of them as uint8, and then the frame if there is one
+TraceCount = struct.Struct('<I')
+
+
+# Mamele to passthrough: message type, flags, buttons bitmask, argument, payload length
+CommandHeader = struct.Struct('<BBHII')
+
+# command types
+InputCommand = 1 # argument is the number of frames to hold the input for
+SkipCommand = 2 # argument is the number of frames to skip
+ResetCommand = 3
+QuitCommand = 4
+SaveStateCommand = 5 # answered straight away with a StateMessage, no frames go by
+LoadStateCommand = 6 # payload is a state we got from SaveStateCommand. Also answered with a StateMessage
+ReplayCommand = 7 # argument is the number of steps in the payload. Answered once they are all done
+
+# a ReplayCommand payload is, for each step, the buttons bitmask and the number of frames to hold them for,
+# both as uint16. Both ends handle them as numpy arrays of shape (steps, 2)
+
+# command flags
+MaxPoolFrames = 1 << 0 # answer a repeated input with the maximum of the last two frames
+NoFrame = 1 << 1 # only send the score and game over status in the update that answers this command
@@ -0,0 +1,353 @@
+"""
+Recording episodes to disk as they are played, and reading them back
+"""
+
+import os
+import json
+import queue
+import inspect
+import logging
+import threading
+
+import numpy
+
+from .protocol import BinaryProtocol
+
+
+# what gets recorded every step besides the frame, and how
+StepFields = (('actions', numpy.uint16), ('rewards', numpy.int64), ('game_overs', bool), ('frame_numbers', numpy.uint32))
+Fields = ('frames',) + tuple(name for name, _ in StepFields)
+
+
+class EpisodeRecorder(object):
+    """
+    Writes what happens in a Mamele to `directory`: the frame after every action (as the passthrough sends
+    it, see Mamele.frame_shape), the buttons pressed as a bitmask, the change in score, whether the game was
+    over and the frame number.
+
+    Steps are gathered into chunks of `chunk_size`, and whole chunks are written by a background thread,
+    with at most `queue_size` chunks waiting to be written before recording waits for the disk. Frames
+    are received straight into the chunk they belong to, so recording costs no extra copies in the step
+    loop. Chunks are .npy files that can be memory-mapped back (see Recording) unless `compress` is set,
+    in which case each chunk is a compressed .npz.
+
+    Each game is an episode, finishing at game over or when the game is restarted, restored or respawned
+    (see SupervisedMamele) under us. Steps are heard about through Mamele.add_step_hook, so those taken
+    with act, send_action and act_async are all recorded. Frame numbers tell where a game was cut short,
+    so it needs the binary protocol. Use it as `EpisodeRecorder(directory).attach(environment)` and
+    `close` it when done
+    """
+
+    def __init__(self, directory, chunk_size=1000, compress=False, queue_size=4):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.compress = compress
+
+        self.environment = None
+        self.episode = -1
+        self.episode_steps = 0
+        self.chunk_number = 0
+        self.chunk_lengths = []
+        self.chunk = None
+        self.steps_in_chunk = 0
+        self.start_frame_number = 0
+        # where the last step recorded left off, to tell when the game was restarted under us
+        self._last_frame_number = None
+        # the slot in the chunk the next frame should land in
+        self._frame = None
+
+        self._written = queue.Queue(maxsize=queue_size)
+        self._spare_chunks = queue.Queue()
+        self._frame_shape = None
+        self._error = None
+        self._writer = threading.Thread(target=self._write_chunks, name='episode recorder', daemon=True)
+
+    def attach(self, environment):
+        """
+        Record everything `environment` does from now on until we are closed
+        """
+        if self.environment is not None:
+            raise ValueError("Already recording an environment")
+        if inspect.iscoroutinefunction(environment.receive_update) or not hasattr(environment, 'add_step_hook'):
+            raise ValueError("Only environments that step synchronously can be recorded")
+        if environment.protocol != BinaryProtocol:
+            # frame numbers are how we tell how long steps were, and where episodes were cut short
+            raise ValueError("Recording needs the binary protocol, the text one doesn't tell us frame numbers")
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.environment = environment
+        self._frame_shape = environment.frame_shape
+        with open(os.path.join(self.directory, 'recording.json'), 'w') as description:
+            json.dump({
+                'game': environment.game_name,
+                'frame_shape': list(environment.frame_shape),
+                'action_spaces': environment.get_minimal_action_set(),
+                'buttons': environment.SwitchesOrder,
+                'chunk_size': self.chunk_size,
+                'compress': self.compress,
+            }, description, indent=2)
+
+        self._writer.start()
+        self._start_episode()
+        environment.add_step_hook(self._record_step)
+        self._next_frame()
+        return self
+
+    def close(self):
+        """
+        Write whatever is left, stop recording and wait for it all to be on disk
+        """
+        if self.environment is not None:
+            self._finish_episode()
+            self.environment.remove_step_hook(self._record_step)
+            self.environment.set_image_buffer(None)
+            self.environment = None
+
+            self._written.put(None)
+            self._writer.join()
+        self._check_writer()
+
+    def _record_step(self, environment, buttons, start_frame_number, reward):
+        # `environment` is the one that played the step, which is not ours if ours is a wrapper like SupervisedMamele
+        if self.episode_steps and start_frame_number != self._last_frame_number:
+            # the game was restarted, restored or respawned since the last step, so this is a new episode
+            self._finish_episode()
+            self._start_episode()
+            if self.chunk is None:
+                # the frame landed in the chunk that went with the last episode, and gets copied out of it below
+                self._next_frame()
+        if not self.episode_steps:
+            # where the episode starts, so that replaying it knows how long the first step was
+            self.start_frame_number = start_frame_number
+
+        step = self.steps_in_chunk
+        frame = self._frame
+        if environment.latest_image_as_bytes is not frame:
+            # the frame didn't come our way (omitted, in shared memory, or to an environment respawned since), so take a copy of what the environment shows
+            frame.reshape(-1)[:] = numpy.frombuffer(environment.latest_image_as_bytes, dtype=numpy.uint8)
+
+        self.chunk['actions'][step] = buttons
+        self.chunk['rewards'][step] = reward
+        self.chunk['game_overs'][step] = environment.game_over
+        self.chunk['frame_numbers'][step] = environment.frame_number
+        self._last_frame_number = environment.frame_number
+        self.steps_in_chunk += 1
+        self.episode_steps += 1
+
+        if environment.game_over:
+            self._finish_episode()
+            self._start_episode()
+        elif self.steps_in_chunk == self.chunk_size:
+            self._hand_over_chunk()
+        self._next_frame()
+
+    def _next_frame(self):
+        # have the next frame land where it will be recorded. Until then the last one stays where it was
+        if self.chunk is None:
+            self.chunk = self._new_chunk()
+            self.steps_in_chunk = 0
+        self._frame = self.chunk['frames'][self.steps_in_chunk]
+        self.environment.set_image_buffer(self._frame)
+
+    def _new_chunk(self):
+        self._check_writer()
+        try:
+            return self._spare_chunks.get_nowait()
+        except queue.Empty:
+            chunk = {'frames': numpy.empty((self.chunk_size,) + tuple(self._frame_shape), dtype=numpy.uint8)}
+            for name, dtype in StepFields:
+                chunk[name] = numpy.empty(self.chunk_size, dtype=dtype)
+            return chunk
+
+    def _hand_over_chunk(self):
+        if self.steps_in_chunk:
+            self._written.put((self._episode_directory(), self.chunk_number, self.chunk, self.steps_in_chunk))
+            self.chunk_lengths.append(self.steps_in_chunk)
+            self.chunk_number += 1
+            self.chunk = None
+
+    def _start_episode(self):
+        self.episode += 1
+        self.episode_steps = 0
+        self.chunk_number = 0
+        self.chunk_lengths = []
+
+    def _finish_episode(self):
+        if self.episode_steps:
+            self._hand_over_chunk()
+            self._written.put((self._episode_directory(), None, {'steps': self.episode_steps, 'chunk_lengths': self.chunk_lengths,
+                                                                 'start_frame_number': self.start_frame_number}, None))
+
+    def _episode_directory(self):
+        return os.path.join(self.directory, 'episode_%06d' % self.episode)
+
+    def _write_chunks(self):
+        while True:
+            work = self._written.get()
+            if work is None:
+                return
+            directory, number, chunk, steps = work
+            try:
+                os.makedirs(directory, exist_ok=True)
+                if number is None:
+                    # the episode is over, and this is its description
+                    with open(os.path.join(directory, 'episode.json'), 'w') as description:
+                        json.dump(chunk, description)
+                    continue
+
+                path = os.path.join(directory, 'chunk_%06d' % number)
+                if self.compress:
+                    numpy.savez_compressed(path, **dict((name, chunk[name][:steps]) for name in Fields))
+                else:
+                    for name in Fields:
+                        numpy.save('%s_%s.npy' % (path, name), chunk[name][:steps])
+                self._spare_chunks.put(chunk)
+            except Exception as error:
+                logging.error("Couldn't write a chunk of an episode: %s" % error)
+                self._error = error
+
+    def _check_writer(self):
+        if self._error is not None:
+            raise IOError("Recording failed: %s" % self._error)
+
+
+class ChunkedArray(object):
+    """
+    An array split over chunk files. Indexing with an integer gives a view into the chunk it's in, and
+    slices are put together from as many chunks as needed. Uncompressed chunks are memory-mapped, and
+    compressed ones are loaded one at a time as they are needed
+    """
+
+    def __init__(self, paths, lengths, name, compressed):
+        self.name = name
+        self.compressed = compressed
+        self._paths = paths
+        self._lengths = lengths
+        self._starts = numpy.cumsum([0] + lengths)
+        self._chunks = [None] * len(paths)
+        self._loaded = None
+
+        first = self.chunk(0) if paths else numpy.empty((0,))
+        self.shape = (int(self._starts[-1]),) + first.shape[1:]
+        self.dtype = first.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, index):
+        """
+        The whole of chunk `index` as an array
+        """
+        if not self.compressed:
+            if self._chunks[index] is None:
+                self._chunks[index] = numpy.load(self._paths[index], mmap_mode='r')
+            return self._chunks[index]
+
+        # only keep the last one we needed
+        if self._loaded is None or self._loaded[0] != index:
+            with numpy.load(self._paths[index]) as archive:
+                self._loaded = (index, archive[self.name])
+        return self._loaded[1]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, stride = key.indices(len(self))
+            if stride != 1:
+                return numpy.stack([self[index] for index in range(start, stop, stride)]) if stop > start else self[start:start]
+            pieces = []
+            while start < stop:
+                index = int(numpy.searchsorted(self._starts, start, side='right')) - 1
+                offset = start - self._starts[index]
+                taken = min(stop - start, self._lengths[index] - offset)
+                pieces.append(self.chunk(index)[offset:offset + taken])
+                start += taken
+            if not pieces:
+                return numpy.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return pieces[0] if len(pieces) == 1 else numpy.concatenate(pieces)
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Index %d out of range for %d entries" % (key, len(self)))
+        index = int(numpy.searchsorted(self._starts, key, side='right')) - 1
+        return self.chunk(index)[key - self._starts[index]]
+
+
+class Episode(object):
+    """
+    One recorded game. frames, actions, rewards, game_overs and frame_numbers are ChunkedArrays
+    """
+
+    def __init__(self, directory, compressed):
+        self.directory = directory
+        with open(os.path.join(directory, 'episode.json')) as description:
+            description = json.load(description)
+        lengths = description['chunk_lengths']
+        self.start_frame_number = description.get('start_frame_number')
+
+        for name in Fields:
+            if compressed:
+                paths = [os.path.join(directory, 'chunk_%06d.npz' % number) for number in range(len(lengths))]
+            else:
+                paths = [os.path.join(directory, 'chunk_%06d_%s.npy' % (number, name)) for number in range(len(lengths))]
+            setattr(self, name, ChunkedArray(paths, lengths, name, compressed))
+
+    def __len__(self):
+        return len(self.actions)
+
+    def frames_per_step(self):
+        """
+        How many frames each step was held for, going by the frame numbers
+        """
+        if self.start_frame_number is None:
+            raise ValueError("%s was recorded without its starting frame number" % self.directory)
+        frame_numbers = self.frame_numbers[:].astype(numpy.int64)
+        return numpy.diff(frame_numbers, prepend=self.start_frame_number)
+
+
+def verify_episode(environment, episode, checkpoints=(), batch_size=None):
+    """
+    Replay `episode` on `environment` (see Mamele.replay) and check that it plays out the same. The
+    environment has to be where the episode started, so restart the game on a freshly started one
+    first, or restore a snapshot taken there.
+
+    Returns the first step whose reward or game over status differs from the recording (None if they
+    all match), and the frames after the steps in `checkpoints`
+    """
+    arguments = {} if batch_size is None else {'batch_size': batch_size}
+    starting_score = environment.score
+    scores, game_overs, frames = environment.replay(episode.actions[:], episode.frames_per_step(), checkpoints, **arguments)
+
+    rewards = numpy.diff(scores, prepend=starting_score)
+    played = len(scores)
+    differences = numpy.flatnonzero((rewards != episode.rewards[:played]) | (game_overs != episode.game_overs[:played]))
+    if len(differences):
+        return int(differences[0]), frames
+    if played < len(episode):
+        # the game finished before the recording did
+        return played, frames
+    return None, frames
+
+
+class Recording(object):
+    """
+    Everything an EpisodeRecorder wrote to `directory`. `episodes` has the finished ones in order
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'recording.json')) as description:
+            self.description = json.load(description)
+        self.frame_shape = tuple(self.description['frame_shape'])
+
+        self.episodes = []
+        for name in sorted(os.listdir(directory)):
+            episode_directory = os.path.join(directory, name)
+            if name.startswith('episode_') and os.path.exists(os.path.join(episode_directory, 'episode.json')):
+                self.episodes.append(Episode(episode_directory, self.description['compress']))
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def __getitem__(self, index):
+        return self.episodes[index]
@@ -0,0 +1,358 @@
+"""
+Playing Mamele instances that run on another machine, served by mamele-server (see mamele.server).
+
+Every message either way is a RemoteHeader followed by `length` bytes of payload. A client opens a
+session asking for a number of instances of a game, and from then on sends the actions of all of them
+in one message and gets back what happened to all of them in another. The server answers every message
+but CloseMessage with exactly one message
+"""
+
+import json
+import zlib
+import struct
+import numbers
+
+import numpy
+
+from .connection import Socket
+
+# message type, flags, number of instances, argument, payload length
+RemoteHeader = struct.Struct('<BBHII')
+
+# client to server
+OpenMessage = 1 # payload is JSON: game_name, instances, arguments (for Mamele), screen (for get_screen) and compression
+StepMessage = 2 # argument is the frames to hold the actions for, payload is the action number of every instance as int64
+RestartMessage = 3 # payload is a uint8 for every instance, 1 for those whose games should be restarted
+CloseMessage = 4 # quit the instances, no answer
+
+# server to client
+DescriptionMessage = 5 # answer to OpenMessage, JSON: width, height, action_spaces and observation_shape
+ResultMessage = 6 # answer to StepMessage and RestartMessage, see below
+ErrorMessage = 7 # what went wrong with the last message, as UTF-8. The session goes on, unless an instance was lost
+
+# a result is, for every instance, the change in score as int64, the game over status as uint8 and the frame
+# number as uint32, then the observations one after the other. With FinalObservations, the final observations
+# of the instances whose games are over follow, in order. With Compressed, it's the size of every compressed
+# observation as uint32 first and then the compressed observations
+
+# flags
+MaxPoolFrames = 1 << 0 # step: as in Mamele.act
+NoFrames = 1 << 1 # step: don't send the observations back. Result: there aren't any
+RestartFinished = 1 << 2 # step: restart the games that ended, like MameleVec
+Compressed = 1 << 3 # result: every observation was compressed on its own with zlib
+FinalObservations = 1 << 4 # result: games were restarted, and their last observations come too (see MameleVec.step)
+
+DefaultPort = 7870
+
+# the observation arguments that leave the screen as it is
+ScreenDefaults = dict(grayscale=False, crop=None, downsample=1, layout='HWC', resize=None)
+
+
+class RemoteError(Exception):
+    """
+    The server couldn't do what we asked, or said something we didn't expect
+    """
+
+
+def tcp_address(address):
+    """
+    `address` as Socket.start_client wants it, from host:port, or the default port on localhost if it's None
+    """
+    if address is None:
+        address = 'localhost:%d' % DefaultPort
+    if not address.startswith(Socket.TcpPrefix):
+        address = Socket.TcpPrefix + address
+    return address
+
+
+class RemoteMameleVec(object):
+    """
+    `number_of_instances` instances of `game_name` running on the mamele-server at `address` (host:port),
+    stepped together like MameleVec. The actions of every step go out in one message and the results come
+    back in another, however many instances there are.
+
+    The observations are converted before they are sent, as the observation arguments say (see
+    Mamele.get_screen). With `compression`, a zlib level, every observation is compressed on its own,
+    which pays off on slow networks and for screens that don't change much. Nothing we get waits longer
+    than `timeout` seconds, if that's given.
+
+    Any other keyword arguments go to Mamele on the server, so they have to be things JSON can carry
+    """
+
+    def __init__(self, game_name, number_of_instances, address=None, grayscale=False, crop=None, downsample=1, layout='HWC',
+                 resize=None, compression=None, timeout=None, **mamele_arguments):
+        if number_of_instances < 1:
+            raise ValueError("We need at least one instance, not %d" % number_of_instances)
+
+        self.game_name = game_name
+        self.number_of_instances = number_of_instances
+        self.address = tcp_address(address)
+        self.compression = compression
+
+        self.connection = Socket()
+        self.connection.set_timeout(timeout)
+        self.connection.start_client(self.address)
+
+        request = {
+            'game_name': game_name,
+            'instances': number_of_instances,
+            'arguments': mamele_arguments,
+            'screen': dict(grayscale=grayscale, crop=crop, downsample=downsample, layout=layout, resize=resize),
+            'compression': compression,
+        }
+        self._send(OpenMessage, 0, 0, json.dumps(request).encode('utf-8'))
+        try:
+            description = json.loads(self._receive(DescriptionMessage)[1].decode('utf-8'))
+        except BaseException:
+            self.connection.destroy()
+            raise
+
+        self.width = description['width']
+        self.height = description['height']
+        self.action_spaces = [(name, list(choices)) for name, choices in description['action_spaces']]
+        self.action_space_sizes = [len(choices) for _, choices in self.action_spaces]
+        self.number_of_actions = int(numpy.prod(self.action_space_sizes))
+        # what each choice is worth in an action number: the last action space changes fastest, as in Mamele
+        self._strides = numpy.ones(len(self.action_space_sizes), dtype=numpy.int64)
+        for space in range(len(self.action_space_sizes) - 2, -1, -1):
+            self._strides[space] = self._strides[space + 1] * self.action_space_sizes[space + 1]
+
+        self.observations = numpy.zeros((number_of_instances,) + tuple(description['observation_shape']), dtype=numpy.uint8)
+        self.final_observations = numpy.zeros_like(self.observations)
+        self.rewards = numpy.zeros(number_of_instances, dtype=numpy.int64)
+        self.game_overs = numpy.zeros(number_of_instances, dtype=bool)
+        self.frame_numbers = numpy.zeros(number_of_instances, dtype=numpy.uint32)
+        self._sizes = numpy.zeros(number_of_instances, dtype=numpy.uint32)
+        self._actions = numpy.zeros(number_of_instances, dtype=numpy.int64)
+
+    def __len__(self):
+        return self.number_of_instances
+
+    def get_screen_dimensions(self):
+        return self.width, self.height
+
+    def get_minimal_action_set(self):
+        return self.action_spaces
+
+    def reset(self):
+        """
+        Restart all the games and return their first observations
+        """
+        return self.restart(range(self.number_of_instances))
+
+    def restart(self, indices):
+        """
+        Restart the games of the instances at `indices` and return the observations
+        """
+        which = numpy.zeros(self.number_of_instances, dtype=numpy.uint8)
+        which[list(indices)] = 1
+        self._send(RestartMessage, 0, 0, which)
+        self.receive_results()
+        return self.observations
+
+    def step(self, actions, repeat=1, max_pool=False, with_frame=None, restart_finished=True):
+        """
+        Same as MameleVec.step. The actions are action numbers, or rows of choices, either the index of
+        the choice in each action space or the choices themselves (see Mamele.encode_action).
+        Without frames (`with_frame` False) the observations are left as they were
+        """
+        self.send_actions(actions, repeat, max_pool, with_frame, restart_finished)
+        return self.receive_results()
+
+    def send_actions(self, actions, repeat=1, max_pool=False, with_frame=None, restart_finished=True):
+        """
+        First half of `step`: send the actions without waiting for the results
+        """
+        if len(actions) != self.number_of_instances:
+            raise ValueError("Expected %d actions, got %d" % (self.number_of_instances, len(actions)))
+        self._actions[:] = self.action_numbers(actions)
+
+        flags = 0
+        if max_pool:
+            flags |= MaxPoolFrames
+        if with_frame is False:
+            flags |= NoFrames
+        if restart_finished:
+            flags |= RestartFinished
+        self._send(StepMessage, flags, repeat, self._actions)
+
+    def receive_results(self):
+        """
+        Second half of `step`: wait for the results and return (observations, rewards, game overs)
+        """
+        flags, _ = self._receive(ResultMessage, payload=False)
+        connection = self.connection
+        connection.receive_into(self.rewards)
+        connection.receive_into(self.game_overs)
+        connection.receive_into(self.frame_numbers)
+        finals = [self.final_observations[index] for index in numpy.flatnonzero(self.game_overs)] if flags & FinalObservations else []
+        if flags & Compressed:
+            sizes = numpy.zeros(self.number_of_instances + len(finals), dtype=numpy.uint32) if finals else self._sizes
+            connection.receive_into(sizes)
+            for observation, size in zip(list(self.observations) + finals, sizes.tolist()):
+                observation.reshape(-1)[:] = numpy.frombuffer(zlib.decompress(connection.receive_bytes(size)), dtype=numpy.uint8)
+        elif not flags & NoFrames:
+            connection.receive_into(self.observations)
+            for observation in finals:
+                connection.receive_into(observation)
+        return self.observations, self.rewards, self.game_overs
+
+    def action_numbers(self, actions):
+        """
+        The action numbers of `actions` as an int64 array. Either an array of action numbers or of rows of
+        choice indices, or a list of anything `action_number` takes
+        """
+        if isinstance(actions, numpy.ndarray) and actions.dtype.kind in 'iu':
+            if actions.ndim == 1:
+                return actions
+            if actions.ndim == 2 and actions.shape[1] == len(self._strides):
+                return actions.astype(numpy.int64).dot(self._strides)
+            raise ValueError("Can't make actions out of an array of shape %s" % (actions.shape,))
+        return [self.action_number(action) for action in actions]
+
+    def action_number(self, action):
+        """
+        The action number of `action`: an action number already, a tuple or list with a choice from each
+        action space, or an integer array with the index of the choice in each
+        """
+        if isinstance(action, numbers.Integral):
+            return action
+        if getattr(action, 'dtype', None) is not None and action.dtype.kind in 'iu':
+            if action.ndim == 0:
+                return int(action)
+            return int(numpy.dot(action, self._strides))
+        if len(action) != len(self.action_spaces):
+            raise ValueError("Expected a choice for each of the %d action spaces, got %d" % (len(self.action_spaces), len(action)))
+        number = 0
+        for (_, choices), stride, choice in zip(self.action_spaces, self._strides.tolist(), action):
+            try:
+                number += choices.index(choice) * stride
+            except ValueError:
+                raise KeyError("%r isn't one of %s" % (choice, choices))
+        return number
+
+    def close(self):
+        """
+        Have the server quit the instances, and hang up
+        """
+        try:
+            self._send(CloseMessage, 0, 0)
+        finally:
+            self.connection.destroy()
+
+    def _send(self, message, flags, argument, payload=b''):
+        payload = memoryview(payload).cast('B')
+        self.connection.send_parts((RemoteHeader.pack(message, flags, self.number_of_instances, argument, len(payload)), payload))
+
+    def _receive(self, expected, payload=True):
+        """
+        Receive the header of the next message, which should be an `expected`, and its payload unless
+        we'll take that ourselves. Returns the flags and the payload
+        """
+        message, flags, _, _, length = self.connection.receive_struct(RemoteHeader)
+        if message == ErrorMessage:
+            raise RemoteError(self.connection.receive_bytes(length).decode('utf-8', 'replace'))
+        if message != expected:
+            self.connection.receive_bytes(length)
+            raise RemoteError("Expected message type %d from the server but got %d" % (expected, message))
+        return flags, self.connection.receive_bytes(length) if payload else None
+
+
+class RemoteMamele(object):
+    """
+    One instance of `game_name` on the mamele-server at `address`, played like a Mamele: act,
+    restart_game, get_screen, is_game_over and the score are all there. Nothing gets restarted unless
+    you ask for it.
+
+    The screen comes converted as the observation arguments say, so get_screen only hands it over as it
+    is, like with Mamele's `preprocess`. The rest of the arguments are those of RemoteMameleVec
+    """
+
+    def __init__(self, game_name, address=None, receive_frames=True, **arguments):
+        self.game_name = game_name
+        self.receive_frames = receive_frames
+        self.vector = RemoteMameleVec(game_name, 1, address, **arguments)
+
+        self.width, self.height = self.vector.get_screen_dimensions()
+        self.action_spaces = self.vector.get_minimal_action_set()
+        self.action_space_sizes = self.vector.action_space_sizes
+        self.number_of_actions = self.vector.number_of_actions
+        # already converted, see get_screen
+        self.preprocess = None
+
+        self.previous_score = self.score = 0
+        self.game_over = True
+        self.frame_number = 0
+        self._action = [None]
+
+    def get_screen_dimensions(self):
+        return self.width, self.height
+
+    def get_minimal_action_set(self):
+        return self.action_spaces
+
+    def is_game_over(self):
+        return self.game_over
+
+    def get_observation_shape(self, **arguments):
+        self._check_screen_arguments(arguments)
+        return self.vector.observations.shape[1:]
+
+    def get_screen(self, out=None, **arguments):
+        """
+        The latest screen, as the server converted it. It's overwritten by the next one, so copy it to keep it
+        """
+        self._check_screen_arguments(arguments)
+        if out is not None:
+            numpy.copyto(out, self.vector.observations[0])
+            return out
+        return self.vector.observations[0]
+
+    def get_screen_rgb(self, out=None):
+        return self.get_screen(out=out)
+
+    def restart_game(self):
+        self.vector.restart((0,))
+        self._take_result()
+        self.game_over = False
+        self.score = self.previous_score = 0
+
+    def act(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        Same as Mamele.act
+        """
+        self.send_action(action, repeat, max_pool, with_frame)
+        return self.receive_update()
+
+    def send_action(self, action, repeat=1, max_pool=False, with_frame=None):
+        if with_frame is None:
+            with_frame = self.receive_frames
+        self._action[0] = action
+        self.vector.send_actions(self._action, repeat, max_pool, with_frame, restart_finished=False)
+
+    def receive_update(self):
+        self.vector.receive_results()
+        return self._take_result()
+
+    def encode_action(self, action):
+        """
+        The action number of `action`, see RemoteMameleVec.action_number. That's what goes over the wire
+        """
+        return self.vector.action_number(action)
+
+    def quit(self):
+        self.vector.close()
+
+    def _take_result(self):
+        reward = int(self.vector.rewards[0])
+        self.previous_score = self.score
+        self.score += reward
+        self.game_over = bool(self.vector.game_overs[0])
+        self.frame_number = int(self.vector.frame_numbers[0])
+        return reward
+
+    @staticmethod
+    def _check_screen_arguments(arguments):
+        for name, value in arguments.items():
+            if value != ScreenDefaults[name]:
+                raise ValueError("The server already converts the screens, they can't be converted again")
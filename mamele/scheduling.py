@@ -0,0 +1,183 @@
+"""
+Which CPUs MAME instances and the processes playing them run on, and how many instances the CPUs
+we are allowed to use can take
+"""
+
+import os
+import math
+import logging
+from collections import namedtuple
+
+
+# CPUs for a MAME instance and for whoever is playing it
+Placement = namedtuple('Placement', ['mame', 'client'])
+
+
+def available_cpus():
+    """
+    The CPUs this process may run on
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def cgroup_cpu_limit():
+    """
+    How many CPUs' worth of time our cgroup lets us have, or None if there's no limit (or no cgroups)
+    """
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as limit:
+            quota, period = limit.read().split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, IOError, ValueError):
+        pass
+
+    try:
+        # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota, open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period:
+            quota, period = int(quota.read()), int(period.read())
+        if quota <= 0:
+            return None
+        return quota / period
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def usable_cpus():
+    """
+    How many CPUs we can actually keep busy: those we may run on, unless the cgroup quota is lower
+    """
+    cpus = len(available_cpus())
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, int(math.ceil(limit))))
+    return cpus
+
+
+def instance_count(cpus_per_instance=1, reserved=1):
+    """
+    How many instances to start so that each has `cpus_per_instance` CPUs of the usable ones, after
+    keeping `reserved` for whoever is playing them. Always at least one
+    """
+    return max(1, int((usable_cpus() - reserved) // cpus_per_instance))
+
+
+def cores():
+    """
+    The CPUs grouped by the physical core they are hardware threads of
+    """
+    groups = {}
+    for cpu in available_cpus():
+        try:
+            with open('/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list' % cpu) as siblings:
+                key = siblings.read().strip()
+        except (OSError, IOError):
+            key = str(cpu)
+        groups.setdefault(key, []).append(cpu)
+    return sorted(groups.values())
+
+
+def place_process(pid, cpus=None, nice=None):
+    """
+    Have every thread of process `pid` run on `cpus`, at niceness `nice`. Threads it starts later
+    inherit both
+    """
+    try:
+        threads = [int(thread) for thread in os.listdir('/proc/%d/task' % pid)]
+    except (OSError, IOError):
+        threads = [pid]
+
+    for thread in threads:
+        try:
+            if cpus is not None:
+                os.sched_setaffinity(thread, cpus)
+            if nice is not None:
+                os.setpriority(os.PRIO_PROCESS, thread, nice)
+        except ProcessLookupError:
+            # it's gone already
+            pass
+        except (OSError, IOError) as error:
+            logging.error("Couldn't place thread %d of process %d: %s" % (thread, pid, error))
+
+
+class CpuScheduler(object):
+    """
+    Hands out CPUs to MAME instances, one `assign` per instance, going round again if there are more
+    instances than places for them. With `layout`
+        'cores': each instance gets a physical core to itself, and the players the first `reserved` cores
+        'pairs': each instance shares a core (or a pair of neighbouring CPUs without hardware threads)
+            with its player, MAME on one CPU and the player on the other, so they share caches. For one
+            player process per instance
+    `cpus` are the CPUs to use, by default those we may run on up to the cgroup quota. MAME runs at
+    niceness `nice` if that's given
+    """
+
+    Layouts = ('cores', 'pairs')
+
+    def __init__(self, layout='cores', cpus=None, reserved=1, nice=None):
+        if layout not in self.Layouts:
+            raise ValueError("Don't know the layout '%s', only %s" % (layout, ', '.join(self.Layouts)))
+        self.layout = layout
+        self.nice = nice
+
+        if cpus is None:
+            groups = cores()
+            # only as many as the quota lets us keep busy
+            allowed = usable_cpus()
+            kept = []
+            for group in groups:
+                if sum(len(kept_group) for kept_group in kept) >= allowed:
+                    break
+                kept.append(group)
+            groups = kept
+        else:
+            wanted = set(cpus)
+            groups = [group for group in ([cpu for cpu in group if cpu in wanted] for group in cores()) if group]
+
+        if layout == 'cores':
+            if len(groups) > reserved:
+                self.client_cpus = [cpu for group in groups[:reserved] for cpu in group]
+                groups = groups[reserved:]
+            else:
+                # not enough to keep any apart
+                self.client_cpus = [cpu for group in groups for cpu in group]
+            self.places = [Placement(group, self.client_cpus) for group in groups]
+        else:
+            cpus = [cpu for group in groups for cpu in group]
+            if all(len(group) >= 2 for group in groups):
+                self.places = [Placement(group[:1], group[1:2]) for group in groups]
+            else:
+                self.places = [Placement(cpus[index:index + 1], cpus[index + 1:index + 2] or cpus[index:index + 1])
+                               for index in range(0, len(cpus), 2)]
+            self.client_cpus = cpus
+
+        self._next = 0
+
+    def __len__(self):
+        # instances that get CPUs of their own
+        return len(self.places)
+
+    def assign(self):
+        """
+        The Placement of the next instance
+        """
+        placement = self.places[self._next % len(self.places)]
+        self._next += 1
+        return placement
+
+    def mame_arguments(self):
+        """
+        Keyword arguments for Mamele that place the next instance
+        """
+        return {'cpus': self.assign().mame, 'nice': self.nice}
+
+    def pin_client(self, placement=None):
+        """
+        Run this process on the CPUs for the players, or on those for the player of `placement`
+        """
+        place_process(os.getpid(), self.client_cpus if placement is None else placement.client)
@@ -0,0 +1,299 @@
+"""
+mamele-server: runs Mamele instances for learners on other machines, over TCP (see mamele.remote for
+the clients and what goes over the wire)
+"""
+
+import re
+import json
+import zlib
+import logging
+import argparse
+import threading
+
+import numpy
+
+from .mamele import Mamele
+from .vector import MameleVec
+from .connection import Socket, ConnectionLost
+from .observation import ObservationFormat
+from .remote import (RemoteHeader, OpenMessage, StepMessage, RestartMessage, CloseMessage, DescriptionMessage, ResultMessage,
+    ErrorMessage, MaxPoolFrames, NoFrames, RestartFinished, Compressed, FinalObservations, DefaultPort, ScreenDefaults)
+
+
+# MAME's short names for its games. Anything else could be taken for one of MAME's options
+GameName = re.compile(r'[a-z0-9_]{1,32}\Z')
+
+# the Mamele arguments clients can set. The rest (cpus, nice, watch, shared_memory...) are for whoever runs the server
+ClientArguments = frozenset(['protocol_version', 'receive_frames', 'tile_size', 'state_cache_size', 'fast_restart', 'frame_hashes'])
+
+# and those of the benchmark's stand-in, for when it's served instead of MAME
+StandInArguments = frozenset(['width', 'height', 'changing_rows', 'game_length'])
+
+
+class MameleServer(object):
+    """
+    Listens on `host` (only this machine's loopback by default) and `port` and gives every client that
+    connects the instances it asks for, stepped together as a MameleVec of its own, until it closes the
+    session or goes away. Every client is served by a thread of its own, and a session whose instances
+    stop answering is closed.
+
+    `environment_class` and `scheduler` go to spawn for every instance (see mamele.scheduling), and there
+    are never more than `maximum_instances` instances running for all the clients together, if that's given.
+    Clients can only set the Mamele arguments in `client_arguments`. Any other keyword arguments go to every
+    instance, over what the clients ask for
+    """
+
+    def __init__(self, host='127.0.0.1', port=DefaultPort, environment_class=Mamele, scheduler=None, maximum_instances=None,
+                 client_arguments=ClientArguments, **mamele_arguments):
+        self.environment_class = environment_class
+        self.scheduler = scheduler
+        self.maximum_instances = maximum_instances
+        self.client_arguments = client_arguments
+        self.mamele_arguments = mamele_arguments
+
+        self.listener = Socket()
+        self.address = self.listener.start_tcp_server(host, port)
+        self.instances = 0
+        self.sessions = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def serve_forever(self):
+        """
+        Take clients until `close`
+        """
+        logging.info("Serving on %s" % self.address)
+        while not self._closed:
+            try:
+                connection = self.listener.accept()
+            except (ConnectionLost, OSError) as error:
+                if self._closed:
+                    break
+                logging.error("Problems taking a connection: %s" % error)
+                continue
+            session = ServerSession(self, connection)
+            with self._lock:
+                self.sessions.add(session)
+            threading.Thread(target=session.serve, name='mamele-session', daemon=True).start()
+
+    def start(self):
+        """
+        Serve from a thread of our own. Returns it
+        """
+        thread = threading.Thread(target=self.serve_forever, name='mamele-server', daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """
+        Stop taking clients. Those already connected keep going until they hang up
+        """
+        self._closed = True
+        self.listener.stop_server()
+
+    def reserve(self, instances):
+        """
+        Count `instances` more instances as running, if there's room for them
+        """
+        with self._lock:
+            if self.maximum_instances is not None and self.instances + instances > self.maximum_instances:
+                raise ValueError("Can't start %d instances, %d of %d are running already" % (instances, self.instances, self.maximum_instances))
+            self.instances += instances
+
+    def release(self, instances):
+        with self._lock:
+            self.instances -= instances
+
+    def session_over(self, session):
+        with self._lock:
+            self.sessions.discard(session)
+
+
+class ServerSession(object):
+    """
+    What a client has going on the server: its connection, and its instances once it's opened a session
+    """
+
+    def __init__(self, server, connection):
+        self.server = server
+        self.connection = connection
+        self.vector = None
+        self.compression = None
+        # of the compressed observations
+        self.sizes = None
+
+    def serve(self):
+        """
+        Answer the client's messages until it closes the session or goes away
+        """
+        try:
+            while True:
+                message, flags, count, argument, length = self.connection.receive_struct(RemoteHeader)
+                # the whole message comes off the connection first, so that it's ready for the next one whatever happens
+                payload = self.connection.receive_bytes(length) if length else b''
+                if message == CloseMessage:
+                    break
+                try:
+                    answer = self._handle(message, flags, count, argument, payload)
+                except (ConnectionLost, OSError) as error:
+                    # one of the instances went away in the middle of something, and the others can't go on without it
+                    logging.error("Lost an instance, closing the session: %s" % error)
+                    self.connection.send_parts(self._error(count, "Lost an instance: %s" % error))
+                    break
+                except Exception as error:
+                    logging.exception("Problems with message type %d from the client" % message)
+                    answer = self._error(count, error)
+                self.connection.send_parts(answer)
+        except ConnectionLost as error:
+            logging.info("The client went away: %s" % error)
+        finally:
+            self._close()
+
+    def _handle(self, message, flags, count, argument, payload):
+        if message == OpenMessage:
+            return self._open(json.loads(payload.decode('utf-8')))
+        if self.vector is None:
+            raise ValueError("Open a session first")
+        if count != len(self.vector):
+            raise ValueError("There are %d instances, not %d" % (len(self.vector), count))
+
+        if message == StepMessage:
+            actions = numpy.frombuffer(payload, dtype='<i8').tolist()
+            with_frame = False if flags & NoFrames else None
+            restart_finished = bool(flags & RestartFinished)
+            self.vector.step(actions, max(argument, 1), bool(flags & MaxPoolFrames), with_frame, restart_finished)
+            return self._result(self._receive_frames if with_frame is None else with_frame, restart_finished)
+        if message == RestartMessage:
+            self.vector.restart(numpy.flatnonzero(numpy.frombuffer(payload, dtype=numpy.uint8)).tolist())
+            return self._result(self._receive_frames)
+        raise ValueError("Unknown message type %d" % message)
+
+    @property
+    def _receive_frames(self):
+        # whether the instances get frames unless told otherwise. They were all started the same way
+        return self.vector.environments[0].receive_frames
+
+    def _error(self, count, error):
+        error = str(error).encode('utf-8')
+        return RemoteHeader.pack(ErrorMessage, 0, count, 0, len(error)), error
+
+    def _open(self, request):
+        if self.vector is not None:
+            raise ValueError("There's a session going already")
+
+        game_name = request['game_name']
+        if not isinstance(game_name, str) or not GameName.match(game_name):
+            raise ValueError("%r isn't the name of a game" % (game_name,))
+        instances = int(request['instances'])
+        screen = dict(ScreenDefaults)
+        screen.update(request.get('screen') or {})
+        arguments = dict(request.get('arguments') or {})
+        refused = sorted(set(screen) - set(ScreenDefaults)) + sorted(set(arguments) - self.server.client_arguments)
+        if refused:
+            raise ValueError("Clients can't set %s" % ', '.join(refused))
+        compression = request.get('compression')
+        if compression is not None and (type(compression) is not int or not -1 <= compression <= 9):
+            # checked now, rather than when the first step has been played and can't be sent
+            raise ValueError("The compression should be a zlib level from -1 to 9, not %r" % (compression,))
+        if screen != ScreenDefaults:
+            # have the passthroughs convert the screens, so that the work is spread over the instances
+            arguments['preprocess'] = ObservationFormat(**screen)
+        arguments.update(self.server.mamele_arguments)
+
+        self.server.reserve(instances)
+        try:
+            self.vector = MameleVec(game_name, instances, environment_class=self.server.environment_class,
+                                    scheduler=self.server.scheduler, **arguments)
+        except BaseException:
+            self.server.release(instances)
+            raise
+        self.compression = compression
+        self.sizes = numpy.zeros(instances, dtype=numpy.uint32)
+
+        description = json.dumps({
+            'width': self.vector.width,
+            'height': self.vector.height,
+            'action_spaces': self.vector.get_minimal_action_set(),
+            'observation_shape': self.vector.observations.shape[1:],
+        }).encode('utf-8')
+        return RemoteHeader.pack(DescriptionMessage, 0, instances, 0, len(description)), description
+
+    def _result(self, with_frames, restarted=False):
+        """
+        What goes back to the client after a step or a restart, as parts to send one after the other.
+        If finished games were `restarted`, their final observations go too
+        """
+        vector = self.vector
+        parts = (vector.rewards, vector.game_overs.view(numpy.uint8), vector.frame_numbers)
+        flags = 0
+        finals = ()
+        if with_frames and restarted and vector.game_overs.any():
+            flags |= FinalObservations
+            finals = tuple(vector.final_observations[index] for index in numpy.flatnonzero(vector.game_overs))
+
+        if not with_frames:
+            flags |= NoFrames
+        elif self.compression is not None:
+            flags |= Compressed
+            frames = [zlib.compress(observation, self.compression) for observation in tuple(vector.observations) + finals]
+            sizes = self.sizes if not finals else numpy.zeros(len(frames), dtype=numpy.uint32)
+            sizes[:] = [len(frame) for frame in frames]
+            parts += (sizes,) + tuple(frames)
+        else:
+            parts += (vector.observations,) + finals
+
+        length = sum(memoryview(part).nbytes for part in parts)
+        return (RemoteHeader.pack(ResultMessage, flags, len(vector), 0, length),) + parts
+
+    def _close(self):
+        if self.vector is not None:
+            try:
+                self.vector.close()
+            finally:
+                self.server.release(len(self.vector))
+                self.vector = None
+        try:
+            self.connection.destroy()
+        except (OSError, IOError):
+            pass
+        self.server.session_over(self)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Run MAME instances for learners elsewhere to play over TCP")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on, only this machine's loopback by default")
+    parser.add_argument('--port', type=int, default=DefaultPort)
+    parser.add_argument('--maximum-instances', type=int, help="instances to run at most, for all clients together")
+    parser.add_argument('--pin', action='store_true', help="give each instance a core of its own, keeping one for the server (see mamele.scheduling)")
+    parser.add_argument('--nice', type=int, help="niceness of the MAME instances")
+    parser.add_argument('--standin', action='store_true', help="serve the benchmark's stand-in instead of MAME, to try things out without ROMs")
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+
+    environment_class = Mamele
+    client_arguments = ClientArguments
+    if options.standin:
+        from .benchmark.harness import StandInMamele
+        environment_class = StandInMamele
+        client_arguments = ClientArguments | StandInArguments
+
+    scheduler = None
+    mamele_arguments = {}
+    if options.pin:
+        from .scheduling import CpuScheduler
+        # we are the ones talking to all the instances
+        scheduler = CpuScheduler('cores', reserved=1, nice=options.nice)
+        scheduler.pin_client()
+    elif options.nice is not None:
+        mamele_arguments['nice'] = options.nice
+
+    server = MameleServer(options.host, options.port, environment_class, scheduler, options.maximum_instances, client_arguments, **mamele_arguments)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Saved machine states, kept around in memory so we can go back to them
+"""
+
+import itertools
+from collections import OrderedDict, namedtuple
+
+
+# the state of the machine as the passthrough saved it, and what we knew about the game at that point
+Snapshot = namedtuple('Snapshot', 'state frame frame_number score game_over')
+
+
+class StateCache(object):
+    """
+    Snapshots by handle, up to `maximum_size` bytes of them. When there's no room left, the ones that
+    were used the longest ago are dropped
+    """
+
+    def __init__(self, maximum_size):
+        self.maximum_size = maximum_size
+        self.size = 0
+        self._snapshots = OrderedDict()
+        self._handles = itertools.count(1)
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, handle):
+        return handle in self._snapshots
+
+    def add(self, snapshot):
+        """
+        Keep `snapshot` and return its handle
+        """
+        size = self.snapshot_size(snapshot)
+        if size > self.maximum_size:
+            raise ValueError("A snapshot of %d bytes doesn't fit in a cache of %d bytes" % (size, self.maximum_size))
+
+        while self.size + size > self.maximum_size:
+            _, oldest = self._snapshots.popitem(last=False)
+            self.size -= self.snapshot_size(oldest)
+
+        handle = next(self._handles)
+        self._snapshots[handle] = snapshot
+        self.size += size
+        return handle
+
+    def get(self, handle):
+        """
+        The snapshot for `handle`. Raises KeyError if it's not there, or not there anymore
+        """
+        snapshot = self._snapshots[handle]
+        self._snapshots.move_to_end(handle)
+        return snapshot
+
+    def discard(self, handle):
+        snapshot = self._snapshots.pop(handle, None)
+        if snapshot is not None:
+            self.size -= self.snapshot_size(snapshot)
+
+    def clear(self):
+        self._snapshots.clear()
+        self.size = 0
+
+    @staticmethod
+    def snapshot_size(snapshot):
+        size = len(snapshot.state)
+        if snapshot.frame is not None:
+            size += len(snapshot.frame)
+        return size
@@ -0,0 +1,245 @@
+"""
+Keeping a Mamele going when MAME crashes or hangs
+"""
+
+import time
+import logging
+from collections import defaultdict
+
+from .mamele import Mamele
+from .connection import ConnectionLost, ConnectionTimeout
+
+
+class SupervisedMamele(object):
+    """
+    A Mamele of `game_name` that gets replaced when MAME dies or stops answering.
+
+    Every step has `step_timeout` seconds to come back, and starting MAME up to having a game going has
+    `start_timeout`. When MAME closes the connection, doesn't answer in time or isn't running any more,
+    it's killed and a new one is started, waiting `backoff` seconds first, twice as long for every
+    failure in a row up to `maximum_backoff`. After `maximum_failures` failures in a row we give up and
+    raise the last problem, and we are `closed`: anything else that needs an instance raises ConnectionLost.
+
+    A step that fails brings no reward and ends the episode: `truncated` is set, and is_game_over is True
+    until the next restart_game. The new instance has a game started already, so that restart_game
+    doesn't have to do anything.
+
+    Anything else is handed to the instance underneath, which is `environment`. Keyword arguments other
+    than those go to `environment_class`. Like with Mamele, if `connect` is False the first instance is
+    started but not waited for, and `finish_connecting` does the rest, so that `spawn` (and with it
+    MameleVec, MamelePool and mamele-server) can start supervised instances too
+    """
+
+    def __init__(self, game_name, step_timeout=30, start_timeout=120, backoff=1.0, maximum_backoff=60.0, maximum_failures=10,
+                 environment_class=Mamele, connect=True, **arguments):
+        self.game_name = game_name
+        self.step_timeout = step_timeout
+        self.start_timeout = start_timeout
+        self.backoff = backoff
+        self.maximum_backoff = maximum_backoff
+        self.maximum_failures = maximum_failures
+        self.environment_class = environment_class
+        self.arguments = arguments
+
+        self.environment = None
+        self.truncated = False
+        self.respawns = 0
+        self.consecutive_failures = 0
+        # what went wrong, by kind: 'closed', 'timeout', 'died'
+        self.failures = defaultdict(int)
+        self._fresh_game = False
+        # the action sent with send_action didn't make it, so there's no update to receive for it
+        self._lost_action = False
+        self.closed = False
+        # step hooks (see Mamele.add_step_hook), for every instance we start
+        self._step_hooks = []
+
+        self.environment = self._start(connect)
+        self._fresh_game = True
+
+    def __getattr__(self, name):
+        # only called for what we don't have ourselves
+        environment = self.__dict__.get('environment')
+        if environment is None:
+            if self.__dict__.get('closed'):
+                self._check_open()
+            raise AttributeError(name)
+        return getattr(environment, name)
+
+    def _check_open(self):
+        if self.closed:
+            raise ConnectionLost("Gave up on %s after %d failures in a row" % (self.game_name, self.consecutive_failures))
+
+    def act(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        Same as Mamele.act. If it fails, the instance is replaced and the episode is truncated
+        """
+        self._check_open()
+        try:
+            reward = self.environment.act(action, repeat, max_pool, with_frame)
+        except (ConnectionLost, OSError) as error:
+            self._replace(error)
+            return 0
+        self._stepped()
+        return reward
+
+    def send_action(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        Same as Mamele.send_action, failing like `act` does. receive_update then brings no reward
+        """
+        self._check_open()
+        try:
+            self.environment.send_action(action, repeat, max_pool, with_frame)
+        except (ConnectionLost, OSError) as error:
+            self._replace(error)
+            self._lost_action = True
+
+    def receive_update(self):
+        """
+        Same as Mamele.receive_update, failing like `act` does
+        """
+        self._check_open()
+        if self._lost_action:
+            self._lost_action = False
+            return 0
+        try:
+            reward = self.environment.receive_update()
+        except (ConnectionLost, OSError) as error:
+            self._replace(error)
+            return 0
+        self._stepped()
+        return reward
+
+    def act_async(self, action, repeat=1, max_pool=False, with_frame=None):
+        """
+        Not supervised: the PendingStep would wait on the instance behind our back. send_action and
+        receive_update get MAME working while we do something else just as well
+        """
+        raise NotImplementedError("SupervisedMamele can't look after act_async steps, use send_action and receive_update")
+
+    def has_pending_data(self):
+        # the update of an action that didn't make it is there straight away: there isn't one
+        return self._lost_action or self.environment.has_pending_data()
+
+    def _stepped(self):
+        self.consecutive_failures = 0
+        self._fresh_game = False
+
+    def restart_game(self):
+        self._check_open()
+        self.truncated = False
+        self._lost_action = False
+        if self._fresh_game:
+            # the instance that just replaced the last one has a game going that nobody's played yet
+            self._fresh_game = False
+            return
+        try:
+            self.environment.restart_game()
+        except (ConnectionLost, OSError) as error:
+            self._replace(error)
+            self.truncated = False
+            self._fresh_game = False
+            return
+        # only a restart that went through counts, not skipping one for a fresh instance that may yet fail
+        self.consecutive_failures = 0
+
+    def add_step_hook(self, hook):
+        """
+        Same as Mamele.add_step_hook, and the hook stays on across replacements
+        """
+        self._check_open()
+        self._step_hooks.append(hook)
+        self.environment.add_step_hook(hook)
+
+    def remove_step_hook(self, hook):
+        self._step_hooks.remove(hook)
+        if self.environment is not None:
+            self.environment.remove_step_hook(hook)
+
+    def is_game_over(self):
+        self._check_open()
+        return self.truncated or self.environment.is_game_over()
+
+    @property
+    def game_over(self):
+        return self.is_game_over()
+
+    def check(self):
+        """
+        Replace the instance if MAME isn't running any more. Returns whether it had to
+        """
+        self._check_open()
+        mame = self.environment.mame
+        if mame is None or mame.poll() is None:
+            return False
+        self._replace(ConnectionLost("MAME exited with %s" % mame.returncode))
+        return True
+
+    def quit(self):
+        if self.closed:
+            # there's nothing left to quit
+            return
+        try:
+            self.environment.quit()
+        except (ConnectionLost, OSError) as error:
+            logging.error("Problems telling MAME to quit, killing it instead: %s" % error)
+            self.environment.abandon()
+
+    def _replace(self, error):
+        """
+        Get rid of the instance that failed with `error` and start another, backing off if they keep failing
+        """
+        while True:
+            mame = self.environment.mame if self.environment is not None else None
+            if mame is not None and mame.poll() is not None:
+                kind = 'died'
+            elif isinstance(error, ConnectionTimeout):
+                kind = 'timeout'
+            else:
+                kind = 'closed'
+            self.failures[kind] += 1
+            self.consecutive_failures += 1
+            logging.error("%s went wrong (%s: %s), starting another one" % (self.game_name, kind, error))
+
+            if self.environment is not None:
+                self.environment.abandon()
+                self.environment = None
+            if self.consecutive_failures > self.maximum_failures:
+                self.closed = True
+                raise error
+
+            time.sleep(min(self.backoff * 2 ** (self.consecutive_failures - 1), self.maximum_backoff))
+            try:
+                self.environment = self._start()
+            except (ConnectionLost, OSError) as next_error:
+                error = next_error
+                continue
+
+            self.respawns += 1
+            self.truncated = True
+            self._fresh_game = True
+            return
+
+    def finish_connecting(self):
+        """
+        Same as Mamele.finish_connecting, and then the game is started
+        """
+        self._finish_starting(self.environment)
+
+    def _start(self, connect=True):
+        environment = self.environment_class(self.game_name, connect=False, **self.arguments)
+        if connect:
+            self._finish_starting(environment)
+        return environment
+
+    def _finish_starting(self, environment):
+        try:
+            environment.mamele_connection.set_timeout(self.start_timeout)
+            environment.finish_connecting()
+            environment.restart_game()
+            environment.mamele_connection.set_timeout(self.step_timeout)
+            for hook in self._step_hooks:
+                environment.add_step_hook(hook)
+        except BaseException:
+            environment.abandon()
+            raise
@@ -0,0 +1,92 @@
+"""
+Frames split into fixed-size tiles so that only the ones that changed need to be sent
+"""
+
+import numpy
+
+
+class TileGrid(object):
+    """
+    Keeps a copy of the last frame seen, split into tiles of `tile_size` x `tile_size` pixels.
+
+    The frame is handled as a two dimensional array of bytes, one row of pixels per row (or one row of a
+    channel plane for channel-first frames), so the same grid works for any of the frame formats we send.
+    The copy is padded up to a whole number of tiles
+    """
+
+    def __init__(self, frame_shape, tile_size, channels_first=False):
+        if channels_first:
+            # channel planes, one after the other
+            rows, row_bytes, pixel_bytes = frame_shape[0] * frame_shape[1], frame_shape[2], 1
+        elif len(frame_shape) == 3:
+            rows, row_bytes, pixel_bytes = frame_shape[0], frame_shape[1] * frame_shape[2], frame_shape[2]
+        else:
+            rows, row_bytes, pixel_bytes = frame_shape[0], frame_shape[1], 1
+
+        self.frame_shape = tuple(frame_shape)
+        self.rows = rows
+        self.row_bytes = row_bytes
+        self.tile_rows = tile_size
+        self.tile_bytes = tile_size * pixel_bytes
+        self.tiles_down = (rows + self.tile_rows - 1) // self.tile_rows
+        self.tiles_across = (row_bytes + self.tile_bytes - 1) // self.tile_bytes
+        self.number_of_tiles = self.tiles_down * self.tiles_across
+        self.tile_size_in_bytes = self.tile_rows * self.tile_bytes
+
+        padded_shape = (self.tiles_down * self.tile_rows, self.tiles_across * self.tile_bytes)
+        self.padded = padded_shape != (rows, row_bytes)
+        self.frame = numpy.zeros(padded_shape, dtype=numpy.uint8)
+
+        # only needed when we are the ones looking for changes. We compare whole words at a time
+        self._incoming = None
+        self._difference = None
+        self._word = next(word for word in (numpy.uint64, numpy.uint32, numpy.uint16, numpy.uint8) if self.tile_bytes % numpy.dtype(word).itemsize == 0)
+
+    def tiles(self, grid):
+        """
+        View of `grid` as tiles_down x tiles_across tiles
+        """
+        return grid.reshape(self.tiles_down, self.tile_rows, self.tiles_across, self.tile_bytes).swapaxes(1, 2)
+
+    def load(self, frame):
+        """
+        Take `frame` (anything with the buffer interface) as the last frame seen
+        """
+        self.frame[:self.rows, :self.row_bytes] = numpy.frombuffer(frame, dtype=numpy.uint8).reshape(self.rows, self.row_bytes)
+
+    def changes(self, frame):
+        """
+        Tile indices and contents of the tiles of `frame` that are different to the last frame seen,
+        which then becomes `frame`
+        """
+        if self._incoming is None:
+            self._incoming = numpy.zeros_like(self.frame)
+            self._difference = numpy.empty(self._incoming.view(self._word).shape, dtype=bool)
+
+        self._incoming[:self.rows, :self.row_bytes] = numpy.frombuffer(frame, dtype=numpy.uint8).reshape(self.rows, self.row_bytes)
+        numpy.not_equal(self._incoming.view(self._word), self.frame.view(self._word), out=self._difference)
+        # reducing down the rows first keeps numpy on its fast paths
+        changed_columns = self._difference.reshape(self.tiles_down, self.tile_rows, -1).any(axis=1)
+        changed = changed_columns.reshape(self.tiles_down, self.tiles_across, -1).any(axis=2)
+        down, across = numpy.nonzero(changed)
+        contents = self.tiles(self._incoming)[down, across]
+
+        # the padding is always zero in both, so we can swap them around
+        self.frame, self._incoming = self._incoming, self.frame
+        return (down * self.tiles_across + across).astype(numpy.uint32), contents
+
+    def patch(self, indices, contents):
+        """
+        Write the tiles `contents` (number of tiles x tile_size_in_bytes bytes) at tile `indices`
+        """
+        contents = contents.reshape(len(indices), self.tile_rows, self.tile_bytes)
+        self.tiles(self.frame)[indices // self.tiles_across, indices % self.tiles_across] = contents
+
+    def copy_to(self, destination):
+        """
+        Copy the last frame seen, without the padding, to `destination`
+        """
+        if self.padded:
+            numpy.frombuffer(destination, dtype=numpy.uint8).reshape(self.rows, self.row_bytes)[:] = self.frame[:self.rows, :self.row_bytes]
+        else:
+            memoryview(destination).cast('B')[:] = self.frame.reshape(-1)
@@ -0,0 +1,162 @@
+"""
+Several MAME instances of the same game stepped together
+"""
+
+import logging
+import selectors
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy
+
+from .mamele import spawn
+
+
+class MameleVec(object):
+    """
+    Owns `number_of_instances` Mamele instances of `game_name` and steps them all at once.
+
+    The actions for all instances are sent before waiting for any of the answers, and answers are
+    processed in whatever order they arrive, so every emulator works at the same time. Finished games
+    are restarted all together, each from a thread of its own.
+
+    The observation arguments are those of Mamele.get_screen. Any other keyword arguments go to Mamele
+    """
+
+    def __init__(self, game_name, number_of_instances, grayscale=False, crop=None, downsample=1, layout='HWC', resize=None,
+                 **mamele_arguments):
+        if number_of_instances < 1:
+            raise ValueError("We need at least one instance, not %d" % number_of_instances)
+
+        self.game_name = game_name
+        self._screen_arguments = dict(grayscale=grayscale, crop=crop, downsample=downsample, layout=layout, resize=resize)
+
+        # so that restarts happen all at once
+        self._restarter = ThreadPoolExecutor(max_workers=number_of_instances)
+        self._selector = selectors.DefaultSelector()
+
+        self.environments = []
+        try:
+            self.environments = spawn(game_name, number_of_instances, **mamele_arguments)
+        except Exception:
+            self.close()
+            raise
+
+        first = self.environments[0]
+        self.width, self.height = first.get_screen_dimensions()
+        self.action_spaces = first.get_minimal_action_set()
+
+        self.number_of_instances = number_of_instances
+        self.observations = numpy.empty((number_of_instances,) + first.get_observation_shape(**self._screen_arguments), dtype=numpy.uint8)
+        # the last observations of the games that finished on the last step, by instance
+        self.final_observations = numpy.zeros_like(self.observations)
+        self.rewards = numpy.zeros(number_of_instances, dtype=numpy.int64)
+        self.game_overs = numpy.zeros(number_of_instances, dtype=bool)
+        self.frame_numbers = numpy.zeros(number_of_instances, dtype=numpy.uint32)
+
+        # the connection we wait on for each instance, which changes when SupervisedMamele replaces one
+        self._watched = [None] * number_of_instances
+        self._watch_connections()
+
+
+    def __len__(self):
+        return self.number_of_instances
+
+    def get_screen_dimensions(self):
+        return self.width, self.height
+
+    def get_minimal_action_set(self):
+        return self.action_spaces
+
+    def reset(self):
+        """
+        Restart all the games and return their first observations
+        """
+        return self.restart(range(self.number_of_instances))
+
+    def restart(self, indices):
+        """
+        Restart the games of the instances at `indices`, all at once, and return the observations
+        """
+        self._restart(indices)
+        for index in indices:
+            self.rewards[index] = 0
+            self.game_overs[index] = False
+        return self.observations
+
+    def _restart(self, indices):
+        # the games all restart at once, and then the observations are those of the new games
+        restarts = [self._restarter.submit(self.environments[index].restart_game) for index in indices]
+        wait(restarts)
+        for restart in restarts:
+            restart.result()
+
+        for index in indices:
+            environment = self.environments[index]
+            if environment.receive_frames:
+                environment.get_screen(out=self.observations[index], **self._screen_arguments)
+            self.frame_numbers[index] = environment.frame_number
+
+    def step(self, actions, repeat=1, max_pool=False, with_frame=None, restart_finished=True):
+        """
+        Do one action per instance and return (observations, rewards, game overs) as stacked arrays.
+        The actions can be anything Mamele.encode_action takes, so an array of action numbers, or of
+        a row of choices for each instance, will do.
+        `repeat`, `max_pool` and `with_frame` are as in Mamele.act. The observations of the instances
+        that don't get frames (see Mamele's receive_frames) are left as they were.
+
+        The arrays are reused on the next step, so copy them if you want to keep them. When an instance
+        reports a game over, its game is restarted before we return, like Gym's vector environments do:
+        the observation (and frame number) is the first of the new game, the last observation of the game
+        that finished is in `final_observations`, and the reward and game over are those of the step that
+        finished it. With `restart_finished` False, you get the last observation and it's up to you to
+        `restart` the instance
+        """
+        if len(actions) != self.number_of_instances:
+            raise ValueError("Expected %d actions, got %d" % (self.number_of_instances, len(actions)))
+
+        # get everything going first
+        for environment, action in zip(self.environments, actions):
+            environment.send_action(action, repeat, max_pool, with_frame)
+        self._watch_connections()
+
+        waiting = set(range(self.number_of_instances))
+        while waiting:
+            ready = [index for index in waiting if self.environments[index].has_pending_data()]
+            if not ready:
+                ready = [key.data for key, _ in self._selector.select() if key.data in waiting]
+
+            for index in ready:
+                environment = self.environments[index]
+                self.rewards[index] = environment.receive_update()
+                self.game_overs[index] = environment.is_game_over()
+                self.frame_numbers[index] = environment.frame_number
+                if environment.receive_frames if with_frame is None else with_frame:
+                    environment.get_screen(out=self.observations[index], **self._screen_arguments)
+                waiting.discard(index)
+
+        if restart_finished:
+            finished = numpy.flatnonzero(self.game_overs).tolist()
+            if finished:
+                self.final_observations[finished] = self.observations[finished]
+                self._restart(finished)
+
+        return self.observations, self.rewards, self.game_overs
+
+    def _watch_connections(self):
+        for index, environment in enumerate(self.environments):
+            connection = environment.mamele_connection.connection
+            if connection is not self._watched[index]:
+                if self._watched[index] is not None:
+                    self._selector.unregister(self._watched[index])
+                self._selector.register(connection, selectors.EVENT_READ, index)
+                self._watched[index] = connection
+
+    def close(self):
+        self._restarter.shutdown()
+        self._selector.close()
+
+        for environment in self.environments:
+            try:
+                environment.quit()
+            except Exception as error:
+                logging.error("Problems telling an instance to quit: %s" % error)
@@ -0,0 +1,175 @@
+"""
+A Gym-style environment around Mamele, with the frame stacking, reward clipping and episode
+bookkeeping that everybody ends up writing
+"""
+
+from collections import namedtuple
+
+import numpy
+
+from .mamele import Mamele
+
+try:
+    from gymnasium import spaces
+except ImportError:
+    try:
+        from gym import spaces
+    except ImportError:
+        spaces = None
+
+
+# what the spaces look like when neither gymnasium nor gym are around
+Box = namedtuple('Box', ['low', 'high', 'shape', 'dtype'])
+Discrete = namedtuple('Discrete', ['n'])
+MultiDiscrete = namedtuple('MultiDiscrete', ['nvec'])
+
+
+class MameleEnv(object):
+    """
+    Plays `game_name` with reset and step as in Gymnasium. Observations are the last `frame_stack`
+    screens stacked along a new first axis, each converted as the observation arguments say (see
+    Mamele.get_screen). Every step does the action for `repeat` frames, pooling the last two with
+    `max_pool`. With `clip_rewards`, rewards are just their sign. Episodes are truncated after
+    `max_episode_steps` steps if that's set.
+
+    Actions are action numbers (see Mamele.encode_action), or an array with a choice in each action
+    space with `multi_discrete`.
+
+    The screens live in a circular buffer allocated once, twice as long as the stack, with every
+    screen written in two places so that the last `frame_stack` are always next to each other.
+    Observations are views into it, so they change on the next step: copy them to keep them. Screens
+    are converted straight into the buffer, or received into it from the socket when the passthrough
+    does the converting (with `preprocess`), so stepping doesn't allocate anything of ours.
+
+    Keyword arguments other than those go to Mamele. Pass `environment` to wrap an instance that's
+    already running instead of starting one, or a SupervisedMamele to have MAME replaced when it fails,
+    which truncates the episode
+    """
+
+    metadata = {'render_modes': ['rgb_array']}
+
+    def __init__(self, game_name=None, frame_stack=4, repeat=4, max_pool=True, clip_rewards=False, max_episode_steps=None,
+                 multi_discrete=False, grayscale=False, crop=None, downsample=1, layout='HWC', resize=None, environment=None,
+                 **mamele_arguments):
+        if frame_stack < 1:
+            raise ValueError("We need to stack at least one frame, not %d" % frame_stack)
+        if environment is None:
+            environment = Mamele(game_name, **mamele_arguments)
+        self.environment = environment
+        self.frame_stack = frame_stack
+        self.repeat = repeat
+        self.max_pool = max_pool and repeat > 1
+        self.clip_rewards = clip_rewards
+        self.max_episode_steps = max_episode_steps
+        self.multi_discrete = multi_discrete
+        self._screen_arguments = dict(grayscale=grayscale, crop=crop, downsample=downsample, layout=layout, resize=resize)
+
+        screen_shape = environment.get_observation_shape(**self._screen_arguments)
+        # a SupervisedMamele truncates the episode when it has to replace MAME
+        self._can_truncate = hasattr(environment, 'truncated')
+        # the passthrough already converts them, so they can go straight from the socket to where they are kept
+        self._receive_in_place = environment.preprocess is not None
+
+        self._screens = numpy.zeros((2 * frame_stack,) + tuple(screen_shape), dtype=numpy.uint8)
+        self._slots = list(self._screens)
+        # the observation after each of the positions in the circle
+        self._views = [self._screens[position + 1:position + 1 + frame_stack] for position in range(frame_stack)]
+        self._position = 0
+
+        self.observation_space = self._box(screen_shape)
+        if multi_discrete:
+            self.action_space = self._multi_discrete(environment.action_space_sizes)
+        else:
+            self.action_space = self._discrete(environment.number_of_actions)
+
+        self.episodes = 0
+        self.episode_return = 0
+        self.episode_length = 0
+        self.total_steps = 0
+        # handed back on every step, and updated in place
+        self.info = {'episode_return': 0, 'episode_length': 0, 'frame_number': 0}
+
+    def _box(self, screen_shape):
+        shape = (self.frame_stack,) + tuple(screen_shape)
+        if spaces is None:
+            return Box(0, 255, shape, numpy.uint8)
+        return spaces.Box(low=0, high=255, shape=shape, dtype=numpy.uint8)
+
+    @staticmethod
+    def _discrete(number):
+        return Discrete(number) if spaces is None else spaces.Discrete(number)
+
+    @staticmethod
+    def _multi_discrete(sizes):
+        return MultiDiscrete(numpy.array(sizes)) if spaces is None else spaces.MultiDiscrete(sizes)
+
+    def reset(self, seed=None, options=None):
+        """
+        Start a new game and return its first observation, with every frame of the stack the same,
+        and the info dictionary. `seed` and `options` are only there to look like Gymnasium
+        """
+        self.environment.restart_game()
+        self.episodes += 1
+        self.episode_return = 0
+        self.episode_length = 0
+
+        self._position = 0
+        self._place_screen()
+        self._screens[:] = self._slots[0]
+        self._update_info()
+        return self._views[self._position], self.info
+
+    def step(self, action):
+        """
+        Do `action` and return the observation, the reward, whether the game is over, whether the
+        episode was cut short by max_episode_steps and the info dictionary
+        """
+        environment = self.environment
+        self._position = (self._position + 1) % self.frame_stack
+        if self._receive_in_place:
+            environment.set_image_buffer(self._slots[self._position])
+        score = environment.act(action, self.repeat, self.max_pool)
+        self._place_screen()
+
+        self.episode_return += score
+        self.episode_length += 1
+        self.total_steps += 1
+        failed = self._can_truncate and environment.truncated
+        terminated = environment.game_over and not failed
+        truncated = failed or (not terminated and self.max_episode_steps is not None and self.episode_length >= self.max_episode_steps)
+        self._update_info()
+
+        if self.clip_rewards:
+            reward = (score > 0) - (score < 0)
+        else:
+            reward = score
+        return self._views[self._position], reward, terminated, truncated, self.info
+
+    def _place_screen(self):
+        # the latest screen goes at the position in the circle and again one lap later
+        position = self._position
+        screen = self._slots[position]
+        environment = self.environment
+        if not self._receive_in_place:
+            environment.get_screen(out=screen, **self._screen_arguments)
+        elif environment.latest_image_as_bytes is not screen:
+            # it didn't arrive there (no frame this time, it's in shared memory, or we are just starting)
+            screen.reshape(-1)[:] = numpy.frombuffer(environment.latest_image_as_bytes, dtype=numpy.uint8)
+        numpy.copyto(self._slots[position + self.frame_stack], screen)
+
+    def _update_info(self):
+        info = self.info
+        info['episode_return'] = self.episode_return
+        info['episode_length'] = self.episode_length
+        info['frame_number'] = self.environment.frame_number
+
+    def render(self):
+        """
+        The latest screen as RGB
+        """
+        return self.environment.get_screen_rgb()
+
+    def close(self):
+        if self._receive_in_place:
+            self.environment.set_image_buffer(None)
+        self.environment.quit()
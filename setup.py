@@ -134,20 +134,21 @@ setup(name='mamele',
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
         'Intended Audience :: Science/Research',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
         'License :: OSI Approved :: GNU Lesser General Public License v2 or later (LGPLv2+)',
         'License :: OSI Approved :: BSD License',
         'Operating System :: POSIX :: Linux',
 
       ],
-      packages=['mamele'],
+      packages=['mamele', 'mamele.benchmark'],
       package_data={ 'mamele' : package_data },
       data_files=[('share/mamele/examples', ['examples/randomplayer.py'])],
       cmdclass={'build': Build, 'install' : Install, 'sdist' : Sdist},
-      install_requires=['numpy', 'pillow'],
+      entry_points={'console_scripts': ['mamele-server = mamele.server:main']},
+      python_requires='>=3.7',
+      install_requires=['numpy'],
       zip_safe=False,
       tests_require=[],
 )
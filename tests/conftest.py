@@ -0,0 +1,32 @@
+"""
+Everything here plays the benchmark's stand-in (see mamele.benchmark.standin), so it runs without MAME or ROMs
+"""
+
+import pytest
+
+from mamele.benchmark.harness import StandInMamele
+
+
+# small screens keep things quick, and games short enough to finish in a test
+Screen = dict(width=64, height=48, changing_rows=8)
+GameLength = 120
+
+
+@pytest.fixture
+def standin():
+    """
+    Starts stand-ins with a game going, `standin(**arguments)`, and gets rid of them afterwards
+    """
+    started = []
+
+    def start(game_length=GameLength, restart=True, **arguments):
+        environment = StandInMamele('standin', game_length=game_length, **dict(Screen, **arguments))
+        started.append(environment)
+        if restart:
+            environment.restart_game()
+        return environment
+
+    yield start
+    for environment in started:
+        environment.abandon()
+
@@ -0,0 +1,74 @@
+"""
+AsyncMamele plays the same game as Mamele does
+"""
+
+import asyncio
+
+import numpy
+import pytest
+
+from mamele.protocol import TextProtocol
+from mamele.observation import ObservationFormat
+from mamele.asynchronous import AsyncMamele
+from mamele.benchmark.harness import StandInMamele
+
+from conftest import Screen, GameLength
+
+
+class AsyncStandInMamele(AsyncMamele):
+    """
+    AsyncMamele starting the stand-in, with StandInMamele's settings
+    """
+
+    _mame_command = StandInMamele._mame_command
+
+    def __init__(self, game_name, width=400, height=300, changing_rows=16, game_length=100000, **arguments):
+        self.standin_arguments = ['--width', str(width), '--height', str(height), '--changing-rows', str(changing_rows),
+                                  '--game-length', str(game_length)]
+        AsyncMamele.__init__(self, game_name, **arguments)
+
+
+Steps = 150
+
+
+def play(environment, act, restart_game):
+    # through a game over, so that restart_game gets a turn in the middle
+    results = []
+    for step in range(Steps):
+        if environment.is_game_over():
+            restart_game()
+        reward = act(step * 7 % environment.number_of_actions, step % 3 + 1)
+        results.append((reward, environment.is_game_over(), environment.frame_number, environment.get_screen().copy()))
+    return results
+
+
+async def play_asynchronously(arguments):
+    environment = await AsyncStandInMamele.launch('standin', game_length=GameLength, **dict(Screen, **arguments))
+    try:
+        await environment.restart_game()
+        results = []
+        for step in range(Steps):
+            if environment.is_game_over():
+                await environment.restart_game()
+            reward = await environment.act(step * 7 % environment.number_of_actions, step % 3 + 1)
+            results.append((reward, environment.is_game_over(), environment.frame_number, environment.get_screen().copy()))
+        await environment.quit()
+    except BaseException:
+        environment.abandon()
+        raise
+    return results
+
+
+@pytest.mark.parametrize('arguments', [{}, dict(protocol_version=TextProtocol), dict(shared_memory=True), dict(inherit_socket=False),
+                                       dict(tile_size=8), dict(frame_hashes=True),
+                                       dict(preprocess=ObservationFormat(grayscale=True, resize=(32, 24)))])
+def test_async_plays_like_mamele(standin, arguments):
+    synchronous = standin(**arguments)
+    expected = play(synchronous, synchronous.act, synchronous.restart_game)
+    results = asyncio.run(play_asynchronously(arguments))
+
+    assert len(results) == len(expected)
+    assert any(result[1] for result in expected)
+    for step, (result, wanted) in enumerate(zip(results, expected)):
+        assert result[:3] == wanted[:3], step
+        assert numpy.array_equal(result[3], wanted[3]), step
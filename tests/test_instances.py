@@ -0,0 +1,159 @@
+"""
+Keeping instances around: the pool, and the supervisor replacing those that die
+"""
+
+import os
+import signal
+import functools
+import logging
+
+import numpy
+import pytest
+
+from mamele.pool import MamelePool
+from mamele.vector import MameleVec
+from mamele.supervisor import SupervisedMamele
+from mamele.connection import ConnectionLost
+from mamele.benchmark.harness import StandInMamele
+from mamele.recorder import EpisodeRecorder, Recording
+
+from conftest import Screen
+
+
+def kill(environment):
+    os.kill(environment.mame.pid, signal.SIGKILL)
+    environment.mame.wait()
+
+
+def test_pool_keeps_instances_ready():
+    pool = MamelePool(instances_per_game=1, maximum_per_game=2, environment_class=StandInMamele, **Screen)
+    try:
+        first = pool.acquire('standin')
+        assert not first.is_game_over()
+        first.act(0)
+
+        # another one was booted to take its place
+        waiting = pool._instances['standin']
+        assert len(waiting) == 1
+        waiting[0].result()
+        second = pool.acquire('standin')
+        assert second is not first
+        with pytest.raises(ValueError):
+            pool.acquire('standin')
+
+        # given back, it's restarted and handed out again
+        pool.release(first)
+        again = pool.acquire('standin')
+        assert again is first
+        assert first.score == 0
+        pool.release(again)
+        pool.release(second)
+    finally:
+        pool.close()
+
+
+def test_pool_gives_up_on_games_that_dont_boot(caplog):
+    caplog.set_level(logging.CRITICAL)
+
+    boots = []
+
+    class Broken(StandInMamele):
+        def __init__(self, game_name, **arguments):
+            boots.append(game_name)
+            raise ConnectionLost("No MAME here")
+
+    pool = MamelePool(instances_per_game=2, environment_class=Broken, **Screen)
+    try:
+        with pytest.raises(ConnectionLost):
+            pool.acquire('standin')
+        for instance in list(pool._instances['standin']):
+            with pytest.raises(ConnectionLost):
+                instance.result()
+        # and doesn't keep booting more in the background
+        booted = len(boots)
+        with pytest.raises(ConnectionLost):
+            pool.acquire('standin')
+        assert len(boots) == booted + 1
+    finally:
+        pool.close()
+
+
+@pytest.fixture
+def supervised():
+    environment = SupervisedMamele('standin', step_timeout=2, start_timeout=30, backoff=0.01, environment_class=StandInMamele, **Screen)
+    yield environment
+    if environment.environment is not None:
+        environment.environment.abandon()
+
+
+def test_supervisor_replaces_dead_instances(supervised, tmp_path, caplog):
+    caplog.set_level(logging.CRITICAL)
+    recorder = EpisodeRecorder(str(tmp_path)).attach(supervised)
+    for step in range(10):
+        supervised.act(step)
+    first = supervised.environment
+
+    kill(first)
+    assert supervised.act(0) == 0
+    assert supervised.truncated and supervised.is_game_over()
+    assert supervised.respawns == 1 and supervised.environment is not first
+
+    supervised.restart_game()
+    assert not supervised.is_game_over()
+    supervised.send_action(0)
+    kill(supervised.environment)
+    assert supervised.receive_update() == 0
+    assert supervised.respawns == 2
+
+    supervised.restart_game()
+    for step in range(5):
+        supervised.act(step)
+    recorder.close()
+    # the recording went on across both replacements
+    assert [len(episode) for episode in Recording(str(tmp_path))] == [10, 5]
+    last = Recording(str(tmp_path))[1]
+    assert numpy.array_equal(last.frames[4].reshape(-1), numpy.frombuffer(supervised.latest_image_as_bytes, dtype=numpy.uint8))
+
+
+def test_supervisor_closes_when_it_gives_up(supervised, caplog):
+    caplog.set_level(logging.CRITICAL)
+
+    class Broken(StandInMamele):
+        def _mame_command(self, game, socket_path):
+            return ['sleep', '60']
+
+    supervised.environment_class = Broken
+    supervised.start_timeout = 0.2
+    supervised.maximum_failures = 1
+    kill(supervised.environment)
+    with pytest.raises(ConnectionLost):
+        supervised.act(0)
+
+    assert supervised.closed
+    with pytest.raises(ConnectionLost):
+        supervised.act(0)
+    with pytest.raises(ConnectionLost):
+        supervised.score
+    supervised.quit()
+
+
+
+def test_supervised_instances_step_together(caplog):
+    caplog.set_level(logging.CRITICAL)
+    supervised = functools.partial(SupervisedMamele, environment_class=StandInMamele)
+    vector = MameleVec('standin', 2, environment_class=supervised, step_timeout=2, start_timeout=30, backoff=0.01, **Screen)
+    try:
+        vector.reset()
+        vector.step([0, 0])
+        kill(vector.environments[0].environment)
+        for step in range(5):
+            vector.step([step, step])
+        assert vector.environments[0].respawns == 1
+        assert vector.environments[1].respawns == 0
+    finally:
+        vector.close()
+
+
+def test_supervised_act_async_is_refused(supervised):
+    with pytest.raises(NotImplementedError):
+        supervised.act_async(0)
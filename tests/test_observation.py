@@ -0,0 +1,67 @@
+"""
+Converting screens, here or in the passthrough
+"""
+
+import numpy
+import pytest
+
+from mamele.observation import ObservationFormat
+
+
+def expected(frame, grayscale=False, crop=None, downsample=1, layout='HWC', resize=None):
+    """
+    The BGRA `frame` converted the slow and obvious way
+    """
+    frame = frame.astype(numpy.uint32)
+    height, width = frame.shape[:2]
+    left, top, right, bottom = crop if crop is not None else (0, 0, width, height)
+    right, bottom = min(right, width), min(bottom, height)
+    if resize is not None:
+        rows = [top + int((row + 0.5) * (bottom - top) / resize[1]) for row in range(resize[1])]
+        columns = [left + int((column + 0.5) * (right - left) / resize[0]) for column in range(resize[0])]
+        frame = frame[rows][:, columns]
+    else:
+        frame = frame[top:bottom:downsample, left:right:downsample]
+
+    if grayscale:
+        blue, green, red = frame[:, :, 0], frame[:, :, 1], frame[:, :, 2]
+        return ((29 * blue + 150 * green + 77 * red) >> 8).astype(numpy.uint8)
+    rgb = frame[:, :, 2::-1].astype(numpy.uint8)
+    return rgb.transpose(2, 0, 1) if layout == 'CHW' else rgb
+
+
+@pytest.mark.parametrize('arguments', [
+    {},
+    dict(grayscale=True),
+    dict(layout='CHW'),
+    dict(crop=(8, 4, 56, 40)),
+    dict(crop=(8, 4, 200, 100), grayscale=True),
+    dict(downsample=3),
+    dict(downsample=2, crop=(1, 2, 63, 47), layout='CHW'),
+    dict(resize=(20, 30)),
+    dict(resize=(84, 84), grayscale=True),
+    dict(resize=(32, 24), crop=(4, 4, 60, 44), layout='CHW'),
+])
+def test_conversions(standin, arguments):
+    here = standin()
+    passthrough = standin(preprocess=ObservationFormat(**arguments))
+    assert passthrough.frame_shape == here.get_observation_shape(**arguments)
+
+    for step in range(10):
+        here.act(step * 7 % here.number_of_actions)
+        passthrough.act(step * 7 % passthrough.number_of_actions)
+        frame = numpy.frombuffer(here.latest_image_as_bytes, dtype=numpy.uint8).reshape(here.frame_shape)
+        converted = here.get_screen(**arguments)
+        assert converted.shape == here.get_observation_shape(**arguments)
+        assert numpy.array_equal(converted, expected(frame, **arguments)), step
+        assert numpy.array_equal(passthrough.get_screen(), converted), step
+
+        out = numpy.zeros_like(converted)
+        assert here.get_screen(out=out, **arguments) is out
+        assert numpy.array_equal(out, converted)
+
+
+def test_preprocessed_frames_cant_be_converted_again(standin):
+    environment = standin(preprocess=ObservationFormat(grayscale=True))
+    with pytest.raises(ValueError):
+        environment.get_screen(grayscale=True)
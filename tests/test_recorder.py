@@ -0,0 +1,79 @@
+"""
+Recording episodes, reading them back and replaying them
+"""
+
+import numpy
+import pytest
+
+from mamele.protocol import TextProtocol
+from mamele.recorder import EpisodeRecorder, Recording, verify_episode
+
+
+def play_game(environment, act):
+    # the actions are a fixed sequence of all of them, held for 1 to 3 frames
+    step = 0
+    while not environment.is_game_over():
+        act(step * 7 % environment.number_of_actions, step % 3 + 1)
+        step += 1
+    return step
+
+
+@pytest.mark.parametrize('arguments', [{}, dict(shared_memory=True), dict(tile_size=8)])
+def test_recording_replays_the_same(standin, tmp_path, arguments):
+    environment = standin(**arguments)
+    recorder = EpisodeRecorder(str(tmp_path), chunk_size=16).attach(environment)
+    steps = play_game(environment, environment.act)
+    last_frame = numpy.frombuffer(environment.latest_image_as_bytes, dtype=numpy.uint8).reshape(environment.frame_shape).copy()
+    recorder.close()
+
+    episode = Recording(str(tmp_path))[0]
+    assert len(episode) == steps
+    assert episode.game_overs[len(episode) - 1]
+    assert numpy.array_equal(episode.frames[len(episode) - 1], last_frame)
+
+    replayed = standin(**arguments)
+    mismatch, frames = verify_episode(replayed, episode, checkpoints=(5, steps - 1), batch_size=8)
+    assert mismatch is None
+    for step, frame in frames.items():
+        assert numpy.array_equal(frame, episode.frames[step]), step
+
+    # a different action makes a difference where it was taken
+    actions = episode.actions[:].copy()
+    actions[5] ^= 0xffff
+    replayed.restart_game()
+    scores, _, _ = replayed.replay(actions, episode.frames_per_step())
+    assert numpy.flatnonzero(numpy.diff(scores, prepend=0) != episode.rewards[:len(scores)])[0] == 5
+
+
+def test_act_async_is_recorded_like_act(standin, tmp_path):
+    recordings = []
+    for name in ('act', 'act_async'):
+        environment = standin()
+        recorder = EpisodeRecorder(str(tmp_path / name), chunk_size=16).attach(environment)
+        play_game(environment, getattr(environment, name))
+        if environment._pending_step is not None:
+            environment._pending_step.wait()
+        recorder.close()
+        recordings.append(Recording(str(tmp_path / name))[0])
+
+    synchronous, asynchronous = recordings
+    for field in ('actions', 'rewards', 'game_overs', 'frame_numbers', 'frames'):
+        assert numpy.array_equal(getattr(synchronous, field)[:], getattr(asynchronous, field)[:]), field
+
+
+def test_restarting_starts_another_episode(standin, tmp_path):
+    environment = standin()
+    recorder = EpisodeRecorder(str(tmp_path)).attach(environment)
+    for step in range(10):
+        environment.act(step)
+    environment.restart_game()
+    for step in range(5):
+        environment.act(step)
+    recorder.close()
+
+    assert [len(episode) for episode in Recording(str(tmp_path))] == [10, 5]
+
+
+def test_the_text_protocol_cant_be_recorded(standin, tmp_path):
+    with pytest.raises(ValueError):
+        EpisodeRecorder(str(tmp_path)).attach(standin(protocol_version=TextProtocol))
@@ -0,0 +1,113 @@
+"""
+The ways of talking to the passthrough all play the same game
+"""
+
+import numpy
+import pytest
+
+from mamele.protocol import TextProtocol
+from mamele.benchmark.harness import StandInMamele
+
+
+def play(environment, steps, repeat=1, **arguments):
+    """
+    Act through `steps` actions, and return the rewards, game overs, frame numbers and screens after each
+    """
+    results = []
+    for step in range(steps):
+        reward = environment.act(step * 7 % environment.number_of_actions, repeat, **arguments)
+        results.append((reward, environment.is_game_over(), environment.frame_number, environment.get_screen().copy()))
+    return results
+
+
+def assert_same_play(results, expected):
+    assert len(results) == len(expected)
+    for step, (result, wanted) in enumerate(zip(results, expected)):
+        assert result[:3] == wanted[:3], step
+        assert numpy.array_equal(result[3], wanted[3]), step
+
+
+def test_text_and_binary_protocols_agree(standin):
+    text = play(standin(protocol_version=TextProtocol), 60)
+    binary = play(standin(), 60)
+    # the text protocol doesn't tell us frame numbers
+    assert [result[:2] for result in text] == [result[:2] for result in binary]
+    for step, (from_text, from_binary) in enumerate(zip(text, binary)):
+        assert numpy.array_equal(from_text[3], from_binary[3]), step
+    assert any(result[0] for result in binary)
+
+
+@pytest.mark.parametrize('arguments', [dict(shared_memory=True), dict(inherit_socket=False), dict(frame_hashes=True)])
+def test_other_transports_agree(standin, arguments):
+    assert_same_play(play(standin(**arguments), 60, repeat=2), play(standin(), 60, repeat=2))
+
+
+def test_repeat_holds_the_action(standin):
+    repeated = standin()
+    one_at_a_time = standin()
+    for step in range(20):
+        action = step * 7 % repeated.number_of_actions
+        reward = repeated.act(action, repeat=4)
+        assert reward == sum(one_at_a_time.act(action) for _ in range(4))
+        assert repeated.frame_number == one_at_a_time.frame_number
+        assert numpy.array_equal(repeated.get_screen(), one_at_a_time.get_screen())
+
+
+def test_max_pool_keeps_the_brightest_of_the_last_two_frames(standin):
+    pooled = standin()
+    one_at_a_time = standin()
+    for step in range(20):
+        action = step * 7 % pooled.number_of_actions
+        pooled.act(action, repeat=4, max_pool=True)
+        for _ in range(3):
+            one_at_a_time.act(action)
+        before_last = one_at_a_time.get_screen().copy()
+        one_at_a_time.act(action)
+        assert numpy.array_equal(pooled.get_screen(), numpy.maximum(before_last, one_at_a_time.get_screen())), step
+
+
+def test_tiles_rebuild_every_frame(standin, monkeypatch):
+    # keyframes often enough that a few of them come along
+    monkeypatch.setattr(StandInMamele, 'KeyframeInterval', 16)
+    tiled = standin(tile_size=8)
+    assert_same_play(play(tiled, 100), play(standin(), 100))
+    assert tiled.transfer_statistics['tiled_frames'] > tiled.transfer_statistics['full_frames'] > 1
+
+
+def test_snapshot_and_restore(standin):
+    environment = standin()
+    play(environment, 10)
+    handle = environment.snapshot()
+    saved = (environment.score, environment.frame_number, environment.get_screen().copy())
+    after = [result[:2] for result in play(environment, 20)]
+
+    environment.restore(handle)
+    assert (environment.score, environment.frame_number) == saved[:2]
+    assert numpy.array_equal(environment.get_screen(), saved[2])
+    assert [result[:2] for result in play(environment, 20)] == after
+
+
+def test_restore_with_frame_hashes(standin):
+    hashed = standin(frame_hashes=True)
+    plain = standin()
+    for environment in (hashed, plain):
+        play(environment, 10)
+    handles = [environment.snapshot() for environment in (hashed, plain)]
+    # so that the first frame after restoring is the last one the passthrough sent before
+    assert_same_play(play(hashed, 1), play(plain, 1))
+
+    for environment, handle in zip((hashed, plain), handles):
+        environment.restore(handle)
+    assert not hashed.is_duplicate_frame
+    assert_same_play(play(hashed, 5), play(plain, 5))
+
+
+def test_act_async_gives_what_act_does(standin):
+    synchronous = standin()
+    asynchronous = standin()
+    for step in range(30):
+        action = step * 7 % synchronous.number_of_actions
+        reward = synchronous.act(action, repeat=2)
+        pending = asynchronous.act_async(action, repeat=2)
+        assert pending.wait() == reward
+        assert pending.frame_number == synchronous.frame_number
@@ -0,0 +1,129 @@
+"""
+Stepping instances together, here and over TCP through mamele-server
+"""
+
+import numpy
+import pytest
+
+from mamele.vector import MameleVec
+from mamele.remote import RemoteMamele, RemoteMameleVec, RemoteError
+from mamele.server import MameleServer, ClientArguments, StandInArguments
+from mamele.benchmark.harness import StandInMamele
+
+from conftest import Screen
+
+
+Instances = 3
+ScreenArguments = dict(grayscale=True, resize=(32, 24))
+
+
+@pytest.fixture
+def server():
+    server = MameleServer(port=0, environment_class=StandInMamele, maximum_instances=Instances,
+                          client_arguments=ClientArguments | StandInArguments)
+    server.start()
+    yield server.address[len('tcp:'):]
+    server.close()
+
+
+def results(vector):
+    return [array.copy() for array in (vector.observations, vector.rewards, vector.game_overs, vector.frame_numbers, vector.final_observations)]
+
+
+def test_finished_games_restart_in_the_same_step():
+    vector = MameleVec('standin', 2, environment_class=StandInMamele, game_length=40, **Screen)
+    try:
+        vector.reset()
+        for step in range(100):
+            observations, _, game_overs = vector.step([step % 36, 7])
+            if game_overs.any():
+                break
+        finished = numpy.flatnonzero(game_overs)
+        assert len(finished)
+        for index in finished:
+            environment = vector.environments[index]
+            # the observation is already that of the next game, and the last one of the game that ended is kept
+            assert not environment.is_game_over()
+            assert numpy.array_equal(observations[index], environment.get_screen())
+            assert not numpy.array_equal(vector.final_observations[index], observations[index])
+    finally:
+        vector.close()
+
+
+def test_instances_without_frames_keep_their_observations():
+    vector = MameleVec('standin', 2, environment_class=StandInMamele, receive_frames=False, **Screen)
+    try:
+        vector.reset()
+        vector.observations[:] = 7
+        vector.step([0, 0])
+        assert (vector.observations == 7).all()
+        vector.step([0, 0], with_frame=True)
+        assert (vector.observations != 7).any()
+    finally:
+        vector.close()
+
+
+@pytest.mark.parametrize('compression', [None, 1])
+def test_remote_plays_like_local(server, compression):
+    remote = RemoteMameleVec('standin', Instances, server, compression=compression, game_length=40, **dict(Screen, **ScreenArguments))
+    local = MameleVec('standin', Instances, environment_class=StandInMamele, game_length=40, **dict(Screen, **ScreenArguments))
+    try:
+        assert numpy.array_equal(remote.reset(), local.reset())
+        random = numpy.random.default_rng(0)
+        finished = 0
+        for step in range(60):
+            actions = random.integers(0, remote.number_of_actions, Instances)
+            remote.step(actions, repeat=2)
+            local.step(actions, repeat=2)
+            for remotely, locally in zip(results(remote), results(local)):
+                assert numpy.array_equal(remotely, locally), step
+            finished += local.game_overs.sum()
+        assert finished
+    finally:
+        remote.close()
+        local.close()
+
+
+def test_remote_mamele(server):
+    remote = RemoteMamele('standin', server, **Screen)
+    local = StandInMamele('standin', **Screen)
+    try:
+        remote.restart_game()
+        local.restart_game()
+        for step in range(20):
+            assert remote.act(step, repeat=2) == local.act(step, repeat=2)
+            assert remote.frame_number == local.frame_number
+            assert numpy.array_equal(remote.get_screen(), local.get_screen())
+    finally:
+        remote.quit()
+        local.quit()
+
+
+def test_remote_sends_no_frames_to_instances_without_them(server):
+    remote = RemoteMameleVec('standin', 2, server, receive_frames=False, **Screen)
+    try:
+        remote.reset()
+        received = remote.connection.bytes_received
+        remote.step([0, 0])
+        # the rewards, game overs and frame numbers, and not the screens
+        assert remote.connection.bytes_received - received < 100
+        assert not remote.observations.any()
+    finally:
+        remote.close()
+
+
+@pytest.mark.parametrize('game_name, arguments', [('-help', {}), ('standin', dict(nice=-5)), ('standin', dict(shared_memory=True))])
+def test_server_refuses_what_clients_cant_ask_for(server, game_name, arguments):
+    with pytest.raises(RemoteError):
+        RemoteMameleVec(game_name, 1, server, **arguments)
+
+
+@pytest.mark.parametrize('compression', [12, 'fast'])
+def test_server_refuses_bad_compression(server, compression):
+    with pytest.raises(RemoteError):
+        RemoteMameleVec('standin', 1, server, compression=compression, **Screen)
+
+
+def test_server_limits_instances(server):
+    with pytest.raises(RemoteError):
+        RemoteMameleVec('standin', Instances + 1, server, **Screen)
@@ -0,0 +1,46 @@
+"""
+MameleEnv's observations are the last screens stacked
+"""
+
+import numpy
+import pytest
+
+from mamele.observation import ObservationFormat
+from mamele.wrapper import MameleEnv
+
+
+FrameStack = 4
+
+
+@pytest.mark.parametrize('mamele_arguments, screen_arguments', [
+    ({}, {}),
+    ({}, dict(grayscale=True, resize=(32, 24))),
+    (dict(tile_size=8), dict(grayscale=True, crop=(4, 4, 60, 44), layout='CHW')),
+    (dict(preprocess=ObservationFormat(grayscale=True, resize=(32, 24))), {}),
+    (dict(preprocess=ObservationFormat(grayscale=True, resize=(32, 24)), shared_memory=True), {}),
+])
+def test_observations_are_the_last_screens(standin, mamele_arguments, screen_arguments):
+    environment = standin(game_length=40, restart=False, **mamele_arguments)
+    wrapped = MameleEnv(environment=environment, frame_stack=FrameStack, repeat=2, **screen_arguments)
+
+    def assert_stack(observation, screens):
+        assert observation.shape == wrapped.observation_space.shape
+        for stacked, screen in zip(observation, screens):
+            assert numpy.array_equal(stacked, screen)
+
+    try:
+        games = 0
+        terminated = True
+        for step in range(100):
+            if terminated:
+                observation, _ = wrapped.reset()
+                # the first screen of the game, as many times as the stack holds
+                screens = [environment.get_screen(**screen_arguments).copy()] * FrameStack
+                assert_stack(observation, screens)
+                games += 1
+            observation, _, terminated, _, _ = wrapped.step(step % wrapped.action_space.n)
+            screens = screens[1:] + [environment.get_screen(**screen_arguments).copy()]
+            assert_stack(observation, screens)
+        assert games > 1
+    finally:
+        wrapped.close()